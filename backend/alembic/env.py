@@ -0,0 +1,65 @@
+"""Alembic environment: the app's database URL and model metadata.
+
+    cd backend && alembic upgrade head
+
+SQLite runs in batch mode, so column changes work through table copies.
+"""
+
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine, pool
+
+from app import models
+from app.db import SQLALCHEMY_DATABASE_URL, connect_args
+
+config = context.config
+if config.config_file_name is not None and config.attributes.get("configure_logger", True):
+    fileConfig(config.config_file_name)
+
+target_metadata = models.Base.metadata
+
+
+def database_url() -> str:
+    # Tests hand in their own URL through the Config object
+    return config.attributes.get("url") or SQLALCHEMY_DATABASE_URL
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    # The SQLite FTS5 table and its shadow tables are managed by hand in 0002
+    return not (type_ == "table" and name.startswith("messages_fts"))
+
+
+def run_migrations_offline():
+    url = database_url()
+    context.configure(
+        url=url,
+        target_metadata=target_metadata,
+        include_object=include_object,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        render_as_batch=url.startswith("sqlite"),
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    url = database_url()
+    engine = create_engine(url, poolclass=pool.NullPool, connect_args=connect_args if url.startswith("sqlite") else {})
+    with engine.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_object=include_object,
+            render_as_batch=connection.dialect.name == "sqlite",
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+    engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
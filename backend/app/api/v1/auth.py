@@ -3,29 +3,39 @@
 Uses bcrypt for password hashing and python-jose for JWT.
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from jose import jwt
-import random
-import string
+import hmac
 
 from ... import crud, schemas, models
 from ...db import get_db
 from ...config import settings
-from ...utils.email import send_email
+from ...utils.notifications import notifications
+from ...utils.otp_store import create_otp_store, generate_code
+from ...utils.passwords import PasswordHasher
 
 router = APIRouter()
 
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+# Argon2 runs on its own bounded pool; overflow raises HasherBusy (-> 429)
+password_hasher = PasswordHasher(
+    max_workers=settings.PASSWORD_HASH_WORKERS,
+    max_queue=settings.PASSWORD_HASH_QUEUE,
+    queue_timeout=settings.PASSWORD_HASH_QUEUE_TIMEOUT,
+    time_cost=settings.ARGON2_TIME_COST,
+    memory_cost=settings.ARGON2_MEMORY_COST,
+    parallelism=settings.ARGON2_PARALLELISM,
+)
+
+otp_store = create_otp_store(settings.OTP_STORE_URL, ttl=settings.OTP_TTL_SECONDS)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_hasher.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return password_hasher.hash(password)
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
     to_encode = data.copy()
@@ -35,69 +45,54 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
     return encoded_jwt
 
 @router.post("/send-otp")
-def send_otp(request: schemas.OTPRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+def send_otp(request: schemas.OTPRequest, db: Session = Depends(get_db)):
     # Check if user already exists
     if crud.get_user_by_email(db, request.email):
          raise HTTPException(status_code=400, detail="Email already registered. Please login.")
 
-    # Generate 6 digit OTP
-    otp = ''.join(random.choices(string.digits, k=6))
-    
-    # Store in DB
-    # Invalidate old codes
-    old_codes = db.query(models.VerificationCode).filter(models.VerificationCode.email == request.email).all()
-    for code in old_codes:
-        code.is_used = True
+    # Generate 6 digit OTP; issuing it invalidates any earlier code
+    otp = generate_code()
+    otp_store.issue(request.email, otp)
     
-    new_code = models.VerificationCode(email=request.email, code=otp)
-    db.add(new_code)
+    # Send Email (queued in the outbox's priority lane)
+    notifications.otp(db, request.email, "Workspace Registration OTP", f"Your OTP is: {otp}")
     db.commit()
     
-    # Send Email
-    background_tasks.add_task(send_email, request.email, "Workspace Registration OTP", f"Your OTP is: {otp}")
-    
     return {"message": "OTP sent to email"}
 
 @router.post("/register", response_model=schemas.UserRead)
 def register(user_in: schemas.OTPVerify, db: Session = Depends(get_db)):
-    # Verify OTP
-    # Allow master OTP for testing
-    is_master_otp = settings.MASTER_OTP and user_in.code == settings.MASTER_OTP
-    
-    if not is_master_otp:
-        record = db.query(models.VerificationCode).filter(
-            models.VerificationCode.email == user_in.email,
-            models.VerificationCode.code == user_in.code,
-            models.VerificationCode.is_used == False
-        ).order_by(models.VerificationCode.created_at.desc()).first()
-        
-        if not record:
-            raise HTTPException(status_code=400, detail="Invalid OTP")
-            
-        # Check expiration (e.g., 10 mins)
-        if datetime.utcnow() - record.created_at > timedelta(minutes=10):
-            raise HTTPException(status_code=400, detail="OTP expired")
-            
-        record.is_used = True
-        db.commit()
-    
-    # Create User
     db_user = crud.get_user_by_email(db, user_in.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
         
+    # Hash before verifying: a 429 from a busy hasher must not use up the OTP
     hashed_password = get_password_hash(user_in.password)
+
+    # Verify OTP (single use, so only once nothing else can fail)
+    # Allow master OTP for testing
+    is_master_otp = bool(settings.MASTER_OTP) and hmac.compare_digest(user_in.code.encode(), settings.MASTER_OTP.encode())
+    
+    if not is_master_otp and not otp_store.verify(user_in.email, user_in.code):
+        raise HTTPException(status_code=400, detail="Invalid or expired OTP")
+    
+    # Create User
     user_data = schemas.UserCreate(email=user_in.email, password=user_in.password, full_name=user_in.full_name)
     return crud.create_user(db, user_data, hashed_password, role=user_in.role)
 
 @router.post("/login", response_model=schemas.Token)
-def login(background_tasks: BackgroundTasks, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = crud.get_user_by_email(db, form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    valid, new_hash = password_hasher.verify_and_update(form_data.password, user.hashed_password if user else None)
+    if not valid:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect credentials")
+    if new_hash:
+        # Stored with older Argon2 parameters: upgrade while we have the password
+        user.hashed_password = new_hash
     
-    # Trigger login alert mail
-    background_tasks.add_task(send_email, user.email, "New Login Alert", f"New login detected at {datetime.utcnow()}. If this wasn't you, verify your account.")
+    # Trigger login alert mail; repeats within LOGIN_ALERT_WINDOW go to the digest
+    notifications.alert(db, user.email, "New Login Alert", f"New login detected at {datetime.utcnow()}. If this wasn't you, verify your account.", key=f"login_alert:{user.id}", kind="login_alert")
+    db.commit()
     
     access_token = create_access_token(data={"sub": str(user.id)})
     return {"access_token": access_token, "token_type": "bearer"}
@@ -1,36 +1,340 @@
 """Chat endpoints and WebSocket handler with persistence."""
 
-from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, Query
-from typing import List
+import asyncio
+import json
+import logging
+import time
+import uuid
+from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect, Query, status
+from typing import Dict, List, Optional, Set
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from ... import models, schemas, crud
-from ...db import get_db
+from ... import models, schemas, crud, deps
+from ...config import settings
+from ...db import get_async_db, get_db
+from ...utils.broadcast import BroadcastBackend, InMemoryBroadcast, RedisBroadcast, create_broadcast_backend
+from ...utils.chat_writer import MessageWriter
+from ...utils.message_cache import RecentMessageCache, default_ttl
+from ...utils.message_search import search_messages
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# --- Presence ---
+# Worker-to-worker presence frames start with this; chat frames never do
+PRESENCE_STATE = '{"type": "presence_state"'
+
+
+class PresenceTracker:
+    """In-memory user <-> socket and room -> users mappings.
+
+    A user counts as present in a room while at least one of their sockets is
+    connected to it; ``join`` and ``leave`` report only those transitions.
+    Each worker tracks the sockets it holds; ``ConnectionManager`` merges in
+    the other workers' users.
+    """
+
+    def __init__(self):
+        self.user_sockets: Dict[str, Set[WebSocket]] = {}
+        self.room_users: Dict[str, Dict[str, int]] = {}
+
+    def join(self, room: str, user_id: str, websocket: WebSocket) -> bool:
+        """Record a socket; True if the user was not yet present in the room."""
+        self.user_sockets.setdefault(user_id, set()).add(websocket)
+        users = self.room_users.setdefault(room, {})
+        users[user_id] = users.get(user_id, 0) + 1
+        return users[user_id] == 1
+
+    def leave(self, room: str, user_id: str, websocket: WebSocket) -> bool:
+        """Forget a socket; True if it was the user's last one in the room."""
+        sockets = self.user_sockets.get(user_id)
+        if sockets is not None:
+            sockets.discard(websocket)
+            if not sockets:
+                del self.user_sockets[user_id]
+        users = self.room_users.get(room)
+        if not users or user_id not in users:
+            return False
+        users[user_id] -= 1
+        if users[user_id] > 0:
+            return False
+        del users[user_id]
+        if not users:
+            del self.room_users[room]
+        return True
+
+    def roster(self, room: str) -> List[str]:
+        return sorted(self.room_users.get(room, {}))
+
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self.user_sockets
+
 
 # --- Connection Manager ---
+class Connection:
+    """A connected socket plus the bounded queue its writer task drains."""
+
+    def __init__(self, websocket: WebSocket, room: str, queue_size: int, user_id: str | None = None, presence: bool = False):
+        self.websocket = websocket
+        self.room = room
+        self.user_id = user_id
+        self.presence = presence  # Client opted in to presence diffs and heartbeats
+        self.last_seen = time.monotonic()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.writer: asyncio.Task | None = None
+
+
 class ConnectionManager:
-    def __init__(self):
-        # Store connections by room? For now, simple list.
-        # Ideally: self.active_connections: Dict[str, List[WebSocket]]
-        self.active_connections: List[WebSocket] = []
+    """Tracks sockets per room and fans messages out through per-socket queues.
+
+    ``broadcast`` only enqueues, so its cost is proportional to the size of the
+    room and never waits on the network. Every socket has its own writer task;
+    a client that lets its queue fill up, or whose send takes longer than
+    ``send_timeout``, is evicted instead of holding up the rest of the room.
+
+    Sockets that opt in to presence receive the room's roster on connect,
+    then join/leave diffs, and a ``{"type": "ping"}`` frame every
+    ``heartbeat_interval`` seconds. They must answer with ``pong`` (any frame
+    counts); sockets silent for longer than ``heartbeat_timeout`` are reaped
+    even if they never sent a close frame.
+
+    Presence spans workers: each worker publishes its local users of a room
+    (a ``presence_state`` frame) through the broadcast backend whenever they
+    change and on every heartbeat, and asks the others for theirs when it
+    subscribes to the room. The roster is the union of those states; a
+    worker's state expires ``heartbeat_timeout`` seconds after its last
+    refresh, so users of a crashed worker do not stay online. A worker only
+    follows rooms it holds sockets for.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 100,
+        send_timeout: float = 5.0,
+        backend: BroadcastBackend | None = None,
+        heartbeat_interval: float = 20.0,
+        heartbeat_timeout: float = 60.0,
+    ):
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.backend = backend or InMemoryBroadcast()
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.rooms: Dict[str, Dict[WebSocket, Connection]] = {}
+        self.presence = PresenceTracker()
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._remote: Dict[str, Dict[str, tuple]] = {}  # room -> worker -> (users, refreshed at)
+        self._rosters: Dict[str, Set[str]] = {}  # room -> roster last pushed to sockets
+        self.evicted = 0
+        self.reaped = 0
+        self._started = False
+        self._heartbeat: asyncio.Task | None = None
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, room: str = "general", user_id: str | None = None, presence: bool = False):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        if not self._started:
+            await self.backend.start(self.deliver)
+            self._started = True
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.create_task(self._beat())
+        conn = Connection(websocket, room, self.queue_size, user_id=user_id, presence=presence)
+        conn.writer = asyncio.create_task(self._drain(conn))
+        first = room not in self.rooms
+        # Existing sockets get a diff for the new user, the new one the whole roster
+        self.rooms.setdefault(room, {})
+        if user_id is not None and self.presence.join(room, user_id, websocket):
+            self._push_presence(room)
+        self.rooms[room][websocket] = conn
+        if presence:
+            self._push_presence(room, to=conn, snapshot=True)
+        if first:
+            await self.backend.subscribe(room)
+            await self._publish_state(room, sync=True)
+        elif user_id is not None:
+            await self._publish_state(room)
+
+    def disconnect(self, websocket: WebSocket, room: str = "general"):
+        members = self.rooms.get(room)
+        if not members:
+            return
+        conn = members.pop(websocket, None)
+        if not members:
+            del self.rooms[room]
+            self._remote.pop(room, None)
+            self._rosters.pop(room, None)
+            asyncio.create_task(self._release(room))
+        if conn is None:
+            return
+        if conn.writer and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+        if conn.user_id is not None and self.presence.leave(room, conn.user_id, websocket):
+            self._push_presence(room)
+            asyncio.create_task(self._publish_state(room))
+
+    def touch(self, websocket: WebSocket, room: str = "general"):
+        """Mark a socket as alive; call on every inbound frame."""
+        conn = self.rooms.get(room, {}).get(websocket)
+        if conn:
+            conn.last_seen = time.monotonic()
+
+    async def broadcast(self, message: str, room: str = "general"):
+        """Publish to every socket in the room, on this and all other workers."""
+        await self.backend.publish(room, message)
+
+    async def deliver(self, room: str, message: str):
+        """Fan a message out to the sockets this worker holds for the room."""
+        if message.startswith(PRESENCE_STATE):
+            await self._apply_state(room, json.loads(message))
+            return
+        self._fan_out(room, message)
+
+    def room_size(self, room: str) -> int:
+        return len(self.rooms.get(room, {}))
+
+    def roster(self, room: str) -> List[str]:
+        """Users present in the room on this worker or any worker it hears from."""
+        users = set(self.presence.roster(room))
+        for remote_users, _ in self._remote.get(room, {}).values():
+            users |= remote_users
+        return sorted(users)
+
+    async def shutdown(self):
+        if self._heartbeat:
+            self._heartbeat.cancel()
+        await self.backend.close()
 
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+    def _fan_out(self, room: str, message: str, presence_only: bool = False):
+        for conn in list(self.rooms.get(room, {}).values()):
+            if presence_only and not conn.presence:
+                continue
+            try:
+                conn.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self._evict(conn)
+
+    def _push_presence(self, room: str, to: Connection | None = None, snapshot: bool = False):
+        """Send presence sockets what changed since the last push (or, to `to`, the roster)."""
+        if room not in self.rooms:
+            # No sockets left here: nobody to tell, and no roster to keep
+            self._rosters.pop(room, None)
+            return
+        users = set(self.roster(room))
+        if snapshot:
+            joined, left = users, set()
+        else:
+            previous = self._rosters.get(room, set())
+            joined, left = users - previous, previous - users
+            self._rosters[room] = users
+        if not joined and not left:
+            return
+        diff = json.dumps({"type": "presence", "room": room, "joined": sorted(joined), "left": sorted(left)})
+        if to is None:
+            self._fan_out(room, diff, presence_only=True)
+            return
+        try:
+            to.queue.put_nowait(diff)
+        except asyncio.QueueFull:
+            self._evict(to)
+
+    async def _publish_state(self, room: str, sync: bool = False):
+        """Tell the other workers which users this worker holds in the room."""
+        frame = {"type": "presence_state", "worker": self.worker_id, "users": self.presence.roster(room), "sync": sync}
+        try:
+            await self.backend.publish(room, json.dumps(frame))
+        except Exception:
+            logger.exception("Chat presence publish failed for room %s", room)
+
+    async def _apply_state(self, room: str, frame: dict):
+        if frame["worker"] == self.worker_id or room not in self.rooms:
+            return
+        remote = self._remote.setdefault(room, {})
+        if frame["users"]:
+            remote[frame["worker"]] = (set(frame["users"]), time.monotonic())
+        else:
+            remote.pop(frame["worker"], None)
+        if frame.get("sync") and self.presence.roster(room):
+            await self._publish_state(room)  # A worker just joined the room: bring it up to date
+        self._push_presence(room)
+
+    async def _beat(self):
+        ping = json.dumps({"type": "ping"})
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            deadline = time.monotonic() - self.heartbeat_timeout
+            for room in list(self.rooms):
+                if self.presence.roster(room):
+                    await self._publish_state(room)
+                remote = self._remote.get(room, {})
+                stale = [worker for worker, (_, refreshed) in remote.items() if refreshed < deadline]
+                for worker in stale:
+                    del remote[worker]
+                if stale:
+                    self._push_presence(room)
+            for members in list(self.rooms.values()):
+                for conn in list(members.values()):
+                    if not conn.presence:
+                        continue
+                    if conn.last_seen < deadline:
+                        self.reaped += 1
+                        self._evict(conn, code=status.WS_1001_GOING_AWAY)
+                        continue
+                    try:
+                        conn.queue.put_nowait(ping)
+                    except asyncio.QueueFull:
+                        self._evict(conn)
+
+    async def _release(self, room: str):
+        # A socket may have rejoined while this task was pending.
+        if room not in self.rooms:
+            await self.backend.unsubscribe(room)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
+    async def _drain(self, conn: Connection):
+        while True:
+            message = await conn.queue.get()
             try:
-                await connection.send_text(message)
-            except:
-                pass # Handle broken pipe
+                await asyncio.wait_for(conn.websocket.send_text(message), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._evict(conn)
+                return
+
+    def _evict(self, conn: Connection, code: int = status.WS_1013_TRY_AGAIN_LATER):
+        """Drop a slow, broken or silent consumer and close its socket."""
+        if conn.websocket not in self.rooms.get(conn.room, {}):
+            return
+        self.evicted += 1
+        self.disconnect(conn.websocket, conn.room)
+        asyncio.create_task(self._close(conn.websocket, code))
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass # Already closed by the peer
+
+manager = ConnectionManager(
+    queue_size=settings.CHAT_SEND_QUEUE_SIZE,
+    send_timeout=settings.CHAT_SEND_TIMEOUT,
+    backend=create_broadcast_backend(settings.CHAT_BROADCAST_URL),
+    heartbeat_interval=settings.CHAT_HEARTBEAT_INTERVAL,
+    heartbeat_timeout=settings.CHAT_HEARTBEAT_TIMEOUT,
+)
 
-manager = ConnectionManager()
+message_writer = MessageWriter(
+    batch_size=settings.CHAT_WRITE_BATCH_SIZE,
+    flush_interval=settings.CHAT_WRITE_FLUSH_INTERVAL,
+    max_pending=settings.CHAT_WRITE_MAX_PENDING,
+)
+
+history_cache = RecentMessageCache(
+    room_capacity=settings.CHAT_HISTORY_CACHE_ROOM_SIZE,
+    max_bytes=settings.CHAT_HISTORY_CACHE_MAX_BYTES,
+    ttl=settings.CHAT_HISTORY_CACHE_TTL if settings.CHAT_HISTORY_CACHE_TTL is not None
+    else default_ttl(settings.CHAT_BROADCAST_URL),
+)
+message_writer.listeners.append(history_cache.append)
 
 # --- Endpoints ---
 
@@ -38,28 +342,106 @@ manager = ConnectionManager()
 def list_rooms():
     return ["general", "random", "dev"]
 
-@router.get("/history", response_model=List[schemas.MessageRead])
-def get_chat_history(room: str = "general", limit: int = 50, db: Session = Depends(get_db)):
-    """Fetch recent chat messages for a room."""
-    messages = crud.get_messages(db, room=room, limit=limit)
+@router.get("/rooms/{room}/presence")
+def get_room_presence(room: str, current_user: deps.Principal = Depends(deps.get_current_principal)):
+    """Users with at least one open socket in the room.
+
+    Covers every worker for rooms this worker holds sockets for, otherwise
+    only this worker.
+    """
+    users = manager.roster(room)
+    return {"room": room, "users": users, "count": len(users)}
+
+def _history(db: Session, room: str, limit: int, before_id: Optional[int], after_id: Optional[int]):
+    def load_tail(n: int):
+        return [schemas.MessageRead.from_orm(m) for m in crud.get_messages(db, room=room, limit=n)]
+
+    cached = history_cache.lookup(room, limit, load_tail, before_id=before_id, after_id=after_id)
+    if cached is not None:
+        return cached
+    messages = crud.get_messages(db, room=room, limit=limit, before_id=before_id, after_id=after_id)
     return messages
 
+def get_chat_history(
+    room: str = "general",
+    limit: int = Query(50, ge=1, le=200),
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    """Fetch chat messages for a room, oldest first.
+
+    Returns the newest `limit` messages by default. Pass the id of the first
+    message you hold as `before_id` to load older ones, or the id of the last
+    as `after_id` to catch up on newer ones.
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+    return _history(db, room, limit, before_id, after_id)
+
+async def get_chat_history_async(
+    room: str = "general",
+    limit: int = Query(50, ge=1, le=200),
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """`get_chat_history` on the async engine, for DB_ASYNC_READS."""
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+    return await db.run_sync(_history, room, limit, before_id, after_id)
+
+router.get("/history", response_model=List[schemas.MessageRead])(
+    get_chat_history_async if settings.DB_ASYNC_READS else get_chat_history
+)
+
+@router.get("/search", response_model=List[schemas.MessageRead])
+def search_chat(
+    q: str = Query(..., min_length=1),
+    room: Optional[str] = None,
+    sender_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    before_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+):
+    """Full-text search over messages, newest first.
+
+    Every word in `q` must appear in a message for it to match. Pass the id
+    of the last result as `before_id` to fetch the next page.
+    """
+    return search_messages(db, q, room=room, sender_id=sender_id, limit=limit, before_id=before_id)
+
+@router.get("/metrics")
+def get_chat_metrics(admin: deps.Principal = Depends(deps.get_admin_principal)):
+    """Write-behind, history cache and fan-out statistics."""
+    return {
+        "writer": message_writer.metrics(),
+        "history_cache": history_cache.metrics(),
+        "evicted_sockets": manager.evicted,
+        "reaped_sockets": manager.reaped,
+    }
+
 @router.websocket("/ws")
 async def websocket_endpoint(
     websocket: WebSocket, 
     user_id: str = Query(...), 
     room: str = Query("general"),
-    db: Session = Depends(get_db) 
+    presence: bool = Query(False),
 ):
     """
     WebSocket endpoint for real-time chat.
-    Note: 'Depends' on WebSocket isn't fully supported for per-message DB sessions in all versions, 
-    so we use it for initial connection or manage session manually if needed.
+    Messages are handed to the write-behind buffer and broadcast right away;
+    persistence happens in batches off the receive path.
+    With `presence=true` the client also receives JSON presence diffs and
+    heartbeat pings, and must answer each ping with a `pong` frame.
     """
-    await manager.connect(websocket)
+    await manager.connect(websocket, room, user_id=user_id, presence=presence)
     try:
         while True:
             data = await websocket.receive_text()
+            manager.touch(websocket, room)
+            if presence and data == "pong":
+                continue
             
             # Persist message
             # We need a proper user ID (int) for key constraint. 
@@ -71,15 +453,14 @@ async def websocket_endpoint(
             if user_id.isdigit():
                 sender_id_int = int(user_id)
             
-            msg_create = schemas.MessageCreate(content=data, room=room)
-            crud.create_message(db, msg_create, sender_id=sender_id_int)
+            await message_writer.enqueue(data, room, sender_id_int)
             
             # Broadcast
-            await manager.broadcast(f"User {user_id}: {data}")
+            await manager.broadcast(f"User {user_id}: {data}", room)
             
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        await manager.broadcast(f"User {user_id} left the chat")
+        manager.disconnect(websocket, room)
+        await manager.broadcast(f"User {user_id} left the chat", room)
     except Exception as e:
         print(f"WS Error: {e}")
-        manager.disconnect(websocket)
+        manager.disconnect(websocket, room)
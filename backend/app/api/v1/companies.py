@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 
 from ... import crud, schemas, models, deps
@@ -45,15 +45,50 @@ def update_my_company_location(
     company.latitude = loc.latitude
     company.longitude = loc.longitude
     company.allowed_radius = loc.allowed_radius
+    company.sites_version = (company.sites_version or 0) + 1
     db.commit()
     db.refresh(company)
     return company
 
+def _my_company(db: Session, principal: deps.Principal) -> models.Company:
+    company = db.get(models.Company, principal.company_id) if principal.company_id else None
+    if company is None:
+        raise HTTPException(status_code=404, detail="No company associated with user")
+    return company
+
 @router.get("/me", response_model=schemas.CompanyRead)
 def get_my_company(
     db: Session = Depends(get_db), 
-    current_user: models.User = Depends(deps.get_current_user)
+    current_user: deps.Principal = Depends(deps.get_current_principal)
 ):
-    if not current_user.company:
-        raise HTTPException(status_code=404, detail="No company associated with user")
-    return current_user.company
+    return _my_company(db, current_user)
+
+
+def _require_company_admin(db: Session, current_user: deps.Principal) -> models.Company:
+    if current_user.role not in ["hr", "admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return _my_company(db, current_user)
+
+@router.get("/me/sites", response_model=List[schemas.CompanySiteRead])
+def list_my_company_sites(db: Session = Depends(get_db), current_user: deps.Principal = Depends(deps.get_current_principal)):
+    return _my_company(db, current_user).sites
+
+@router.post("/me/sites", response_model=schemas.CompanySiteRead, status_code=status.HTTP_201_CREATED)
+def add_my_company_site(
+    site_in: schemas.CompanySiteCreate,
+    db: Session = Depends(get_db),
+    current_user: deps.Principal = Depends(deps.get_current_principal)
+):
+    """Add an office or client site where employees may clock in."""
+    company = _require_company_admin(db, current_user)
+    return crud.create_company_site(db, company, site_in)
+
+@router.delete("/me/sites/{site_id}", status_code=status.HTTP_204_NO_CONTENT)
+def remove_my_company_site(
+    site_id: int,
+    db: Session = Depends(get_db),
+    current_user: deps.Principal = Depends(deps.get_current_principal)
+):
+    company = _require_company_admin(db, current_user)
+    if not crud.delete_company_site(db, company, site_id):
+        raise HTTPException(status_code=404, detail="Site not found")
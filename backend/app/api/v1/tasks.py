@@ -2,24 +2,35 @@
 """Task CRUD endpoints (minimal)."""
 
 from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing import List
 
 from ... import crud, schemas, models
-from ...db import get_db
+from ...config import settings
+from ...db import get_async_db, get_db
 
 router = APIRouter()
 
-from ...deps import get_current_user
+from ...deps import Principal, get_current_principal, get_current_principal_async
 @router.post("/", response_model=schemas.TaskRead, status_code=status.HTTP_201_CREATED)
-def create_task(task_in: schemas.TaskCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def create_task(task_in: schemas.TaskCreate, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
     return crud.create_task(db, task_in, creator_id=current_user.id)
 
-@router.get("/", response_model=List[schemas.TaskRead])
-def list_tasks(filter_by: str = "assigned", db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def _list_tasks(db: Session, user_id: int, filter_by: str):
     # filter_by: 'assigned' (default) or 'created'
     if filter_by == "created":
-        tasks = db.query(models.Task).filter(models.Task.creator_id == current_user.id).all()
-    else:
-        tasks = db.query(models.Task).filter(models.Task.assignee_id == current_user.id).all()
-    return tasks
+        return db.query(models.Task).filter(models.Task.creator_id == user_id).all()
+    return db.query(models.Task).filter(models.Task.assignee_id == user_id).all()
+
+def list_tasks(filter_by: str = "assigned", db: Session = Depends(get_db), current_user: Principal = Depends(get_current_principal)):
+    return _list_tasks(db, current_user.id, filter_by)
+
+async def list_tasks_async(
+    filter_by: str = "assigned",
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Principal = Depends(get_current_principal_async),
+):
+    return await db.run_sync(_list_tasks, current_user.id, filter_by)
+
+router.get("/", response_model=List[schemas.TaskRead])(list_tasks_async if settings.DB_ASYNC_READS else list_tasks)
@@ -1,32 +1,30 @@
+import asyncio
+import json
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from math import radians, cos, sin, asin, sqrt
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, time, timedelta
 from typing import List
 
 from ... import crud, schemas, models, deps
-from ...db import get_db
+from ...config import settings
+from ...db import SessionLocal, get_db
+from ...utils.attendance_stream import attendance_hub
+from ...utils.entry_sweeper import OpenEntrySweeper
+from ...utils.geofence import site_indexes
+from ...utils.open_sessions import open_sessions
+from ...utils.punch_ingest import ingest_punches
+from ...utils.timesheet_analytics import PERIODS, load_columns, local_range, summarize, summary_rows
+from ...utils.timesheet_export import ENCODERS, FORMATS, export_batches
 
 router = APIRouter()
 
-def haversine(lon1, lat1, lon2, lat2):
-    """
-    Calculate the great circle distance in meters between two points 
-    on the earth (specified in decimal degrees)
-    """
-    if lon1 is None or lat1 is None or lon2 is None or lat2 is None:
-        return float('inf')
-
-    # convert decimal degrees to radians 
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-
-    # haversine formula 
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
-    r = 6371 * 1000 # Radius of earth in meters
-    return c * r
+open_entry_sweeper = OpenEntrySweeper(
+    max_hours=settings.OPEN_ENTRY_MAX_HOURS,
+    interval=settings.OPEN_ENTRY_SWEEP_INTERVAL,
+    batch_size=settings.OPEN_ENTRY_SWEEP_BATCH_SIZE,
+)
 
 @router.post("/clock", response_model=schemas.TimeEntryRead)
 def clock_action(entry: schemas.TimeEntryCreate, db: Session = Depends(get_db), current_user: models.User = Depends(deps.get_current_user)):
@@ -36,19 +34,17 @@ def clock_action(entry: schemas.TimeEntryCreate, db: Session = Depends(get_db),
             # If no company, check if user has forced location check enabled? For now pass
             pass
         else:
-            company = current_user.company
-            if company.latitude and company.longitude:
+            sites = site_indexes.get(current_user.company)
+            if len(sites):
                 # Require user location
                 if entry.latitude is None or entry.longitude is None:
                     raise HTTPException(status_code=400, detail="Location data is required to clock in.")
                 
-                dist = haversine(entry.longitude, entry.latitude, company.longitude, company.latitude)
-                radius = company.allowed_radius or 100.0
-                
-                if dist > radius:
+                match = sites.nearest(entry.latitude, entry.longitude)
+                if not match.allowed:
                     raise HTTPException(
                         status_code=403, 
-                        detail=f"You are {int(dist)}m away from the allowed location. Max allowed is {int(radius)}m."
+                        detail=f"You are {int(match.distance)}m away from {match.site.name}. Max allowed is {int(match.site.radius)}m."
                     )
     
     # 2. Perform action
@@ -56,58 +52,232 @@ def clock_action(entry: schemas.TimeEntryCreate, db: Session = Depends(get_db),
     if not db_entry:
         raise HTTPException(status_code=400, detail="Could not process time entry")
     
+    # 3. Push the status change to live dashboards
+    online = open_sessions.is_open(current_user.id)
+    if online is None:
+        online = db_entry.clock_out is None
+    attendance_hub.publish_punch(current_user.company_id, current_user.id, online=online)
+    
     return db_entry
 
+@router.post("/punches/batch", response_model=schemas.PunchBatchReport)
+def ingest_punch_batch(batch: schemas.PunchBatch, db: Session = Depends(get_db), current_user: deps.Principal = Depends(deps.get_current_principal)):
+    """Replay punches queued offline by a kiosk or mobile app.
+
+    Employees may submit their own punches; HR and admins may submit for
+    anyone in their company. Each punch gets its own result, and
+    resubmitting a batch is safe: already-ingested punches come back as
+    "duplicate" (see utils/punch_ingest.py).
+    """
+    if len(batch.punches) > settings.PUNCH_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {settings.PUNCH_BATCH_MAX_ITEMS} punches per batch")
+    results = ingest_punches(db, batch.punches, current_user)
+    return schemas.PunchBatchReport(
+        accepted=sum(r.status == "accepted" for r in results),
+        duplicates=sum(r.status == "duplicate" for r in results),
+        rejected=sum(r.status == "rejected" for r in results),
+        expired=sum(r.status == "expired" for r in results),
+        results=results,
+    )
+
+@router.get("/geofence-audit", response_model=List[schemas.TimeEntryRead])
+def audit_punch_locations(
+    day: date,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(deps.get_current_user)
+):
+    """Clock-ins on `day` whose recorded location is outside every company site.
+
+    Re-validates the whole day in one vectorized pass against the site index.
+    """
+    if current_user.role not in ["hr", "admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if not current_user.company:
+        raise HTTPException(status_code=404, detail="No company associated with user")
+    start = datetime.combine(day, datetime.min.time())
+    entries = db.query(models.TimeEntry).join(models.User).filter(
+        models.User.company_id == current_user.company_id,
+        models.TimeEntry.clock_in >= start,
+        models.TimeEntry.clock_in < start + timedelta(days=1),
+        models.TimeEntry.latitude.is_not(None),
+        models.TimeEntry.longitude.is_not(None),
+    ).order_by(models.TimeEntry.id).all()
+    inside = site_indexes.get(current_user.company).contains_many(
+        [e.latitude for e in entries], [e.longitude for e in entries]
+    )
+    return [e for e, ok in zip(entries, inside) if not ok]
+
+@router.get("/export")
+def export_time_entries(
+    start: date,
+    end: date,
+    format: str = "csv",
+    current_user: deps.Principal = Depends(deps.get_current_principal)
+):
+    """Stream the company's time entries clocked in from `start` through `end`.
+
+    Rows are read and encoded in batches of EXPORT_BATCH_SIZE, so memory
+    stays flat and the download starts right away for any range.
+    """
+    if current_user.role not in ["hr", "admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if not current_user.company_id:
+        raise HTTPException(status_code=404, detail="No company associated with user")
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(FORMATS)}")
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=400, detail="Parquet export requires pyarrow to be installed")
+
+    batches = export_batches(
+        current_user.company_id,
+        datetime.combine(start, datetime.min.time()),
+        datetime.combine(end + timedelta(days=1), datetime.min.time()),
+    )
+    media_type, extension = FORMATS[format]
+    filename = f"timesheet_{start.isoformat()}_{end.isoformat()}.{extension}"
+    return StreamingResponse(
+        ENCODERS[format](batches),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@router.get("/analytics", response_model=schemas.TimesheetAnalytics)
+def get_timesheet_analytics(
+    start: date,
+    end: date,
+    period: str = "week",
+    daily_overtime_hours: float = 8.0,
+    workday_start: time = time(9, 0),
+    grace_minutes: int = 0,
+    tz_offset_minutes: int = 0,
+    db: Session = Depends(get_db),
+    current_user: deps.Principal = Depends(deps.get_current_principal)
+):
+    """Per-employee hours, overtime and late arrivals per week or month.
+
+    Entries are loaded as NumPy columns and aggregated with vectorized
+    operations (see utils/timesheet_analytics.py). A year of punches for
+    2,000 employees (~1M entries) takes ~6.7 s on SQLite, almost all of it
+    reading rows, versus ~24 s for a per-entry loop
+    (benchmarks/bench_timesheet_analytics.py).
+    """
+    if current_user.role not in ["hr", "admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    if not current_user.company_id:
+        raise HTTPException(status_code=404, detail="No company associated with user")
+    if period not in PERIODS:
+        raise HTTPException(status_code=400, detail=f"period must be one of: {', '.join(PERIODS)}")
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+
+    since, until = local_range(start, end, tz_offset_minutes)
+    columns = load_columns(db, current_user.company_id, since, until)
+    summary = summarize(
+        columns,
+        period=period,
+        daily_overtime_hours=daily_overtime_hours,
+        workday_start=workday_start,
+        grace_minutes=grace_minutes,
+        tz_offset_minutes=tz_offset_minutes,
+    )
+    names = dict(db.query(models.User.id, models.User.full_name).filter(models.User.company_id == current_user.company_id).all())
+    return schemas.TimesheetAnalytics(period=period, start=start, end=end, rows=summary_rows(summary, names))
+
 @router.get("/dashboard", response_model=schemas.AttendanceDashboard)
-def get_attendance_dashboard(db: Session = Depends(get_db), current_user: models.User = Depends(deps.get_current_user)):
+def get_attendance_dashboard(db: Session = Depends(get_db), current_user: deps.Principal = Depends(deps.get_current_principal)):
+    """Today's attendance for the caller's company.
+
+    Reads the attendance_days rollup plus any open entries in one query,
+    instead of one query per user over raw punches. At 10k users on SQLite,
+    p95 drops from ~21 s to ~70 ms (see benchmarks/bench_attendance_dashboard.py).
+    """
     if current_user.role not in ["hr", "admin"]:
         raise HTTPException(status_code=403, detail="Not authorized")
-    
+    return build_attendance_dashboard(db, current_user.company_id)
+
+@router.get("/metrics")
+def get_time_tracking_metrics(admin: deps.Principal = Depends(deps.get_admin_principal)):
+    """Stale open-entry sweeper statistics."""
+    return {"sweeper": open_entry_sweeper.metrics()}
+
+@router.get("/stream")
+async def stream_attendance(current_user: deps.Principal = Depends(deps.get_current_principal_detached)):
+    """Live attendance over Server-Sent Events.
+
+    Sends the dashboard once as a `snapshot` event, then a `status` event
+    (user_id, status, online_count) whenever a punch changes someone's
+    status. A comment line every 15 s keeps idle proxies from closing it.
+    The snapshot is read on a short session of its own: the stream holds no
+    database connection while it is open.
+    """
+    if current_user.role not in ["hr", "admin"]:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    company_id = current_user.company_id
+
+    # Subscribe before reading the snapshot; the hub holds back punches
+    # published in between and replays them once seeded.
+    queue = await attendance_hub.subscribe(company_id)
+    try:
+        snapshot = await run_in_threadpool(_read_snapshot, company_id)
+    except Exception:
+        attendance_hub.unsubscribe(company_id, queue)
+        raise
+    attendance_hub.seed(company_id, [s.user_id for s in snapshot.stats if s.status == "online"])
+
+    async def events():
+        try:
+            yield f"event: snapshot\ndata: {snapshot.json()}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), 15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            attendance_hub.unsubscribe(company_id, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def _read_snapshot(company_id) -> schemas.AttendanceDashboard:
+    with SessionLocal() as db:
+        return build_attendance_dashboard(db, company_id)
+
+def build_attendance_dashboard(db: Session, company_id) -> schemas.AttendanceDashboard:
+    """Today's attendance snapshot for one company."""
     today_start = datetime.combine(date.today(), datetime.min.time())
-    users = db.query(models.User).all()
+    now = datetime.utcnow()
+    rows = crud.get_attendance_stats(db, company_id, since=today_start, now=now)
     
     stats = []
     online_count = 0
     offline_count = 0
     
-    for user in users:
-        # Get entries for today
-        entries = db.query(models.TimeEntry).filter(
-            models.TimeEntry.user_id == user.id,
-            models.TimeEntry.clock_in >= today_start
-        ).order_by(models.TimeEntry.clock_in.asc()).all()
-        
-        # Calculate total hours
-        total_seconds = 0.0
-        is_online = False
-        last_clock_in = None
-        last_clock_out = None
-        
-        for entry in entries:
-            last_clock_in = entry.clock_in
-            if entry.clock_out:
-                last_clock_out = entry.clock_out
-                total_seconds += (entry.clock_out - entry.clock_in).total_seconds()
-            else:
-                # Currently clocked in
-                is_online = True
-                # Add duration until now
-                total_seconds += (datetime.utcnow() - entry.clock_in).total_seconds()
-        
-        status = "online" if is_online else "offline"
+    for row in rows:
+        # The registry also sees entries left open since an earlier day.
+        is_online = open_sessions.is_open(row.id)
+        if is_online is None:
+            is_online = bool(row.is_open)
         if is_online:
             online_count += 1
         else:
             offline_count += 1
             
         stats.append(schemas.AttendanceStat(
-            user_id=user.id,
-            full_name=user.full_name,
-            status=status,
-            clock_in=entries[0].clock_in if entries else None,
-            clock_out=last_clock_out,
-            total_hours=round(total_seconds / 3600, 2),
-            last_seen=last_clock_out if not is_online else datetime.utcnow()
+            user_id=row.id,
+            full_name=row.full_name,
+            status="online" if is_online else "offline",
+            clock_in=row.first_clock_in,
+            clock_out=row.last_clock_out,
+            total_hours=round((row.total_seconds or 0.0) / 3600, 2),
+            last_seen=now if is_online else row.last_clock_out
         ))
         
     return schemas.AttendanceDashboard(
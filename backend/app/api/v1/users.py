@@ -6,18 +6,32 @@ import os
 import secrets
 from pathlib import Path
 
+from sqlalchemy.ext.asyncio import AsyncSession
+
 from ... import crud, schemas, models, deps
-from ...db import get_db
+from ...config import settings
+from ...db import get_async_db, get_db
 
 router = APIRouter()
 
 UPLOAD_DIR = Path("static/uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
-@router.get("/me", response_model=schemas.UserRead)
 def read_users_me(current_user: models.User = Depends(deps.get_current_user)):
     return current_user
 
+async def read_users_me_async(
+    principal: deps.Principal = Depends(deps.get_current_principal_async),
+    db: AsyncSession = Depends(get_async_db),
+):
+    user = await db.get(models.User, principal.id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+# DB_ASYNC_READS serves this hot read on the event loop instead of the threadpool
+router.get("/me", response_model=schemas.UserRead)(read_users_me_async if settings.DB_ASYNC_READS else read_users_me)
+
 @router.put("/me", response_model=schemas.UserRead)
 def update_user_me(
     user_in: schemas.UserUpdate,
@@ -69,7 +83,7 @@ async def upload_profile_picture(
 def invite_user(
     invite_in: schemas.OnboardingInviteCreate, 
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(deps.get_current_user)
+    current_user: deps.Principal = Depends(deps.get_current_principal)
 ):
     if current_user.role != "admin" and current_user.role != "hr":
          raise HTTPException(status_code=403, detail="Not authorized to invite users")
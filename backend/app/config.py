@@ -4,14 +4,40 @@ Uses pydantic BaseSettings for type safety.
 """
 
 import os
+from typing import Optional
 from pydantic import Field, BaseSettings
 # from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     DATABASE_URL: str = Field(default="sqlite:///./test_v3.db", env="DATABASE_URL")
+    # Each engine (sync and async) keeps its own pool of this size
+    DB_POOL_SIZE: int = Field(default=10, env="DB_POOL_SIZE")
+    DB_MAX_OVERFLOW: int = Field(default=20, env="DB_MAX_OVERFLOW")
+    DB_POOL_TIMEOUT: float = Field(default=30.0, env="DB_POOL_TIMEOUT")  # seconds to wait for a connection
+    DB_POOL_RECYCLE: int = Field(default=1800, env="DB_POOL_RECYCLE")  # seconds; -1 never recycles
+    DB_POOL_PRE_PING: bool = Field(default=True, env="DB_POOL_PRE_PING")
+    DB_ASYNC_READS: bool = Field(default=False, env="DB_ASYNC_READS")  # serve hot reads from async routes
+
+    # SQLite Profile (ignored for other databases)
+    SQLITE_PROFILE: bool = Field(default=True, env="SQLITE_PROFILE")  # WAL + the pragmas below
+    SQLITE_SYNCHRONOUS: str = Field(default="NORMAL", env="SQLITE_SYNCHRONOUS")
+    SQLITE_MMAP_SIZE: int = Field(default=256 * 1024 * 1024, env="SQLITE_MMAP_SIZE")  # bytes
+    SQLITE_CACHE_SIZE: int = Field(default=-65536, env="SQLITE_CACHE_SIZE")  # negative = KiB
+    SQLITE_BUSY_TIMEOUT: int = Field(default=5000, env="SQLITE_BUSY_TIMEOUT")  # ms
+    SQLITE_SINGLE_WRITER: bool = Field(default=True, env="SQLITE_SINGLE_WRITER")
     SECRET_KEY: str = Field(default="temporary_secret_key_change_me", env="SECRET_KEY")
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60
     ALGORITHM: str = "HS256"
+    PRINCIPAL_CACHE_SIZE: int = Field(default=10000, env="PRINCIPAL_CACHE_SIZE")
+    PRINCIPAL_CACHE_TTL: float = Field(default=60.0, env="PRINCIPAL_CACHE_TTL")  # seconds; 0 disables
+
+    # Password Hashing (Argon2id)
+    ARGON2_TIME_COST: int = Field(default=3, env="ARGON2_TIME_COST")
+    ARGON2_MEMORY_COST: int = Field(default=65536, env="ARGON2_MEMORY_COST")  # KiB
+    ARGON2_PARALLELISM: int = Field(default=4, env="ARGON2_PARALLELISM")
+    PASSWORD_HASH_WORKERS: int = Field(default=2, env="PASSWORD_HASH_WORKERS")
+    PASSWORD_HASH_QUEUE: int = Field(default=16, env="PASSWORD_HASH_QUEUE")
+    PASSWORD_HASH_QUEUE_TIMEOUT: float = Field(default=0.0, env="PASSWORD_HASH_QUEUE_TIMEOUT")
     
     # SMTP Settings
     SMTP_SERVER: str = Field(default="smtp.gmail.com", env="SMTP_SERVER")
@@ -20,6 +46,50 @@ class Settings(BaseSettings):
     SMTP_PASSWORD: str = Field(default="", env="SMTP_PASSWORD")
     SMTP_FROM_EMAIL: str = Field(default="", env="SMTP_FROM_EMAIL")
     MASTER_OTP: str = Field(default="123456", env="MASTER_OTP")
+    SMTP_POOL_SIZE: int = Field(default=2, env="SMTP_POOL_SIZE")
+    SMTP_TIMEOUT: float = Field(default=30.0, env="SMTP_TIMEOUT")
+    SMTP_MAX_MESSAGES_PER_CONNECTION: int = Field(default=100, env="SMTP_MAX_MESSAGES_PER_CONNECTION")
+    SMTP_MAX_IDLE: float = Field(default=60.0, env="SMTP_MAX_IDLE")  # seconds before a NOOP check on reuse
+
+    # Email Outbox Settings
+    EMAIL_OUTBOX_BATCH_SIZE: int = Field(default=50, env="EMAIL_OUTBOX_BATCH_SIZE")
+    EMAIL_OUTBOX_POLL_INTERVAL: float = Field(default=5.0, env="EMAIL_OUTBOX_POLL_INTERVAL")  # seconds; 0 disables the sender
+    EMAIL_MAX_ATTEMPTS: int = Field(default=5, env="EMAIL_MAX_ATTEMPTS")
+    EMAIL_RETRY_BASE: float = Field(default=30.0, env="EMAIL_RETRY_BASE")
+    EMAIL_RETRY_MAX: float = Field(default=3600.0, env="EMAIL_RETRY_MAX")
+    LOGIN_ALERT_WINDOW: float = Field(default=900.0, env="LOGIN_ALERT_WINDOW")  # seconds; repeats go to the digest
+    NOTIFICATION_DIGEST_INTERVAL: float = Field(default=3600.0, env="NOTIFICATION_DIGEST_INTERVAL")  # seconds; 0 disables
+
+    # OTP Settings
+    OTP_STORE_URL: str = Field(default="sql://", env="OTP_STORE_URL")  # sql://, memory:// or redis://...
+    OTP_TTL_SECONDS: float = Field(default=600.0, env="OTP_TTL_SECONDS")
+    OTP_PURGE_INTERVAL: float = Field(default=3600.0, env="OTP_PURGE_INTERVAL")  # seconds; 0 disables
+
+    # Chat Settings
+    CHAT_SEND_QUEUE_SIZE: int = Field(default=100, env="CHAT_SEND_QUEUE_SIZE")
+    CHAT_SEND_TIMEOUT: float = Field(default=5.0, env="CHAT_SEND_TIMEOUT")
+    CHAT_HEARTBEAT_INTERVAL: float = Field(default=20.0, env="CHAT_HEARTBEAT_INTERVAL")
+    CHAT_HEARTBEAT_TIMEOUT: float = Field(default=60.0, env="CHAT_HEARTBEAT_TIMEOUT")
+    CHAT_BROADCAST_URL: str = Field(default="memory://", env="CHAT_BROADCAST_URL")
+    CHAT_WRITE_BATCH_SIZE: int = Field(default=200, env="CHAT_WRITE_BATCH_SIZE")
+    CHAT_WRITE_FLUSH_INTERVAL: float = Field(default=0.25, env="CHAT_WRITE_FLUSH_INTERVAL")
+    CHAT_WRITE_MAX_PENDING: int = Field(default=5000, env="CHAT_WRITE_MAX_PENDING")
+    CHAT_HISTORY_CACHE_ROOM_SIZE: int = Field(default=200, env="CHAT_HISTORY_CACHE_ROOM_SIZE")
+    CHAT_HISTORY_CACHE_MAX_BYTES: int = Field(default=16 * 1024 * 1024, env="CHAT_HISTORY_CACHE_MAX_BYTES")
+    # Unset: no expiry with memory://, a few seconds with a multi-worker backend
+    CHAT_HISTORY_CACHE_TTL: Optional[float] = Field(default=None, env="CHAT_HISTORY_CACHE_TTL")
+
+    # Time Tracking Settings
+    OPEN_SESSION_REGISTRY: bool = Field(default=False, env="OPEN_SESSION_REGISTRY")  # Single worker only
+    WEB_CONCURRENCY: int = Field(default=1, env="WEB_CONCURRENCY")  # uvicorn/gunicorn worker count
+    PUNCH_BATCH_MAX_ITEMS: int = Field(default=5000, env="PUNCH_BATCH_MAX_ITEMS")
+    OFFLINE_PUNCH_MAX_AGE_HOURS: float = Field(default=168.0, env="OFFLINE_PUNCH_MAX_AGE_HOURS")  # 0 disables
+    OPEN_ENTRY_MAX_HOURS: float = Field(default=16.0, env="OPEN_ENTRY_MAX_HOURS")
+    OPEN_ENTRY_SWEEP_INTERVAL: float = Field(default=900.0, env="OPEN_ENTRY_SWEEP_INTERVAL")  # seconds; 0 disables
+    OPEN_ENTRY_SWEEP_BATCH_SIZE: int = Field(default=500, env="OPEN_ENTRY_SWEEP_BATCH_SIZE")
+
+    # Export Settings
+    EXPORT_BATCH_SIZE: int = Field(default=5000, env="EXPORT_BATCH_SIZE")
 
     class Config:
         env_file = ".env"
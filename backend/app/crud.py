@@ -3,9 +3,17 @@
 These functions are used by the API routers.
 """
 
+from sqlalchemy import Date, DateTime, Float, and_, bindparam, case, delete, func, insert, literal, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import FunctionElement
+from contextlib import ExitStack
 from datetime import datetime, timedelta
+from typing import List, Optional
 from . import models, schemas
+from .utils.message_search import index_messages
+from .utils.open_sessions import open_sessions
 
 # User CRUD
 
@@ -39,6 +47,25 @@ def create_company(db: Session, company: schemas.CompanyCreate):
     db.refresh(db_company)
     return db_company
 
+def create_company_site(db: Session, company: models.Company, site: schemas.CompanySiteCreate):
+    db_site = models.CompanySite(company_id=company.id, **site.dict())
+    db.add(db_site)
+    company.sites_version = (company.sites_version or 0) + 1
+    db.commit()
+    db.refresh(db_site)
+    return db_site
+
+def delete_company_site(db: Session, company: models.Company, site_id: int) -> bool:
+    db_site = db.query(models.CompanySite).filter(
+        models.CompanySite.id == site_id, models.CompanySite.company_id == company.id
+    ).first()
+    if not db_site:
+        return False
+    db.delete(db_site)
+    company.sites_version = (company.sites_version or 0) + 1
+    db.commit()
+    return True
+
 # Project CRUD
 
 def create_project(db: Session, project: schemas.ProjectCreate):
@@ -102,49 +129,306 @@ def create_message(db: Session, message: schemas.MessageCreate, sender_id: int):
         sender_id=sender_id
     )
     db.add(db_message)
+    db.flush()
+    index_messages(db, [db_message])
     db.commit()
     db.refresh(db_message)
     return db_message
 
-def get_messages(db: Session, room: str = "general", limit: int = 50):
-    return db.query(models.Message).filter(models.Message.room == room).order_by(models.Message.timestamp.asc()).limit(limit).all()
+def create_messages(db: Session, rows: List[dict]) -> List[models.Message]:
+    """Insert many messages in one multi-row INSERT and commit once."""
+    messages = db.scalars(insert(models.Message).returning(models.Message), rows).all()
+    index_messages(db, messages)
+    db.commit()
+    return messages
+
+def get_messages(db: Session, room: str = "general", limit: int = 50, before_id: Optional[int] = None, after_id: Optional[int] = None):
+    """Return up to `limit` messages of a room, oldest first.
+
+    Without a cursor this is the newest page. `before_id` pages back to older
+    messages and `after_id` forward to newer ones. Both seek on the
+    (room, timestamp, id) index, so cost does not depend on table size.
+    """
+    Message = models.Message
+    query = db.query(Message).filter(Message.room == room)
+    key = tuple_(Message.timestamp, Message.id)
+    cursor_id = after_id if after_id is not None else before_id
+    if cursor_id is not None:
+        cursor_ts = db.query(Message.timestamp).filter(Message.id == cursor_id).scalar()
+        if cursor_ts is None:
+            return []
+        if after_id is not None:
+            return query.filter(key > tuple_(cursor_ts, cursor_id)).order_by(
+                Message.timestamp.asc(), Message.id.asc()
+            ).limit(limit).all()
+        query = query.filter(key < tuple_(cursor_ts, cursor_id))
+    messages = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    messages.reverse()
+    return messages
 
 def create_time_entry(db: Session, entry: schemas.TimeEntryCreate, user_id: int):
+    # One punch per user at a time: reading the open entry and closing it
+    # must not interleave with another punch by the same user.
+    with open_sessions.lock(user_id):
+        return _create_time_entry(db, entry, user_id)
+
+def _create_time_entry(db: Session, entry: schemas.TimeEntryCreate, user_id: int):
     # Determine clock_in or clock_out based on action, or create a raw entry
+    now = datetime.utcnow()
     if entry.action == "clock_in":
         db_entry = models.TimeEntry(
             user_id=user_id,
-            clock_in=datetime.utcnow()
+            clock_in=now,
+            latitude=entry.latitude,
+            longitude=entry.longitude
         )
         db.add(db_entry)
+        record_attendance(db, user_id, clock_in=now, opened=True)
         db.commit()
         db.refresh(db_entry)
+        open_sessions.opened(user_id, db_entry.clock_in, db_entry.id)
         return db_entry
     elif entry.action == "clock_out":
         # Find latest open entry
-        last_entry = db.query(models.TimeEntry).filter(
-            models.TimeEntry.user_id == user_id, 
-            models.TimeEntry.clock_out == None
-        ).order_by(models.TimeEntry.clock_in.desc()).first()
+        latest = open_sessions.latest(user_id) if open_sessions.loaded else None
+        last_entry = db.get(models.TimeEntry, latest[1]) if latest else None
+        if last_entry is not None and last_entry.clock_out is not None:
+            # Closed elsewhere (e.g. by the sweeper): forget it and ask the database
+            open_sessions.closed(user_id, last_entry.id)
+            last_entry = None
+        if last_entry is None:
+            # A registry miss is not proof: the entry may have been opened on another worker
+            last_entry = _latest_open_entry(db, user_id)
         
-        if last_entry:
-            last_entry.clock_out = datetime.utcnow()
-            db.commit()
-            db.refresh(last_entry)
-            return last_entry
-        else:
-            # Create a new completed entry (e.g., if they forgot to clock in)
-            db_entry = models.TimeEntry(
-                user_id=user_id,
-                clock_in=datetime.utcnow(),
-                clock_out=datetime.utcnow()
-            )
-            db.add(db_entry)
-            db.commit()
-            db.refresh(db_entry)
-            return db_entry
+        while last_entry is not None:
+            # Only an entry that is still open: the sweeper, possibly on
+            # another worker, may have closed it since it was read.
+            closed = db.execute(
+                update(models.TimeEntry)
+                .where(models.TimeEntry.id == last_entry.id, models.TimeEntry.clock_out.is_(None))
+                .values(clock_out=now)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if closed:
+                record_attendance(db, user_id, clock_in=last_entry.clock_in, clock_out=now, closed=True)
+                db.commit()
+                db.refresh(last_entry)
+                open_sessions.closed(user_id, last_entry.id)
+                return last_entry
+            open_sessions.closed(user_id, last_entry.id)
+            last_entry = _latest_open_entry(db, user_id)
+
+        # Create a new completed entry (e.g., if they forgot to clock in)
+        db_entry = models.TimeEntry(
+            user_id=user_id,
+            clock_in=now,
+            clock_out=now
+        )
+        db.add(db_entry)
+        record_attendance(db, user_id, clock_in=now, clock_out=now)
+        db.commit()
+        db.refresh(db_entry)
+        return db_entry
     return None
 
+def _latest_open_entry(db: Session, user_id: int) -> Optional[models.TimeEntry]:
+    return db.query(models.TimeEntry).filter(
+        models.TimeEntry.user_id == user_id,
+        models.TimeEntry.clock_out == None
+    ).order_by(models.TimeEntry.clock_in.desc()).populate_existing().first()
+
+def auto_close_stale_entries(db: Session, opened_before: datetime, max_open: timedelta, after_id: int = 0, limit: int = 500):
+    """Close one batch of entries opened before `opened_before` and still open.
+
+    Walks open entries by id from `after_id` (a keyset cursor), sets
+    clock_out to clock_in + `max_open` and flags them `auto_closed`, then
+    rebuilds the affected attendance days and commits. Returns
+    (last id seen, [(entry id, user id)] closed); last id is None once no
+    stale entries remain. It holds the same per-user locks as /clock, and
+    the UPDATE re-checks `clock_out IS NULL`, so a concurrent clock_out wins.
+    """
+    TimeEntry = models.TimeEntry
+    rows = db.execute(
+        select(TimeEntry.id, TimeEntry.user_id, TimeEntry.clock_in)
+        .where(TimeEntry.clock_out.is_(None), TimeEntry.clock_in < opened_before, TimeEntry.id > after_id)
+        .order_by(TimeEntry.id)
+        .limit(limit)
+    ).all()
+    if not rows:
+        return None, []
+    table = TimeEntry.__table__
+    with ExitStack() as locks:
+        # Same per-user locks as /clock, taken in a fixed order
+        for user_id in sorted({r.user_id for r in rows}):
+            locks.enter_context(open_sessions.lock(user_id))
+        db.execute(
+            update(table)
+            .where(table.c.id == bindparam("entry_id"), table.c.clock_out.is_(None))
+            .values(clock_out=bindparam("closed_at"), auto_closed=True),
+            [{"entry_id": entry_id, "closed_at": clock_in + max_open} for entry_id, _, clock_in in rows],
+        )
+        closed = db.execute(
+            select(TimeEntry.id, TimeEntry.user_id).where(TimeEntry.id.in_([r.id for r in rows]), TimeEntry.auto_closed.is_(True))
+        ).all()
+        rebuild_attendance_days(db, [(user_id, clock_in.date()) for _, user_id, clock_in in rows])
+        db.commit()
+        for entry_id, user_id in closed:
+            open_sessions.closed(user_id, entry_id)
+    return rows[-1].id, [tuple(row) for row in closed]
+
+# Attendance
+
+class seconds_between(FunctionElement):
+    """Portable `end - start` in seconds for two DateTime expressions."""
+    type = Float()
+    inherit_cache = True
+
+@compiles(seconds_between)
+def _seconds_between_default(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return "EXTRACT(EPOCH FROM (%s - %s))" % (compiler.process(end, **kw), compiler.process(start, **kw))
+
+@compiles(seconds_between, "sqlite")
+def _seconds_between_sqlite(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return "((julianday(%s) - julianday(%s)) * 86400.0)" % (compiler.process(end, **kw), compiler.process(start, **kw))
+
+class day_of(FunctionElement):
+    """Calendar date of a DateTime expression."""
+    type = Date()
+    inherit_cache = True
+
+@compiles(day_of)
+def _day_of_default(element, compiler, **kw):
+    return "CAST(%s AS DATE)" % compiler.process(list(element.clauses)[0], **kw)
+
+@compiles(day_of, "sqlite")
+def _day_of_sqlite(element, compiler, **kw):
+    return "date(%s)" % compiler.process(list(element.clauses)[0], **kw)
+
+def _earliest(column, value):
+    return case((column.is_(None), value), (column > value, value), else_=column)
+
+def _latest(column, value):
+    return case((column.is_(None), value), (column < value, value), else_=column)
+
+def record_attendance(db: Session, user_id: int, clock_in: datetime, clock_out: Optional[datetime] = None, opened: bool = False, closed: bool = False):
+    """Fold one punch into the user's AttendanceDay row for the clock-in date.
+
+    `opened` marks a new open entry, `closed` the closing of a previously open
+    one; with neither, the entry arrived already complete. Updates are
+    relative (`total_seconds = total_seconds + ...`) so concurrent punches
+    for the same user never overwrite each other. Does not commit.
+    """
+    Day = models.AttendanceDay
+    day = clock_in.date()
+    dialect = db.get_bind().dialect.name
+    values = {"user_id": user_id, "day": day, "total_seconds": 0.0, "open_count": 0}
+    if dialect in ("sqlite", "postgresql"):
+        upsert = (sqlite.insert if dialect == "sqlite" else postgresql.insert)(Day)
+        db.execute(upsert.values(**values).on_conflict_do_nothing(index_elements=["user_id", "day"]))
+    elif db.query(Day.id).filter(Day.user_id == user_id, Day.day == day).first() is None:
+        db.execute(insert(Day).values(**values))
+
+    changes = {}
+    if not closed:
+        changes[Day.first_clock_in] = _earliest(Day.first_clock_in, clock_in)
+    if opened:
+        changes[Day.open_count] = Day.open_count + 1
+        changes[Day.open_since] = _earliest(Day.open_since, clock_in)
+    if clock_out is not None:
+        changes[Day.total_seconds] = Day.total_seconds + (clock_out - clock_in).total_seconds()
+        changes[Day.last_clock_out] = _latest(Day.last_clock_out, clock_out)
+    if closed:
+        # clock_out closes the newest open entry, so open_since (the oldest) survives
+        changes[Day.open_since] = case((Day.open_count <= 1, None), else_=Day.open_since)
+        changes[Day.open_count] = case((Day.open_count > 0, Day.open_count - 1), else_=0)
+    db.execute(
+        update(Day).where(Day.user_id == user_id, Day.day == day).values(changes),
+        execution_options={"synchronize_session": False},
+    )
+
+def backfill_attendance_days(db: Session) -> int:
+    """Rebuild every AttendanceDay row from time_entries in one INSERT ... SELECT."""
+    db.execute(delete(models.AttendanceDay))
+    rowcount = _insert_attendance_rollup(db)
+    db.commit()
+    return rowcount
+
+def rebuild_attendance_days(db: Session, keys: List[tuple]) -> int:
+    """Recompute the AttendanceDay rows for (user_id, day) pairs. Does not commit.
+
+    Used after bulk writes, where replaying each punch through
+    record_attendance would cost two statements per punch.
+    """
+    if not keys:
+        return 0
+    TimeEntry = models.TimeEntry
+    Day = models.AttendanceDay
+    keys = sorted(set(keys))
+    user_ids = sorted({user_id for user_id, _ in keys})
+    first_day = min(day for _, day in keys)
+    last_day = max(day for _, day in keys)
+    db.execute(delete(Day).where(tuple_(Day.user_id, Day.day).in_(keys)))
+    return _insert_attendance_rollup(
+        db,
+        TimeEntry.user_id.in_(user_ids),
+        TimeEntry.clock_in >= datetime.combine(first_day, datetime.min.time()),
+        TimeEntry.clock_in < datetime.combine(last_day + timedelta(days=1), datetime.min.time()),
+        tuple_(TimeEntry.user_id, day_of(TimeEntry.clock_in)).in_(keys),
+    )
+
+def _insert_attendance_rollup(db: Session, *criteria) -> int:
+    TimeEntry = models.TimeEntry
+    is_open = TimeEntry.clock_out.is_(None)
+    rollup = select(
+        TimeEntry.user_id,
+        day_of(TimeEntry.clock_in),
+        func.coalesce(func.sum(case((is_open, 0.0), else_=seconds_between(TimeEntry.clock_in, TimeEntry.clock_out))), 0.0),
+        func.min(TimeEntry.clock_in),
+        func.max(TimeEntry.clock_out),
+        func.min(case((is_open, TimeEntry.clock_in))),
+        func.sum(case((is_open, 1), else_=0)),
+    ).where(TimeEntry.user_id.is_not(None), TimeEntry.clock_in.is_not(None), *criteria).group_by(
+        TimeEntry.user_id, day_of(TimeEntry.clock_in)
+    )
+    result = db.execute(insert(models.AttendanceDay).from_select(
+        ["user_id", "day", "total_seconds", "first_clock_in", "last_clock_out", "open_since", "open_count"],
+        rollup,
+    ))
+    return result.rowcount
+
+def get_attendance_stats(db: Session, company_id: Optional[int], since: datetime, now: datetime):
+    """Per-user attendance for the day starting at `since`, for one company.
+
+    Reads the AttendanceDay rollup plus the still-open entries, so the cost
+    does not grow with punch history. Each row has the user's id and name,
+    closed + open seconds worked, whether an entry is still open, the first
+    clock-in and the last clock-out. Users without punches come back with
+    NULL aggregates.
+    """
+    TimeEntry = models.TimeEntry
+    Day = models.AttendanceDay
+    open_entries = select(
+        TimeEntry.user_id,
+        func.sum(seconds_between(TimeEntry.clock_in, literal(now, DateTime))).label("open_seconds"),
+    ).where(TimeEntry.clock_out.is_(None), TimeEntry.clock_in >= since).group_by(TimeEntry.user_id).subquery()
+
+    return db.execute(
+        select(
+            models.User.id,
+            models.User.full_name,
+            (func.coalesce(Day.total_seconds, 0.0) + func.coalesce(open_entries.c.open_seconds, 0.0)).label("total_seconds"),
+            case((Day.open_count > 0, 1), else_=0).label("is_open"),
+            Day.first_clock_in,
+            Day.last_clock_out,
+        )
+        .outerjoin(Day, and_(Day.user_id == models.User.id, Day.day == since.date()))
+        .outerjoin(open_entries, open_entries.c.user_id == models.User.id)
+        .where(models.User.company_id == company_id)
+        .order_by(models.User.id)
+    ).all()
+
 # Onboarding CRUD
 
 def create_onboarding_invite(db: Session, invite: schemas.OnboardingInviteCreate, token: str, invited_by_id: int):
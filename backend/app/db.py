@@ -1,10 +1,24 @@
 # db.py
 """SQLAlchemy engine and session utilities.
-Provides a FastAPI dependency `get_db` that yields a Session.
+Provides a FastAPI dependency `get_db` that yields a Session, and an asyncio
+counterpart (`async_engine`, `AsyncSessionLocal`, `get_async_db`) for code
+that runs on the event loop.
+
+On SQLite both engines get a production profile (`apply_sqlite_profile`):
+WAL journaling, so readers never wait for a writer; `synchronous=NORMAL`;
+memory-mapped I/O; a larger page cache; and a busy timeout instead of an
+immediate "database is locked". SQLite still takes one writer at a time, so
+sync write transactions also queue on a process-wide `WriterGate` rather than
+racing each other in SQLite's busy handler.
 """
 
 import os
-from sqlalchemy import create_engine
+import re
+import threading
+import time
+from typing import Optional
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from .config import settings
 
@@ -16,14 +30,146 @@ connect_args = {}
 if "sqlite" in SQLALCHEMY_DATABASE_URL:
     connect_args = {"check_same_thread": False}
 
+def pool_options(url: str) -> dict:
+    """Pool settings from `Settings`, for both engines.
+
+    In-memory SQLite keeps a single shared connection, so sizing does not
+    apply there.
+    """
+    options = {"pool_pre_ping": settings.DB_POOL_PRE_PING, "pool_recycle": settings.DB_POOL_RECYCLE}
+    if url.startswith("sqlite") and (":memory:" in url or url.rstrip("/").endswith(":")):
+        return options
+    options.update(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+    )
+    return options
+
+class WriterGate:
+    """One SQLite write transaction at a time in this process.
+
+    A connection takes the gate on its first write statement (INSERT,
+    UPDATE, DELETE, DDL) and gives it back when it is returned to the pool,
+    i.e. after its commit or rollback. Reads never touch it. A writer that
+    waits longer than `timeout` seconds goes ahead anyway and falls back on
+    SQLite's busy timeout.
+
+    The gate remembers the thread that took it, but it is not an RLock: a
+    Session may be closed on another thread than the one that wrote. If the
+    owning thread writes through a second connection while its first write
+    is still open, the second connection skips the gate rather than wait for
+    the thread itself; it goes to SQLite's lock as it would without a gate.
+
+    Only sync connections of engines passed to `apply_sqlite_profile` with
+    this gate queue on it. The async engine and other processes writing the
+    same file are not covered; against them SQLite's busy timeout still
+    applies.
+    """
+
+    def __init__(self, timeout: float = 5.0):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._owner: Optional[int] = None
+        self.stats = {"writes": 0, "waited": 0, "timeouts": 0, "reentered": 0, "max_wait_ms": 0.0}
+
+    def acquire(self) -> bool:
+        """Take the gate for this thread. False if not taken: timed out, or the thread already holds it."""
+        thread = threading.get_ident()
+        if self._owner == thread:
+            self.stats["reentered"] += 1
+            return False
+        if self._lock.acquire(blocking=False):
+            self._owner = thread
+            self.stats["writes"] += 1
+            return True
+        started = time.perf_counter()
+        acquired = self._lock.acquire(timeout=self.timeout)
+        if acquired:
+            self._owner = thread
+        waited_ms = (time.perf_counter() - started) * 1000
+        self.stats["waited"] += 1
+        self.stats["max_wait_ms"] = round(max(self.stats["max_wait_ms"], waited_ms), 3)
+        self.stats["writes" if acquired else "timeouts"] += 1
+        return acquired
+
+    def release(self):
+        self._owner = None
+        self._lock.release()
+
+    def metrics(self) -> dict:
+        return dict(self.stats)
+
+_WRITE_STATEMENT = re.compile(r"\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b", re.IGNORECASE)
+
+def sqlite_pragmas() -> list:
+    return [
+        "PRAGMA journal_mode=WAL",
+        f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}",
+        f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}",
+        f"PRAGMA cache_size={int(settings.SQLITE_CACHE_SIZE)}",
+        f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)}",
+    ]
+
+def apply_sqlite_profile(engine, gate: Optional[WriterGate] = None):
+    """Set the pragmas on every new connection of `engine` (sync or async)
+    and, with a `gate`, queue its write transactions on it."""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in sqlite_pragmas():
+            cursor.execute(pragma)
+        cursor.close()
+
+    if gate is None:
+        return
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _enter_writer(conn, cursor, statement, parameters, context, executemany):
+        if "sqlite_writer" not in conn.info and _WRITE_STATEMENT.match(statement):
+            conn.info["sqlite_writer"] = gate.acquire()
+
+    @event.listens_for(sync_engine.pool, "checkin")
+    def _leave_writer(dbapi_connection, connection_record):
+        # Checked in = the transaction is over (the pool resets it on return)
+        if connection_record.info.pop("sqlite_writer", False):
+            gate.release()
+
+IS_SQLITE = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+writer_gate = WriterGate(timeout=settings.SQLITE_BUSY_TIMEOUT / 1000)
+
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, 
     echo=False, 
     future=True, 
-    connect_args=connect_args
+    connect_args=connect_args,
+    **pool_options(SQLALCHEMY_DATABASE_URL),
 )
+if IS_SQLITE and settings.SQLITE_PROFILE:
+    apply_sqlite_profile(engine, writer_gate if settings.SQLITE_SINGLE_WRITER else None)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def to_async_url(url: str) -> str:
+    """Swap the sync driver in a database URL for its asyncio equivalent."""
+    scheme, sep, rest = url.partition("://")
+    dialect = scheme.split("+", 1)[0]
+    drivers = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+    return f"{drivers.get(dialect, scheme)}{sep}{rest}"
+
+# Sessions from here are short-lived: open one per unit of work so that idle
+# WebSockets never pin a pooled connection.
+async_engine = create_async_engine(
+    to_async_url(SQLALCHEMY_DATABASE_URL), echo=False, **pool_options(SQLALCHEMY_DATABASE_URL)
+)
+if IS_SQLITE and settings.SQLITE_PROFILE:
+    # No gate here: waiting on a thread lock would block the event loop. The
+    # async writers (chat write-behind) already batch into a single task and
+    # rely on busy_timeout.
+    apply_sqlite_profile(async_engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
 Base = declarative_base()
 
 def get_db():
@@ -33,3 +179,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    """Async variant of `get_db` for `async def` endpoints."""
+    async with AsyncSessionLocal() as db:
+        yield db
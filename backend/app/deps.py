@@ -2,27 +2,104 @@ from typing import Optional
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
-from .db import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
+from .db import SessionLocal, get_async_db, get_db
 from .config import settings
 from .models import User
+from .utils.principal_cache import Principal, PrincipalCache
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/login")
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
-    credentials_exception = HTTPException(
+principal_cache = PrincipalCache(max_entries=settings.PRINCIPAL_CACHE_SIZE, ttl=settings.PRINCIPAL_CACHE_TTL)
+principal_cache.watch()
+
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _decode(token: str) -> dict:
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
-    user = db.query(User).filter(User.id == int(user_id)).first()
+        raise _credentials_exception()
+    if payload.get("sub") is None:
+        raise _credentials_exception()
+    return payload
+
+def _check_active(principal: Principal) -> Principal:
+    if not principal.is_active:
+        raise HTTPException(status_code=403, detail="Inactive user")
+    return principal
+
+def _attach(db: Session, principal: Principal) -> User:
+    """The caller's `User` in `db`, built from a cached principal without SQL.
+
+    The principal's columns come from the cache; the rest are expired and
+    load in one SELECT the first time a route reads one of them.
+    """
+    user = User(id=principal.id, email=principal.email, role=principal.role, company_id=principal.company_id)
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+    cached = principal_cache.get(token)
+    if cached is not None:
+        # Known-good token: skip the JWT decode and the identity query
+        return _attach(db, _check_active(cached))
+    payload = _decode(token)
+    user = db.query(User).filter(User.id == int(payload["sub"])).first()
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
+    principal = Principal.from_user(user)
+    principal_cache.put(token, principal, payload.get("exp"))
+    _check_active(principal)
     return user
+
+def get_current_principal(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> Principal:
+    """Lightweight caller identity (id, role, company_id, ...).
+
+    Served from `principal_cache` when possible, in which case neither the
+    JWT nor the database is touched. Use it in routes that do not need the
+    ORM `User`; the session is only opened on a cache miss.
+    """
+    cached = principal_cache.get(token)
+    if cached is not None:
+        return _check_active(cached)
+    payload = _decode(token)
+    user = db.query(User).filter(User.id == int(payload["sub"])).first()
+    if user is None:
+        raise _credentials_exception()
+    principal = Principal.from_user(user)
+    principal_cache.put(token, principal, payload.get("exp"))
+    return _check_active(principal)
+
+def get_admin_principal(principal: Principal = Depends(get_current_principal)) -> Principal:
+    """`get_current_principal`, restricted to admins. For operational endpoints."""
+    if principal.role != "admin" and not principal.is_superuser:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    return principal
+
+def get_current_principal_detached(token: str = Depends(oauth2_scheme)) -> Principal:
+    """`get_current_principal` on a session of its own, closed before the
+    route runs. For long-lived responses (streams), which would otherwise
+    keep the request's session, and its pooled connection, until they end."""
+    with SessionLocal() as db:
+        return get_current_principal(token, db)
+
+async def get_current_principal_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)) -> Principal:
+    """`get_current_principal` for `async def` routes: a cache miss is read
+    through the async engine instead of a threadpool session."""
+    cached = principal_cache.get(token)
+    if cached is not None:
+        return _check_active(cached)
+    payload = _decode(token)
+    user = await db.get(User, int(payload["sub"]))
+    if user is None:
+        raise _credentials_exception()
+    principal = Principal.from_user(user)
+    principal_cache.put(token, principal, payload.get("exp"))
+    return _check_active(principal)
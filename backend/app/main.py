@@ -3,10 +3,19 @@
 Includes mounting of API routers, health check, and a simple WebSocket.
 """
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import logging
+
+from fastapi import Depends, FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from . import deps
 from .config import settings
 from .api.v1 import auth, users, chat, projects, tasks, kra
+from .utils.email_outbox import email_outbox
+from .utils.notifications import notifications
+from .utils.passwords import HasherBusy
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Workspace Platform Backend", version="0.1.0")
 
@@ -24,6 +33,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(HasherBusy)
+async def password_hashing_busy(request: Request, exc: HasherBusy):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Too many sign-in attempts right now. Please retry shortly."},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 # Include routers
 app.include_router(auth.router, prefix="/api/v1/auth", tags=["auth"])
 app.include_router(users.router, prefix="/api/v1/users", tags=["users"])
@@ -43,13 +60,68 @@ app.include_router(assets.router, prefix="/api/v1/assets", tags=["assets"])
 app.include_router(training.router, prefix="/api/v1/training", tags=["training"])
 app.include_router(exit_requests.router, prefix="/api/v1/exit-requests", tags=["exit-requests"])
 
-from .db import engine
-from . import models
+# The schema is managed by Alembic (`alembic upgrade head`); startup runs no DDL
+
+@app.on_event("startup")
+def load_open_sessions():
+    if settings.OPEN_SESSION_REGISTRY and settings.WEB_CONCURRENCY > 1:
+        # Punches on the other workers would never reach this worker's registry
+        logger.warning("OPEN_SESSION_REGISTRY ignored: it needs a single worker (WEB_CONCURRENCY=%d)", settings.WEB_CONCURRENCY)
+    elif settings.OPEN_SESSION_REGISTRY:
+        from .db import SessionLocal
+        from .utils.open_sessions import open_sessions
+        with SessionLocal() as db:
+            open_sessions.load(db)
+
+@app.on_event("startup")
+async def start_open_entry_sweeper():
+    time_tracking.open_entry_sweeper.start()
+
+@app.on_event("shutdown")
+async def stop_open_entry_sweeper():
+    await time_tracking.open_entry_sweeper.close()
+
+@app.on_event("startup")
+async def start_attendance_hub():
+    await time_tracking.attendance_hub.start()
 
-# Ensure tables exist (simplest migration strategy for MVP)
-models.Base.metadata.create_all(bind=engine)
+@app.on_event("shutdown")
+async def stop_attendance_hub():
+    await time_tracking.attendance_hub.close()
+
+@app.on_event("startup")
+async def start_otp_purge():
+    auth.otp_store.start(settings.OTP_PURGE_INTERVAL)
+
+@app.on_event("shutdown")
+async def stop_otp_purge():
+    await auth.otp_store.close()
+
+@app.on_event("startup")
+async def start_email_outbox():
+    email_outbox.start()
+    notifications.start()
+
+@app.on_event("shutdown")
+async def stop_email_outbox():
+    await notifications.close()
+    await email_outbox.close()
+
+@app.on_event("shutdown")
+def stop_password_hasher():
+    auth.password_hasher.shutdown()
+
+@app.on_event("shutdown")
+async def shutdown_chat():
+    await chat.message_writer.close()
+    await chat.manager.shutdown()
 
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
 
+@app.get("/health/email")
+def email_outbox_health(admin: deps.Principal = Depends(deps.get_admin_principal)):
+    """Outbox queue depth, delivery latency, SMTP pool and coalescing counters."""
+    return {**email_outbox.metrics(), "notifications": notifications.metrics()}
+
@@ -0,0 +1,50 @@
+"""Maintenance commands.
+
+Usage (from backend/):
+    python -m app.manage backfill-attendance
+    python -m app.manage close-stale-entries [--max-hours H]
+"""
+
+import argparse
+
+from . import crud
+from .config import settings
+from .db import SessionLocal
+from .utils.entry_sweeper import OpenEntrySweeper
+
+
+def backfill_attendance(args):
+    with SessionLocal() as db:
+        rows = crud.backfill_attendance_days(db)
+    print(f"Rebuilt {rows} attendance day rows from time entries.")
+
+
+def close_stale_entries(args):
+    sweeper = OpenEntrySweeper(max_hours=args.max_hours, batch_size=settings.OPEN_ENTRY_SWEEP_BATCH_SIZE)
+    closed = sweeper.sweep()
+    print(f"Auto-closed {closed} entries open longer than {args.max_hours:g} hours "
+          f"in {sweeper.stats['last_pass_ms']:.0f} ms.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.manage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser(
+        "backfill-attendance",
+        help="Rebuild the attendance_days rollup from all existing time entries",
+    ).set_defaults(func=backfill_attendance)
+
+    stale = commands.add_parser(
+        "close-stale-entries",
+        help="Run one pass of the open time-entry sweeper now",
+    )
+    stale.add_argument("--max-hours", type=float, default=settings.OPEN_ENTRY_MAX_HOURS)
+    stale.set_defaults(func=close_stale_entries)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
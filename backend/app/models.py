@@ -1,5 +1,5 @@
 
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Float, Text, Table
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Date, DateTime, Float, Text, Table, Index, UniqueConstraint, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .db import Base
@@ -18,8 +18,20 @@ class Company(Base):
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
     allowed_radius = Column(Float, default=100.0)
+    sites_version = Column(Integer, default=0)  # Bumped on any geofence change
     users = relationship("User", back_populates="company")
     projects = relationship("Project", back_populates="company")
+    sites = relationship("CompanySite", back_populates="company")
+
+class CompanySite(Base):
+    __tablename__ = "company_sites"
+    id = Column(Integer, primary_key=True, index=True)
+    company_id = Column(Integer, ForeignKey("companies.id"), nullable=False, index=True)
+    name = Column(String, nullable=False)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    radius = Column(Float, default=100.0)
+    company = relationship("Company", back_populates="sites")
 
 class User(Base):
     __tablename__ = "users"
@@ -29,7 +41,7 @@ class User(Base):
     full_name = Column(String, nullable=True)
     is_active = Column(Boolean, default=True)
     is_superuser = Column(Boolean, default=False)
-    company_id = Column(Integer, ForeignKey("companies.id"))
+    company_id = Column(Integer, ForeignKey("companies.id"), index=True)
     company = relationship("Company", back_populates="users")
     tasks = relationship("Task", foreign_keys="Task.assignee_id", back_populates="assignee")
     created_tasks = relationship("Task", foreign_keys="Task.creator_id", back_populates="creator")
@@ -58,6 +70,12 @@ class FriendRequest(Base):
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_requests")
     receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_requests")
 
+    __table_args__ = (
+        # Pending/accepted requests per user, from either side
+        Index("ix_friend_requests_receiver_status", "receiver_id", "status"),
+        Index("ix_friend_requests_sender_status", "sender_id", "status"),
+    )
+
 class TimeEntry(Base):
     __tablename__ = "time_entries"
     id = Column(Integer, primary_key=True, index=True)
@@ -66,8 +84,57 @@ class TimeEntry(Base):
     clock_out = Column(DateTime, nullable=True)
     latitude = Column(Float, nullable=True)
     longitude = Column(Float, nullable=True)
+    auto_closed = Column(Boolean, nullable=False, default=False) # Closed by the stale-entry sweeper; needs review
     user = relationship("User", back_populates="time_entries")
 
+    __table_args__ = (
+        Index("ix_time_entries_clock_in", "clock_in"),
+        # A user's history, newest first
+        Index("ix_time_entries_user_clock_in", "user_id", "clock_in"),
+        # Partial index: only open entries, so clock_out's lookup stays tiny
+        # however much history a user has.
+        Index(
+            "ix_time_entries_open_user",
+            "user_id",
+            "clock_in",
+            postgresql_where=text("clock_out IS NULL"),
+            sqlite_where=text("clock_out IS NULL"),
+        ),
+    )
+
+class AttendanceDay(Base):
+    """Per-user, per-day rollup of time entries, keyed by the clock-in date.
+
+    Maintained by crud.create_time_entry in the same transaction as the
+    entry itself; `total_seconds` only counts closed entries.
+    """
+    __tablename__ = "attendance_days"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    total_seconds = Column(Float, nullable=False, default=0.0)
+    first_clock_in = Column(DateTime, nullable=True)
+    last_clock_out = Column(DateTime, nullable=True)
+    open_since = Column(DateTime, nullable=True)
+    open_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "day", name="uq_attendance_days_user_day"),
+    )
+
+class PunchReceipt(Base):
+    """Idempotency record for a punch submitted through the batch endpoint.
+
+    `client_id` is generated by the device; replaying a batch maps each
+    already-seen punch back to the entry it produced.
+    """
+    __tablename__ = "punch_receipts"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    client_id = Column(String(64), primary_key=True)
+    entry_id = Column(Integer, ForeignKey("time_entries.id"), nullable=True)
+    action = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class Ticket(Base):
     __tablename__ = "tickets"
     id = Column(Integer, primary_key=True, index=True)
@@ -102,7 +169,7 @@ class Project(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
     description = Column(Text, nullable=True)
-    company_id = Column(Integer, ForeignKey("companies.id"))
+    company_id = Column(Integer, ForeignKey("companies.id"), index=True)
     company = relationship("Company", back_populates="projects")
     tasks = relationship("Task", back_populates="project")
     members = relationship("User", secondary="project_members", back_populates="projects_included")
@@ -113,9 +180,9 @@ class Task(Base):
     title = Column(String, nullable=False)
     description = Column(Text, nullable=True)
     completed = Column(Boolean, default=False)
-    project_id = Column(Integer, ForeignKey("projects.id"))
-    assignee_id = Column(Integer, ForeignKey("users.id"))
-    creator_id = Column(Integer, ForeignKey("users.id"))
+    project_id = Column(Integer, ForeignKey("projects.id"), index=True)
+    assignee_id = Column(Integer, ForeignKey("users.id"), index=True)
+    creator_id = Column(Integer, ForeignKey("users.id"), index=True)
     project = relationship("Project", back_populates="tasks")
     assignee = relationship("User", foreign_keys=[assignee_id], back_populates="tasks")
     creator = relationship("User", foreign_keys=[creator_id])
@@ -137,6 +204,10 @@ class KRAProgress(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
     kra = relationship("KRA", back_populates="progresses")
 
+    __table_args__ = (
+        Index("ix_kra_progresses_kra_timestamp", "kra_id", "timestamp"),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, index=True)
@@ -146,14 +217,60 @@ class Message(Base):
     room = Column(String, default="general")
     sender = relationship("User")
 
+    __table_args__ = (
+        # Serves newest-first history pages and keyset cursors per room
+        Index("ix_messages_room_timestamp", "room", "timestamp", "id"),
+    )
+
+class MessageTerm(Base):
+    """Inverted index of chat messages, used where SQLite FTS5 is unavailable."""
+    __tablename__ = "message_terms"
+    term = Column(String(64), primary_key=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), primary_key=True)
+    room = Column(String, nullable=False)
+    sender_id = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index("ix_message_terms_term_room", "term", "room", "message_id"),
+    )
+
 class VerificationCode(Base):
     __tablename__ = "verification_codes"
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, index=True)
     code = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=True)
     is_used = Column(Boolean, default=False)
 
+    __table_args__ = (
+        # Live-code lookup in SQLOTPStore, and the purge of used/expired rows
+        Index("ix_verification_codes_email_active", "email", "is_used", "expires_at"),
+    )
+
+class OutboxEmail(Base):
+    """A mail waiting for, or already handled by, the outbox sender."""
+    __tablename__ = "email_outbox"
+    id = Column(Integer, primary_key=True, index=True)
+    to_email = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    kind = Column(String, nullable=True)
+    status = Column(String, default="pending", nullable=False)  # pending, sending, sent, failed; held, digested
+    priority = Column(Integer, default=5, nullable=False)  # lower is sent first
+    dedupe_key = Column(String, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    claim_token = Column(String, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_email_outbox_due", "status", "priority", "next_attempt_at"),
+        Index("ix_email_outbox_dedupe", "dedupe_key", "created_at"),
+    )
+
 # HR Features
 class Asset(Base):
     __tablename__ = "assets"
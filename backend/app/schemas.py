@@ -3,7 +3,7 @@
 Only essential fields are included for brevity.
 """
 
-from datetime import datetime
+from datetime import date, datetime
 from typing import List, Optional
 from pydantic import BaseModel, EmailStr, Field
 
@@ -78,11 +78,37 @@ class TimeEntryCreate(BaseModel):
     latitude: Optional[float] = None
     longitude: Optional[float] = None
 
+class PunchSubmit(BaseModel):
+    client_id: str = Field(..., min_length=1, max_length=64) # Device-generated idempotency key
+    user_id: int
+    action: str # clock_in or clock_out
+    timestamp: datetime
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+class PunchBatch(BaseModel):
+    punches: List[PunchSubmit]
+
+class PunchResult(BaseModel):
+    client_id: str
+    user_id: int
+    status: str # "accepted", "duplicate", "rejected" or "expired" (older than OFFLINE_PUNCH_MAX_AGE_HOURS)
+    entry_id: Optional[int] = None
+    detail: Optional[str] = None
+
+class PunchBatchReport(BaseModel):
+    accepted: int
+    duplicates: int
+    rejected: int
+    expired: int = 0
+    results: List[PunchResult]
+
 class TimeEntryRead(BaseModel):
     id: int
     clock_in: datetime
     clock_out: Optional[datetime]
     user_id: int
+    auto_closed: bool = False
     class Config:
         orm_mode = True
 
@@ -116,6 +142,19 @@ class CompanyRead(CompanyBase):
     class Config:
         orm_mode = True
 
+class CompanySiteCreate(BaseModel):
+    name: str
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+    radius: float = Field(100.0, gt=0)
+
+class CompanySiteRead(CompanySiteCreate):
+    id: int
+    company_id: int
+
+    class Config:
+        orm_mode = True
+
 class ProjectBase(BaseModel):
     name: str
     description: Optional[str] = None
@@ -252,6 +291,21 @@ class AttendanceDashboard(BaseModel):
     online_count: int
     offline_count: int
 
+class TimesheetPeriod(BaseModel):
+    user_id: int
+    full_name: Optional[str]
+    period_start: date
+    hours: float
+    overtime_hours: float
+    late_days: int
+    days_worked: int
+
+class TimesheetAnalytics(BaseModel):
+    period: str # "week" or "month"
+    start: date
+    end: date
+    rows: List[TimesheetPeriod]
+
 class OTPRequest(BaseModel):
     email: EmailStr
 
@@ -0,0 +1,162 @@
+"""Per-company fan-out of live attendance changes.
+
+HR dashboards subscribe once and receive a snapshot followed by deltas, so
+each clock event costs O(subscribers) queue puts instead of every open
+dashboard re-running the attendance query on a poll.
+
+`/clock` runs in FastAPI's thread pool, so `publish_punch` hands events to
+subscriber queues with `call_soon_threadsafe`. With a broadcast `backend`
+(`CHAT_BROADCAST_URL` pointing at Redis) each punch is published on an
+`attendance:<company>` channel instead, and every worker holding
+dashboards of that company applies it, so it does not matter which worker
+handled the punch. Without one (`memory://`) punches stay in the worker
+that handled them, which is right for a single worker.
+
+A new subscriber reads its snapshot after `subscribe` and hands the result
+to `seed`. Punches published in between are buffered and replayed on top of
+the snapshot, so none is lost; replaying one the snapshot already reflects
+changes nothing.
+"""
+
+import asyncio
+import json
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from ..config import settings
+from .broadcast import BroadcastBackend, create_broadcast_backend
+
+
+class AttendanceHub:
+    def __init__(self, queue_size: int = 100, backend: Optional[BroadcastBackend] = None):
+        self.queue_size = queue_size
+        self.backend = backend
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Dict[int, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._online: Dict[int, Set[int]] = {}
+        self._unseeded: Dict[int, List[Tuple[int, bool]]] = {}  # Punches awaiting a snapshot
+        self._lock = threading.Lock()
+
+    async def start(self):
+        """Receive the company channels this worker follows. Needed before
+        `publish_punch` can reach the backend; `subscribe` calls it too."""
+        if self.backend is not None and self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            await self.backend.start(self._deliver)
+
+    async def close(self):
+        if self.backend is not None and self._loop is not None:
+            await self.backend.close()
+            self._loop = None
+
+    async def subscribe(self, company_id: int) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(company_id, set()).add((asyncio.get_running_loop(), queue))
+        if self.backend is not None:
+            # Listening before the caller reads its snapshot: nothing published
+            # from here on is missed
+            await self.start()
+            await self.backend.subscribe(str(company_id))
+        return queue
+
+    def seed(self, company_id: int, online_user_ids: Iterable[int]):
+        """Install the online set from a snapshot unless one is already tracked,
+        then replay the punches published since the subscription."""
+        with self._lock:
+            if company_id not in self._subscribers or company_id in self._online:
+                return
+            self._online[company_id] = set(online_user_ids)
+            # Replayed under the lock, so a newer punch cannot overtake them
+            events = [self._apply(company_id, user_id, online) for user_id, online in self._unseeded.pop(company_id, [])]
+            subscribers = list(self._subscribers[company_id])
+        for event in events:
+            if event is not None:
+                self._dispatch(subscribers, event)
+
+    def unsubscribe(self, company_id: int, queue: asyncio.Queue):
+        with self._lock:
+            subscribers = self._subscribers.get(company_id, set())
+            subscribers.difference_update({s for s in subscribers if s[1] is queue})
+            if not subscribers:
+                self._subscribers.pop(company_id, None)
+                self._online.pop(company_id, None)
+                self._unseeded.pop(company_id, None)
+                released = True
+            else:
+                released = False
+        if released and self.backend is not None and self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._release(company_id), self._loop)
+
+    def publish_punch(self, company_id: Optional[int], user_id: int, online: bool):
+        """Record a user's new status and push a delta if it changed. Safe from
+        any thread; with a backend the punch reaches every worker's dashboards."""
+        if self.backend is None:
+            self._receive(company_id, user_id, online)
+        elif company_id is not None and self._loop is not None:
+            message = json.dumps({"user_id": user_id, "online": online})
+            asyncio.run_coroutine_threadsafe(self.backend.publish(str(company_id), message), self._loop)
+
+    async def _deliver(self, channel: str, message: str):
+        punch = json.loads(message)
+        self._receive(int(channel), punch["user_id"], punch["online"])
+
+    async def _release(self, company_id: int):
+        # A dashboard may have subscribed again while this was pending
+        if company_id not in self._subscribers:
+            await self.backend.unsubscribe(str(company_id))
+
+    def _receive(self, company_id: Optional[int], user_id: int, online: bool):
+        with self._lock:
+            subscribers = list(self._subscribers.get(company_id, ()))
+            if not subscribers:
+                return
+            if company_id not in self._online:
+                self._unseeded.setdefault(company_id, []).append((user_id, online))
+                return
+            event = self._apply(company_id, user_id, online)
+        if event is not None:
+            self._dispatch(subscribers, event)
+
+    def _apply(self, company_id: int, user_id: int, online: bool) -> Optional[dict]:
+        """Update the online set (lock held); the delta to push, if any."""
+        online_users = self._online[company_id]
+        if (user_id in online_users) == online:
+            return None
+        if online:
+            online_users.add(user_id)
+        else:
+            online_users.discard(user_id)
+        return {
+            "type": "status",
+            "user_id": user_id,
+            "status": "online" if online else "offline",
+            "online_count": len(online_users),
+        }
+
+    def _dispatch(self, subscribers, event: dict):
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._offer, queue, event)
+            except RuntimeError:
+                pass # Subscriber's loop already closed
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, event: dict):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Too far behind to catch up on deltas; the stream ends and the
+            # client reconnects for a fresh snapshot.
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+
+def create_attendance_hub(url: str) -> AttendanceHub:
+    if url.startswith("memory://"):
+        return AttendanceHub()
+    return AttendanceHub(backend=create_broadcast_backend(url, prefix="attendance:"))
+
+
+attendance_hub = create_attendance_hub(settings.CHAT_BROADCAST_URL)
@@ -0,0 +1,190 @@
+"""Write-behind persistence for chat messages.
+
+The WebSocket handler hands each inbound message to ``MessageWriter.enqueue``
+and broadcasts immediately. A background task group-commits the buffer as a
+single multi-row INSERT, on a short-lived async session, once ``batch_size``
+messages are pending or ``flush_interval`` seconds have passed, whichever
+comes first.
+
+Loss is bounded: at most ``max_pending`` messages are ever held in memory
+(``enqueue`` waits for a flush once the buffer is full), a failed flush keeps
+its rows for the next attempt, and ``close`` drains the buffer on shutdown.
+A hard crash can therefore lose at most ``max_pending`` messages, and in
+steady state no more than ``flush_interval`` seconds' worth.
+
+When a batch fails its rows are retried one at a time, so one bad row (say
+an unknown ``sender_id`` on a database that enforces foreign keys) cannot
+hold back the rest. A row that still fails ``max_attempts`` flushes in a row
+is logged and moved to ``dead_letters``. Connection errors count against no
+row: the whole buffer waits for the database to come back.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, List
+
+from sqlalchemy import exc
+
+from .. import crud, schemas
+from ..db import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+Listener = Callable[[List[schemas.MessageRead]], None]
+
+# The database is unreachable or busy, rather than refusing a row
+TRANSIENT_ERRORS = (exc.OperationalError, exc.InterfaceError)
+
+
+class MessageWriter:
+    def __init__(
+        self,
+        batch_size: int = 200,
+        flush_interval: float = 0.25,
+        max_pending: int = 5000,
+        max_attempts: int = 3,
+        max_dead_letters: int = 1000,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.listeners: List[Listener] = []
+        self.dead_letters: Deque[dict] = deque(maxlen=max_dead_letters)
+        self._pending: List[dict] = []
+        self._wakeup: asyncio.Event | None = None
+        self._lock: asyncio.Lock | None = None
+        self._task: asyncio.Task | None = None
+        self._closing = False
+        self.stats = {
+            "messages_written": 0,
+            "batches": 0,
+            "failed_flushes": 0,
+            "row_retries": 0,
+            "dead_lettered": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    def start(self):
+        task = self._task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._closing = False
+            self._wakeup = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, content: str, room: str, sender_id: int):
+        self.start()
+        while len(self._pending) >= self.max_pending:
+            # Backpressure: hold this sender until the buffer has room again.
+            if not await self.flush():
+                await asyncio.sleep(self.flush_interval)
+        self._pending.append({
+            "content": content,
+            "room": room,
+            "sender_id": sender_id,
+            "timestamp": datetime.utcnow(),
+            "attempts": 0,
+        })
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> bool:
+        """Write everything currently buffered. Returns False if any row is left over."""
+        async with self._lock:
+            if not self._pending:
+                return True
+            rows, self._pending = self._pending, []
+            started = time.perf_counter()
+            try:
+                persisted = await self._write(rows)
+            except Exception as e:
+                logger.exception("Chat write-behind flush failed (%d messages)", len(rows))
+                self.stats["failed_flushes"] += 1
+                if isinstance(e, TRANSIENT_ERRORS):
+                    self._pending = rows + self._pending
+                    return False
+                persisted, retry = await self._write_one_by_one(rows)
+                self._pending = retry + self._pending
+            else:
+                retry = []
+            if persisted:
+                self._record(len(persisted), (time.perf_counter() - started) * 1000)
+        for listener in self.listeners:
+            listener(persisted)
+        return not retry
+
+    async def _write_one_by_one(self, rows: List[dict]):
+        """Isolate the rows that broke a batch. Returns (persisted, rows to retry)."""
+        persisted, retry = [], []
+        for i, row in enumerate(rows):
+            self.stats["row_retries"] += 1
+            try:
+                persisted.extend(await self._write([row]))
+            except TRANSIENT_ERRORS:
+                # Not this row's fault: keep it and the rest for the next flush
+                return persisted, retry + rows[i:]
+            except Exception as e:
+                row["attempts"] += 1
+                if row["attempts"] < self.max_attempts:
+                    retry.append(row)
+                    continue
+                logger.exception("Chat write-behind dropped a message to room %r after %d attempts", row["room"], row["attempts"])
+                self.dead_letters.append({**row, "error": str(e)})
+                self.stats["dead_lettered"] += 1
+        return persisted, retry
+
+    async def close(self):
+        """Stop the timer and drain the buffer."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        if not await self.flush():
+            logger.error("Chat write-behind: %d messages lost on shutdown", len(self._pending))
+
+    def metrics(self) -> dict:
+        batches = self.stats["batches"]
+        return {
+            **self.stats,
+            "pending": len(self._pending),
+            "avg_batch_size": round(self.stats["messages_written"] / batches, 2) if batches else 0.0,
+            "avg_flush_ms": round(self.stats["total_flush_ms"] / batches, 3) if batches else 0.0,
+        }
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    @staticmethod
+    async def _write(rows: List[dict]) -> List[schemas.MessageRead]:
+        # One short-lived async session per batch; run_sync reuses the crud
+        # helper while the driver I/O stays on the event loop.
+        rows = [{k: v for k, v in row.items() if k != "attempts"} for row in rows]
+        async with AsyncSessionLocal() as db:
+            messages = await db.run_sync(crud.create_messages, rows)
+            return [schemas.MessageRead.from_orm(m) for m in messages]
+
+    def _record(self, size: int, elapsed_ms: float):
+        stats = self.stats
+        stats["messages_written"] += size
+        stats["batches"] += 1
+        stats["last_batch_size"] = size
+        stats["max_batch_size"] = max(stats["max_batch_size"], size)
+        stats["last_flush_ms"] = round(elapsed_ms, 3)
+        stats["max_flush_ms"] = round(max(stats["max_flush_ms"], elapsed_ms), 3)
+        stats["total_flush_ms"] += elapsed_ms
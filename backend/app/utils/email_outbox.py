@@ -0,0 +1,464 @@
+"""Durable outgoing mail: an `email_outbox` table and a background sender.
+
+Requests only insert a row (`EmailOutbox.enqueue`, committed with the
+rest of the request's transaction) and return. The mail survives a crash
+or restart, and the request never waits on SMTP.
+
+The sender claims due rows in batches. A claim is one UPDATE that stamps
+the rows with a token and pushes `next_attempt_at` out by `lease`, so
+several workers can share the table, and rows claimed by a worker that died
+become due again once the lease runs out. It then delivers the batch over
+`SMTPConnectionPool`: a few connections that stay open and authenticated
+between batches, each sending many messages in turn, with no new
+connection, STARTTLS or login per mail. Due rows are claimed lowest
+`priority` first, so OTP codes never wait behind a backlog of alerts or
+digests. Outcomes are written back with one
+executemany UPDATE:
+
+- accepted: `sent`;
+- temporary failure (4xx, dropped connection, timeout): back to `pending`,
+  retried after `retry_base` * 2^(attempts-1) seconds (capped at
+  `retry_max`);
+- permanent failure (5xx), or `max_attempts` used up: `failed`, with the
+  last error kept.
+
+Without an SMTP pool (no credentials configured) mails are only printed
+(`utils.email.log_email`).
+"""
+
+import asyncio
+import logging
+import smtplib
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from typing import List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import bindparam, event, func, select, update
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+from ..db import SessionLocal
+from .email import build_message, log_email
+
+logger = logging.getLogger(__name__)
+
+# Claim order: OTP mail jumps every queue of alerts and digests
+PRIORITY_OTP = 0
+PRIORITY_NORMAL = 5
+PRIORITY_DIGEST = 9
+
+
+class _Connection:
+    __slots__ = ("smtp", "sent", "last_used")
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPConnectionPool:
+    """Up to `size` authenticated SMTP connections, reused across messages.
+
+    A connection is retired after `max_messages` mails (providers cap mails
+    per session) and checked with NOOP before reuse if it sat idle longer
+    than `max_idle` seconds.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str = "",
+        password: str = "",
+        size: int = 2,
+        use_ssl: Optional[bool] = None,
+        starttls: bool = True,
+        timeout: float = 30.0,
+        max_messages: int = 100,
+        max_idle: float = 60.0,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.use_ssl = port == 465 if use_ssl is None else use_ssl
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self._idle: List[_Connection] = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.stats = {"opened": 0, "reused": 0, "discarded": 0}
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; it is dropped if the block raises."""
+        self._slots.acquire()
+        try:
+            conn = self._checkout()
+            try:
+                yield conn
+            except BaseException:
+                # State unknown (dropped link, half-sent DATA): never reuse it
+                self._discard(conn)
+                raise
+            conn.last_used = time.monotonic()
+            if conn.sent >= self.max_messages:
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def _checkout(self) -> _Connection:
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                return self._open()
+            if time.monotonic() - conn.last_used <= self.max_idle or self._alive(conn):
+                self.stats["reused"] += 1
+                return conn
+            self._discard(conn)
+
+    def _open(self) -> _Connection:
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        self.stats["opened"] += 1
+        return _Connection(smtp)
+
+    def _alive(self, conn: _Connection) -> bool:
+        try:
+            return conn.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _discard(self, conn: _Connection):
+        self.stats["discarded"] += 1
+        try:
+            conn.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.smtp.close()
+
+
+class EmailOutbox:
+    def __init__(
+        self,
+        pool: Optional[SMTPConnectionPool],
+        batch_size: int = 50,
+        poll_interval: float = 5.0,
+        max_attempts: int = 5,
+        retry_base: float = 30.0,
+        retry_max: float = 3600.0,
+        lease: float = 300.0,
+        from_email: str = "",
+        session_factory=SessionLocal,
+    ):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lease = lease
+        self.from_email = from_email
+        self._session = session_factory
+        self._executor = ThreadPoolExecutor(max_workers=pool.size if pool else 1, thread_name_prefix="smtp")
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lock = threading.Lock()
+        self.stats = {
+            "enqueued": 0,
+            "sent": 0,
+            "retried": 0,
+            "failed": 0,
+            "batches": 0,
+            "failed_passes": 0,
+            "send_attempts": 0,
+            "total_send_ms": 0.0,
+            "max_send_ms": 0.0,
+            "last_queue_latency_ms": 0.0,
+            "max_queue_latency_ms": 0.0,
+        }
+
+    def enqueue(
+        self,
+        db: Session,
+        to_email: str,
+        subject: str,
+        body: str,
+        kind: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL,
+        dedupe_key: Optional[str] = None,
+        held: bool = False,
+    ) -> models.OutboxEmail:
+        """Add a mail to `db`, to be delivered once the caller commits.
+
+        The mail is part of the caller's transaction: a rollback drops it, and
+        the sender is woken only after the commit. Lower `priority` values are
+        sent first. `held` mails are not sent themselves;
+        `utils.notifications` folds them into digests.
+        """
+        mail = models.OutboxEmail(
+            to_email=to_email, subject=subject, body=body, kind=kind, priority=priority, dedupe_key=dedupe_key,
+            status="held" if held else "pending", next_attempt_at=datetime.utcnow(),
+        )
+        db.add(mail)
+        db.flush()
+        if not held:
+            key = ("email_outbox", id(self))
+            if key not in db.info:
+                event.listen(db, "after_commit", partial(self._committed, key))
+                event.listen(db, "after_rollback", partial(self._rolled_back, key))
+                db.info[key] = 0
+            db.info[key] += 1
+        return mail
+
+    def _committed(self, key, db: Session):
+        queued, db.info[key] = db.info[key], 0
+        if queued:
+            self.stats["enqueued"] += queued
+            self.notify()
+
+    def _rolled_back(self, key, db: Session):
+        db.info[key] = 0
+
+    def notify(self):
+        """Wake the sender now rather than at its next poll. Safe from any thread."""
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def start(self):
+        if self.poll_interval > 0 and (self._task is None or self._task.done()):
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._loop = self._wakeup = None
+        if self.pool:
+            self.pool.close()
+
+    def drain(self, now: Optional[datetime] = None) -> int:
+        """Deliver due mails batch by batch until none are due. Returns how many were sent."""
+        sent = 0
+        while True:
+            batch = self._claim(now or datetime.utcnow())
+            if not batch:
+                return sent
+            sent += self._deliver(batch)
+            if len(batch) < self.batch_size:
+                return sent
+
+    def metrics(self) -> dict:
+        Outbox = models.OutboxEmail
+        with self._session() as db:
+            depth = dict(db.execute(
+                select(Outbox.status, func.count()).where(Outbox.status.in_(("pending", "sending", "held"))).group_by(Outbox.status)
+            ).all())
+            oldest = db.scalar(select(func.min(Outbox.created_at)).where(Outbox.status.in_(("pending", "sending"))))
+        attempts = self.stats["send_attempts"]
+        return {
+            **self.stats,
+            "pending": depth.get("pending", 0),
+            "sending": depth.get("sending", 0),
+            "held": depth.get("held", 0),
+            "oldest_pending_s": round((datetime.utcnow() - oldest).total_seconds(), 3) if oldest else None,
+            "avg_send_ms": round(self.stats["total_send_ms"] / attempts, 3) if attempts else 0.0,
+            "pool": dict(self.pool.stats, size=self.pool.size) if self.pool else None,
+            "running": self._task is not None and not self._task.done(),
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await run_in_threadpool(self.drain)
+            except Exception:
+                logger.exception("Email outbox pass failed")
+                self.stats["failed_passes"] += 1
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _claim(self, now: datetime) -> List[Tuple]:
+        Outbox = models.OutboxEmail
+        token = uuid.uuid4().hex
+        due = (Outbox.status.in_(("pending", "sending")), Outbox.next_attempt_at <= now)
+        with self._session() as db:
+            ids = (
+                select(Outbox.id).where(*due)
+                .order_by(Outbox.priority, Outbox.next_attempt_at, Outbox.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            db.execute(
+                update(Outbox)
+                .where(Outbox.id.in_(ids), *due)
+                .values(
+                    status="sending", claim_token=token, attempts=Outbox.attempts + 1,
+                    next_attempt_at=now + timedelta(seconds=self.lease),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            batch = db.execute(
+                select(Outbox.id, Outbox.to_email, Outbox.subject, Outbox.body, Outbox.attempts, Outbox.created_at)
+                .where(Outbox.claim_token == token)
+                .order_by(Outbox.id)
+            ).all()
+            db.commit()
+        return [tuple(row) + (token,) for row in batch]
+
+    def _deliver(self, batch: List[Tuple]) -> int:
+        workers = self.pool.size if self.pool else 1
+        chunks = [batch[i::workers] for i in range(workers) if batch[i::workers]]
+        outcomes = []
+        for chunk_outcomes in self._executor.map(self._send_chunk, chunks):
+            outcomes.extend(chunk_outcomes)
+        self._record(batch, outcomes)
+        return sum(1 for _, error, _ in outcomes if error is None)
+
+    def _send_chunk(self, chunk: List[Tuple]) -> List[Tuple[int, Optional[str], bool]]:
+        """Send a chunk over one connection: [(id, error or None, permanent)].
+
+        Never raises: every row gets an outcome, so `_record` always runs and
+        a failing mail uses up its attempts instead of sitting in `sending`
+        until the lease expires and being claimed again.
+        """
+        outcomes = []
+        if self.pool is None:
+            for mail_id, to_email, subject, body, *_ in chunk:
+                try:
+                    log_email(to_email, subject, body)
+                    outcomes.append((mail_id, None, False))
+                except Exception as e:
+                    outcomes.append((mail_id, f"{type(e).__name__}: {e}", False))
+            return outcomes
+        try:
+            with self.pool.connection() as conn:
+                for row in chunk:
+                    mail_id, to_email, subject, body = row[:4]
+                    started = time.perf_counter()
+                    try:
+                        message = build_message(to_email, subject, body, self.from_email)
+                        conn.smtp.sendmail(self.from_email, [to_email], message.as_string())
+                        conn.sent += 1
+                        outcomes.append((mail_id, None, False))
+                    except smtplib.SMTPRecipientsRefused as e:
+                        codes = [code for code, _ in e.recipients.values()]
+                        outcomes.append((mail_id, str(e.recipients), all(code >= 500 for code in codes)))
+                    except smtplib.SMTPResponseException as e:
+                        outcomes.append((mail_id, f"{e.smtp_code} {e.smtp_error!r}", e.smtp_code >= 500))
+                    except (smtplib.SMTPException, OSError):
+                        raise
+                    except Exception as e:
+                        # This message alone is bad (e.g. cannot be encoded); the connection is fine
+                        outcomes.append((mail_id, f"{type(e).__name__}: {e}", False))
+                    self._timed((time.perf_counter() - started) * 1000)
+        except Exception as e:
+            # Connection lost, never opened, or the pool broke: everything not yet
+            # sent waits for a retry, and still counts towards max_attempts
+            done = {mail_id for mail_id, _, _ in outcomes}
+            outcomes.extend((row[0], f"{type(e).__name__}: {e}", False) for row in chunk if row[0] not in done)
+        return outcomes
+
+    def _timed(self, elapsed_ms: float):
+        with self._lock:
+            self.stats["send_attempts"] += 1
+            self.stats["total_send_ms"] += elapsed_ms
+            self.stats["max_send_ms"] = round(max(self.stats["max_send_ms"], elapsed_ms), 3)
+
+    def _record(self, batch: List[Tuple], outcomes: List[Tuple[int, Optional[str], bool]]):
+        rows = {row[0]: row for row in batch}
+        now = datetime.utcnow()
+        params = []
+        for mail_id, error, permanent in outcomes:
+            _, _, _, _, attempts, created_at, token = rows[mail_id]
+            if error is None:
+                status, next_attempt = "sent", now
+                latency_ms = (now - created_at).total_seconds() * 1000 if created_at else 0.0
+                self.stats["last_queue_latency_ms"] = round(latency_ms, 3)
+                self.stats["max_queue_latency_ms"] = round(max(self.stats["max_queue_latency_ms"], latency_ms), 3)
+            elif permanent or attempts >= self.max_attempts:
+                status, next_attempt = "failed", now
+            else:
+                status = "pending"
+                next_attempt = now + timedelta(seconds=min(self.retry_max, self.retry_base * 2 ** (attempts - 1)))
+            self.stats["retried" if status == "pending" else status] += 1
+            params.append({
+                "mail_id": mail_id, "token": token, "new_status": status, "next_at": next_attempt,
+                "error": error, "sent": now if error is None else None,
+            })
+        table = models.OutboxEmail.__table__
+        with self._session() as db:
+            # The token guard skips rows another worker re-claimed after our lease ran out
+            db.execute(
+                update(table)
+                .where(table.c.id == bindparam("mail_id"), table.c.claim_token == bindparam("token"))
+                .values(
+                    status=bindparam("new_status"), next_attempt_at=bindparam("next_at"),
+                    last_error=bindparam("error"), sent_at=bindparam("sent"), claim_token=None,
+                ),
+                params,
+            )
+            db.commit()
+        self.stats["batches"] += 1
+
+
+def create_email_outbox() -> EmailOutbox:
+    pool = None
+    if settings.SMTP_USERNAME and settings.SMTP_PASSWORD:
+        pool = SMTPConnectionPool(
+            settings.SMTP_SERVER,
+            settings.SMTP_PORT,
+            username=settings.SMTP_USERNAME,
+            password=settings.SMTP_PASSWORD,
+            size=settings.SMTP_POOL_SIZE,
+            timeout=settings.SMTP_TIMEOUT,
+            max_messages=settings.SMTP_MAX_MESSAGES_PER_CONNECTION,
+            max_idle=settings.SMTP_MAX_IDLE,
+        )
+    return EmailOutbox(
+        pool,
+        batch_size=settings.EMAIL_OUTBOX_BATCH_SIZE,
+        poll_interval=settings.EMAIL_OUTBOX_POLL_INTERVAL,
+        max_attempts=settings.EMAIL_MAX_ATTEMPTS,
+        retry_base=settings.EMAIL_RETRY_BASE,
+        retry_max=settings.EMAIL_RETRY_MAX,
+        from_email=settings.SMTP_FROM_EMAIL or settings.SMTP_USERNAME,
+    )
+
+
+email_outbox = create_email_outbox()
@@ -0,0 +1,113 @@
+"""Background auto-close of time entries nobody clocked out of.
+
+An entry left open keeps growing on the dashboard and stays in every
+open-entry scan. Every `interval` seconds the sweeper closes entries that
+have been open longer than `max_hours`. Each one is closed at clock_in +
+`max_hours`, never "now", so a forgotten punch counts as a capped shift,
+and it is flagged `auto_closed` for HR to review.
+
+A pass walks the stale entries in id order, `batch_size` rows per UPDATE
+and per commit, so it never holds long locks. Passes run in a worker
+thread, so the event loop keeps serving requests. Users left with no open
+entry are pushed to live dashboards as offline.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+
+from .. import crud, models
+from ..db import SessionLocal
+from .attendance_stream import attendance_hub
+
+logger = logging.getLogger(__name__)
+
+
+class OpenEntrySweeper:
+    def __init__(self, max_hours: float = 16.0, interval: float = 900.0, batch_size: int = 500):
+        self.max_hours = max_hours
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {
+            "passes": 0,
+            "failed_passes": 0,
+            "entries_closed": 0,
+            "batches": 0,
+            "last_pass_closed": 0,
+            "last_pass_batches": 0,
+            "last_pass_ms": 0.0,
+            "max_pass_ms": 0.0,
+            "last_pass_at": None,
+        }
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def sweep(self, now: Optional[datetime] = None) -> int:
+        """Run one pass synchronously. Returns the number of entries closed."""
+        now = now or datetime.utcnow()
+        max_open = timedelta(hours=self.max_hours)
+        started = time.perf_counter()
+        closed_total = batches = 0
+        cursor = 0
+        with SessionLocal() as db:
+            while cursor is not None:
+                cursor, closed = crud.auto_close_stale_entries(
+                    db, opened_before=now - max_open, max_open=max_open, after_id=cursor, limit=self.batch_size
+                )
+                if closed:
+                    self._publish(db, {user_id for _, user_id in closed})
+                closed_total += len(closed)
+                batches += cursor is not None
+        self._record(closed_total, batches, (time.perf_counter() - started) * 1000, now)
+        return closed_total
+
+    @staticmethod
+    def _publish(db, user_ids):
+        """Tell live dashboards about users whose entries were just closed."""
+        TimeEntry, User = models.TimeEntry, models.User
+        still_open = select(TimeEntry.id).where(TimeEntry.user_id == User.id, TimeEntry.clock_out.is_(None)).exists()
+        for user_id, company_id, online in db.execute(
+            select(User.id, User.company_id, still_open).where(User.id.in_(user_ids))
+        ):
+            attendance_hub.publish_punch(company_id, user_id, online=bool(online))
+
+    def metrics(self) -> dict:
+        return {**self.stats, "max_hours": self.max_hours, "interval": self.interval, "running": self._task is not None and not self._task.done()}
+
+    async def _run(self):
+        while True:
+            try:
+                await run_in_threadpool(self.sweep)
+            except Exception:
+                logger.exception("Open entry sweep failed")
+                self.stats["failed_passes"] += 1
+            await asyncio.sleep(self.interval)
+
+    def _record(self, closed: int, batches: int, elapsed_ms: float, now: datetime):
+        stats = self.stats
+        stats["passes"] += 1
+        stats["entries_closed"] += closed
+        stats["batches"] += batches
+        stats["last_pass_closed"] = closed
+        stats["last_pass_batches"] = batches
+        stats["last_pass_ms"] = round(elapsed_ms, 3)
+        stats["max_pass_ms"] = round(max(stats["max_pass_ms"], elapsed_ms), 3)
+        stats["last_pass_at"] = now
@@ -0,0 +1,150 @@
+"""Great-circle distances and a grid index of a company's allowed sites.
+
+`SiteIndex` buckets sites into a lat/lon grid whose cell size matches the
+largest site radius, so a point only has to be checked against the sites
+in the few cells around it instead of against every site.
+"""
+
+from math import asin, cos, radians, sin, sqrt
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371 * 1000
+METERS_PER_DEGREE = 111_320.0
+MIN_CELL_DEGREES = 0.001  # ~110 m; keeps tiny radii from exploding the grid
+MAX_BATCH_PAIRS = 1_000_000  # points x sites evaluated per vectorized chunk
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Calculate the great circle distance in meters between two points
+    on the earth (specified in decimal degrees)
+    """
+    if lon1 is None or lat1 is None or lon2 is None or lat2 is None:
+        return float('inf')
+
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+
+    # haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a))
+    return c * EARTH_RADIUS_M
+
+
+def haversine_np(lon1, lat1, lon2, lat2) -> np.ndarray:
+    """Vectorized `haversine`: broadcasts array arguments, NaN -> inf."""
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(v, dtype=float)) for v in (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    distance = 2 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0))) * EARTH_RADIUS_M
+    return np.where(np.isnan(distance), np.inf, distance)
+
+
+class Site(NamedTuple):
+    id: Optional[int]
+    name: str
+    latitude: float
+    longitude: float
+    radius: float
+
+
+class SiteMatch(NamedTuple):
+    site: Optional[Site]  # Nearest site, or None if the index is empty
+    distance: float
+    allowed: bool
+
+
+class SiteIndex:
+    def __init__(self, sites: List[Site]):
+        self.sites = sites
+        self.lat = np.array([s.latitude for s in sites], dtype=float)
+        self.lon = np.array([s.longitude for s in sites], dtype=float)
+        self.radius = np.array([s.radius for s in sites], dtype=float)
+        self.max_radius = float(self.radius.max()) if sites else 0.0
+        self.cell = max(self.max_radius / METERS_PER_DEGREE, MIN_CELL_DEGREES)
+        self.buckets: Dict[Tuple[int, int], List[int]] = {}
+        for i, site in enumerate(sites):
+            self.buckets.setdefault(self._cell_of(site.latitude, site.longitude), []).append(i)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def nearest(self, latitude: float, longitude: float) -> SiteMatch:
+        """Nearest site around a point; `allowed` if the point is inside its radius.
+
+        Prefers the nearest site whose radius covers the point, since a large
+        campus may contain a smaller site's circle. A point outside every
+        cell's reach falls back to scanning all sites, so the rejection can
+        still name the closest one.
+        """
+        if not self.sites:
+            return SiteMatch(None, float("inf"), False)
+        candidates = self._candidates(latitude, longitude) or range(len(self.sites))
+        idx = np.array(candidates)
+        distances = haversine_np(longitude, latitude, self.lon[idx], self.lat[idx])
+        inside = distances <= self.radius[idx]
+        pick = int(np.argmin(np.where(inside, distances, np.inf))) if inside.any() else int(np.argmin(distances))
+        return SiteMatch(self.sites[idx[pick]], float(distances[pick]), bool(inside[pick]))
+
+    def contains_many(self, latitudes, longitudes) -> np.ndarray:
+        """Boolean mask: is each point inside at least one site's radius?
+
+        Evaluates the full points x sites distance matrix in chunks, which is
+        the fast path for re-validating thousands of punches at once.
+        """
+        lat = np.asarray(latitudes, dtype=float)
+        lon = np.asarray(longitudes, dtype=float)
+        result = np.zeros(lat.shape[0], dtype=bool)
+        if not self.sites:
+            return result
+        step = max(1, MAX_BATCH_PAIRS // len(self.sites))
+        for start in range(0, lat.shape[0], step):
+            chunk = slice(start, start + step)
+            distances = haversine_np(lon[chunk, None], lat[chunk, None], self.lon[None, :], self.lat[None, :])
+            result[chunk] = (distances <= self.radius[None, :]).any(axis=1)
+        return result
+
+    def _cell_of(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return int(np.floor(latitude / self.cell)), int(np.floor(longitude / self.cell))
+
+    def _candidates(self, latitude: float, longitude: float) -> List[int]:
+        # Longitude degrees shrink towards the poles, so widen the search there.
+        lon_scale = max(cos(radians(latitude)), 0.01)
+        lat_span = int(np.ceil(self.max_radius / METERS_PER_DEGREE / self.cell))
+        lon_span = int(np.ceil(self.max_radius / (METERS_PER_DEGREE * lon_scale) / self.cell))
+        row, col = self._cell_of(latitude, longitude)
+        found: List[int] = []
+        for i in range(row - lat_span, row + lat_span + 1):
+            for j in range(col - lon_span, col + lon_span + 1):
+                found.extend(self.buckets.get((i, j), ()))
+        return found
+
+
+class SiteIndexCache:
+    """Per-company SiteIndex, rebuilt when the company's `sites_version` moves."""
+
+    def __init__(self):
+        self._indexes: Dict[int, Tuple[int, SiteIndex]] = {}
+
+    def get(self, company) -> SiteIndex:
+        version = company.sites_version or 0
+        cached = self._indexes.get(company.id)
+        if cached and cached[0] == version:
+            return cached[1]
+        index = SiteIndex(company_sites(company))
+        self._indexes[company.id] = (version, index)
+        return index
+
+
+def company_sites(company) -> List[Site]:
+    """The company's sites, plus its legacy single location if one is set."""
+    sites = [Site(s.id, s.name, s.latitude, s.longitude, s.radius or 100.0) for s in company.sites]
+    if company.latitude is not None and company.longitude is not None:
+        sites.append(Site(None, company.name, company.latitude, company.longitude, company.allowed_radius or 100.0))
+    return sites
+
+
+site_indexes = SiteIndexCache()
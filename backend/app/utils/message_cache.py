@@ -0,0 +1,172 @@
+"""In-memory tail of recent messages per chat room.
+
+Every client that opens a room asks `/chat/history` for the same newest
+page, so each room keeps a ring buffer of its most recent messages. Rooms are
+warmed from the database on first use, extended by the write-behind writer
+after each flush, and evicted least-recently-used once the estimated memory
+footprint exceeds `max_bytes`.
+
+Each worker holds its own buffers. With a multi-worker broadcast backend a
+room only sees messages persisted by the local worker, so `ttl` bounds how
+stale a buffer may get before it is re-read from the database;
+`default_ttl` picks one from the broadcast backend.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional
+
+from .. import schemas
+
+# Rough per-message overhead of the pydantic object, datetime and deque slot.
+MESSAGE_OVERHEAD_BYTES = 300
+
+# Staleness bound when other workers also write to the rooms
+MULTI_WORKER_TTL = 2.0
+
+
+def default_ttl(broadcast_url: str) -> float:
+    """No expiry when this worker sees every message, else `MULTI_WORKER_TTL`."""
+    return 0 if broadcast_url.startswith("memory://") else MULTI_WORKER_TTL
+
+
+def _message_size(message: schemas.MessageRead) -> int:
+    return MESSAGE_OVERHEAD_BYTES + len(message.content.encode()) + len(message.room)
+
+
+class RoomBuffer:
+    def __init__(self, capacity: int):
+        self.messages: deque = deque(maxlen=capacity)
+        self.complete = False  # True when the room has nothing older than the buffer
+        self.size = 0
+        self.loaded_at = time.monotonic()
+
+    def append(self, message: schemas.MessageRead):
+        if len(self.messages) == self.messages.maxlen:
+            self.size -= _message_size(self.messages[0])
+            self.complete = False
+        self.messages.append(message)
+        self.size += _message_size(message)
+
+    def index_of(self, message_id: int) -> Optional[int]:
+        for i in range(len(self.messages) - 1, -1, -1):
+            if self.messages[i].id == message_id:
+                return i
+        return None
+
+
+class RecentMessageCache:
+    def __init__(self, room_capacity: int = 200, max_bytes: int = 16 * 1024 * 1024, ttl: float = 0):
+        self.room_capacity = room_capacity
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._rooms: "OrderedDict[str, RoomBuffer]" = OrderedDict()
+        self._epochs: Dict[str, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(
+        self,
+        room: str,
+        limit: int,
+        loader: Callable[[int], List[schemas.MessageRead]],
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+    ) -> Optional[List[schemas.MessageRead]]:
+        """Serve a history window from the buffer, warming the room if needed.
+
+        Returns None when the window reaches past what the buffer holds; the
+        caller should then query the database.
+        """
+        with self._lock:
+            buffer = self._fresh(room)
+            epoch = self._epochs.get(room, 0)
+        if buffer is None:
+            self._warm(room, loader, epoch)
+        with self._lock:
+            buffer = self._fresh(room)
+            window = self._window(buffer, limit, before_id, after_id) if buffer else None
+            if window is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return window
+
+    def append(self, messages: List[schemas.MessageRead]):
+        """Add freshly persisted messages to the rooms that are currently warm."""
+        with self._lock:
+            for message in messages:
+                buffer = self._rooms.get(message.room)
+                if buffer is None:
+                    # Invalidate any warm-up that read the table before this row.
+                    self._epochs[message.room] = self._epochs.get(message.room, 0) + 1
+                    continue
+                self._bytes -= buffer.size
+                buffer.append(message)
+                self._bytes += buffer.size
+            self._enforce_cap()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "rooms": len(self._rooms),
+                "bytes": self._bytes,
+            }
+
+    def _warm(self, room: str, loader: Callable[[int], List[schemas.MessageRead]], epoch: int):
+        messages = loader(self.room_capacity)
+        buffer = RoomBuffer(self.room_capacity)
+        for message in messages:
+            buffer.append(message)
+        buffer.complete = len(messages) < self.room_capacity
+        with self._lock:
+            if room in self._rooms or self._epochs.get(room, 0) != epoch:
+                return  # Raced with another warm-up or a flush; next lookup retries
+            self._rooms[room] = buffer
+            self._bytes += buffer.size
+            self._enforce_cap()
+
+    def _fresh(self, room: str) -> Optional[RoomBuffer]:
+        buffer = self._rooms.get(room)
+        if buffer is None:
+            return None
+        if self.ttl and time.monotonic() - buffer.loaded_at > self.ttl:
+            self._drop(room)
+            return None
+        self._rooms.move_to_end(room)
+        return buffer
+
+    @staticmethod
+    def _window(buffer: RoomBuffer, limit: int, before_id: Optional[int], after_id: Optional[int]):
+        messages = buffer.messages
+        if after_id is not None:
+            i = buffer.index_of(after_id)
+            if i is None:
+                return None
+            return list(messages)[i + 1:i + 1 + limit]
+        end = len(messages)
+        if before_id is not None:
+            end = buffer.index_of(before_id)
+            if end is None:
+                return None
+        if end < limit and not buffer.complete:
+            return None
+        return list(messages)[max(0, end - limit):end]
+
+    def _enforce_cap(self):
+        while self._bytes > self.max_bytes and self._rooms:
+            self._drop(next(iter(self._rooms)))
+            self.evictions += 1
+
+    def _drop(self, room: str):
+        buffer = self._rooms.pop(room)
+        self._bytes -= buffer.size
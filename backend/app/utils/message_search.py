@@ -0,0 +1,92 @@
+"""Full-text search over chat messages.
+
+On SQLite the index is an FTS5 table (`messages_fts`, created by migration
+0002) that uses `messages` as its external content. Other databases use the `message_terms` inverted
+index. Either way `index_messages` adds new rows inside the transaction that
+inserts them, so history never has to be re-indexed.
+
+A query matches messages that contain every term, newest first.
+"""
+
+import re
+from typing import List, Optional
+
+from sqlalchemy import Integer, func, insert, select, text
+from sqlalchemy.orm import Session
+
+from .. import models
+
+TOKEN_RE = re.compile(r"\w+")
+MAX_TERM_LENGTH = 64
+
+
+def tokenize(content: str) -> List[str]:
+    """Lowercased, de-duplicated word tokens in order of first appearance."""
+    return list(dict.fromkeys(t[:MAX_TERM_LENGTH] for t in TOKEN_RE.findall(content.lower())))
+
+
+def uses_fts5(bind) -> bool:
+    return bind.dialect.name == "sqlite"
+
+
+def index_messages(db: Session, messages: List[models.Message]):
+    """Add freshly inserted (flushed) messages to the search index."""
+    if not messages:
+        return
+    if uses_fts5(db.get_bind()):
+        db.execute(
+            text("INSERT INTO messages_fts(rowid, content) VALUES (:id, :content)"),
+            [{"id": m.id, "content": m.content} for m in messages],
+        )
+        return
+    rows = [
+        {"term": term, "message_id": m.id, "room": m.room, "sender_id": m.sender_id}
+        for m in messages
+        for term in tokenize(m.content)
+    ]
+    if rows:
+        db.execute(insert(models.MessageTerm), rows)
+
+
+def search_messages(
+    db: Session,
+    query: str,
+    room: Optional[str] = None,
+    sender_id: Optional[int] = None,
+    limit: int = 50,
+    before_id: Optional[int] = None,
+) -> List[models.Message]:
+    terms = tokenize(query)
+    if not terms:
+        return []
+    Message = models.Message
+
+    if uses_fts5(db.get_bind()):
+        match = " ".join('"%s"' % term.replace('"', '""') for term in terms)
+        matching_ids = text("SELECT rowid FROM messages_fts WHERE messages_fts MATCH :match").bindparams(
+            match=match
+        ).columns(rowid=Integer)
+        results = db.query(Message).filter(Message.id.in_(matching_ids))
+        if room is not None:
+            results = results.filter(Message.room == room)
+        if sender_id is not None:
+            results = results.filter(Message.sender_id == sender_id)
+        if before_id is not None:
+            results = results.filter(Message.id < before_id)
+        return results.order_by(Message.id.desc()).limit(limit).all()
+
+    Term = models.MessageTerm
+    ids = select(Term.message_id).where(Term.term.in_(terms))
+    if room is not None:
+        ids = ids.where(Term.room == room)
+    if sender_id is not None:
+        ids = ids.where(Term.sender_id == sender_id)
+    if before_id is not None:
+        ids = ids.where(Term.message_id < before_id)
+    ids = ids.group_by(Term.message_id).having(func.count() == len(terms)).order_by(
+        Term.message_id.desc()
+    ).limit(limit)
+    message_ids = db.scalars(ids).all()
+    if not message_ids:
+        return []
+    return db.query(Message).filter(Message.id.in_(message_ids)).order_by(Message.id.desc()).all()
@@ -0,0 +1,169 @@
+"""Coalescing of outgoing notifications in front of the email outbox.
+
+Without it every request that notifies someone mails them, so a script
+that logs in every minute sends a mail every minute, and those mails queue
+up ahead of signup codes. Here outbound mail follows distinct events
+instead:
+
+- `otp` mails go out at once, in the outbox's top priority lane;
+- `alert` mails go out at once, but only the first per `key` within
+  `alert_window` seconds. Repeats are held back and folded into the next
+  digest, so they are still reported, just not one mail each;
+- `notice` mails are always held for the digest.
+
+Every `digest_interval` seconds `flush_digests` turns each recipient's held
+mails into one low-priority digest, with identical subjects counted rather
+than repeated. The window check and the held rows live in `email_outbox`,
+so the limits hold across workers. `otp`, `alert` and `notice` only add
+rows to the caller's session; the caller commits them with the rest of its
+transaction.
+"""
+
+import asyncio
+import logging
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+from ..db import SessionLocal
+from .email_outbox import PRIORITY_DIGEST, PRIORITY_NORMAL, PRIORITY_OTP, EmailOutbox, email_outbox
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationCoalescer:
+    def __init__(
+        self,
+        outbox: EmailOutbox,
+        alert_window: float = 900.0,
+        digest_interval: float = 3600.0,
+        session_factory=SessionLocal,
+    ):
+        self.outbox = outbox
+        self.alert_window = alert_window
+        self.digest_interval = digest_interval
+        self._session = session_factory
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"otp_sent": 0, "alerts_sent": 0, "alerts_coalesced": 0, "notices_held": 0, "digests_sent": 0, "digested": 0}
+
+    def otp(self, db: Session, to_email: str, subject: str, body: str):
+        self.outbox.enqueue(db, to_email, subject, body, kind="otp", priority=PRIORITY_OTP)
+        self.stats["otp_sent"] += 1
+
+    def alert(self, db: Session, to_email: str, subject: str, body: str, key: str, kind: Optional[str] = None) -> bool:
+        """Mail now unless `key` was mailed within the window. Returns True if mailed.
+
+        The window check and the insert are not atomic: two requests for the
+        same `key` racing in different transactions can both see no recent
+        mail and both send one. That costs at most an extra alert, never a
+        lost one, so no lock or constraint is taken for it.
+        """
+        Outbox = models.OutboxEmail
+        since = datetime.utcnow() - timedelta(seconds=self.alert_window)
+        recent = db.scalar(
+            select(Outbox.id)
+            .where(Outbox.dedupe_key == key, Outbox.created_at >= since, Outbox.status != "held")
+            .limit(1)
+        )
+        self.outbox.enqueue(
+            db, to_email, subject, body, kind=kind, priority=PRIORITY_NORMAL, dedupe_key=key, held=recent is not None
+        )
+        self.stats["alerts_coalesced" if recent is not None else "alerts_sent"] += 1
+        return recent is None
+
+    def notice(self, db: Session, to_email: str, subject: str, body: str, kind: Optional[str] = None):
+        """Hold a low-priority mail for the recipient's next digest."""
+        self.outbox.enqueue(db, to_email, subject, body, kind=kind, priority=PRIORITY_DIGEST, held=True)
+        self.stats["notices_held"] += 1
+
+    def flush_digests(self) -> int:
+        """Replace every recipient's held mails with one digest. Returns digests queued.
+
+        The held rows are claimed with a token, as `EmailOutbox._claim` does,
+        and digests are built only from rows this call moved. A worker whose
+        UPDATE lost the race to another worker finds none and queues nothing.
+        """
+        Outbox = models.OutboxEmail
+        token = uuid.uuid4().hex
+        with self._session() as db:
+            claimed = db.execute(
+                update(Outbox)
+                .where(Outbox.status == "held")
+                .values(status="digested", claim_token=token)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not claimed:
+                db.rollback()
+                return 0
+            held = db.execute(
+                select(Outbox.id, Outbox.to_email, Outbox.subject, Outbox.created_at)
+                .where(Outbox.claim_token == token)
+                .order_by(Outbox.to_email, Outbox.created_at)
+            ).all()
+            by_recipient: Dict[str, List] = {}
+            for row in held:
+                by_recipient.setdefault(row.to_email, []).append(row)
+            db.add_all(
+                models.OutboxEmail(
+                    to_email=to_email, subject="Your account activity", body=_digest_body(rows),
+                    kind="digest", priority=PRIORITY_DIGEST, next_attempt_at=datetime.utcnow(),
+                )
+                for to_email, rows in by_recipient.items()
+            )
+            db.commit()
+        self.stats["digests_sent"] += len(by_recipient)
+        self.stats["digested"] += len(held)
+        self.outbox.notify()
+        return len(by_recipient)
+
+    def start(self):
+        if self.digest_interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def metrics(self) -> dict:
+        return {**self.stats, "alert_window": self.alert_window, "digest_interval": self.digest_interval}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.digest_interval)
+            try:
+                await run_in_threadpool(self.flush_digests)
+            except Exception:
+                logger.exception("Notification digest failed")
+
+
+def _digest_body(rows) -> str:
+    groups: "OrderedDict[str, List[datetime]]" = OrderedDict()
+    for row in rows:
+        groups.setdefault(row.subject, []).append(row.created_at)
+    lines = ["Since your last update:", ""]
+    for subject, times in groups.items():
+        if len(times) == 1:
+            lines.append(f"- {subject} ({times[0]:%Y-%m-%d %H:%M} UTC)")
+        else:
+            lines.append(f"- {subject} x{len(times)} ({times[0]:%Y-%m-%d %H:%M} to {times[-1]:%Y-%m-%d %H:%M} UTC)")
+    return "\n".join(lines)
+
+
+notifications = NotificationCoalescer(
+    email_outbox,
+    alert_window=settings.LOGIN_ALERT_WINDOW,
+    digest_interval=settings.NOTIFICATION_DIGEST_INTERVAL,
+)
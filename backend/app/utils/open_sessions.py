@@ -0,0 +1,84 @@
+"""In-memory registry of open time entries.
+
+`create_time_entry` holds a per-user lock from reading the open entry to
+committing the punch, so two concurrent punches by the same user on this
+worker cannot both close (or both miss) the same entry.
+
+With OPEN_SESSION_REGISTRY enabled, the registry is loaded from the
+database at startup and kept in step with every punch. "Is this user
+clocked in" and "which entry does clock_out close" are then answered
+without a query. Punches on other workers do not reach it, so only enable
+it with a single worker: startup skips loading it when WEB_CONCURRENCY is
+above 1, and clock_out still asks the database when the registry has no
+open entry for the user.
+"""
+
+import bisect
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .. import models
+
+OpenEntry = Tuple[datetime, int]  # (clock_in, entry id)
+
+
+class OpenSessionRegistry:
+    def __init__(self):
+        self.loaded = False
+        self._open: Dict[int, List[OpenEntry]] = {}
+        self._locks: Dict[int, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def lock(self, user_id: int) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(user_id, threading.Lock())
+
+    def load(self, db: Session):
+        """Start answering from memory, seeded with every open entry."""
+        TimeEntry = models.TimeEntry
+        rows = db.execute(
+            select(TimeEntry.user_id, TimeEntry.clock_in, TimeEntry.id)
+            .where(TimeEntry.clock_out.is_(None))
+            .order_by(TimeEntry.clock_in, TimeEntry.id)
+        ).all()
+        with self._guard:
+            self._open = {}
+            for user_id, clock_in, entry_id in rows:
+                self._open.setdefault(user_id, []).append((clock_in, entry_id))
+            self.loaded = True
+
+    def clear(self):
+        with self._guard:
+            self._open = {}
+            self.loaded = False
+
+    def is_open(self, user_id: int) -> Optional[bool]:
+        """Whether the user is clocked in, or None if the registry is not loaded."""
+        if not self.loaded:
+            return None
+        return bool(self._open.get(user_id))
+
+    def latest(self, user_id: int) -> Optional[OpenEntry]:
+        """The entry clock_out would close; only meaningful once loaded."""
+        entries = self._open.get(user_id)
+        return entries[-1] if entries else None
+
+    def opened(self, user_id: int, clock_in: datetime, entry_id: int):
+        if self.loaded:
+            with self._guard:
+                bisect.insort(self._open.setdefault(user_id, []), (clock_in, entry_id))
+
+    def closed(self, user_id: int, entry_id: int):
+        if self.loaded:
+            with self._guard:
+                entries = self._open.get(user_id, [])
+                entries[:] = [e for e in entries if e[1] != entry_id]
+                if not entries:
+                    self._open.pop(user_id, None)
+
+
+open_sessions = OpenSessionRegistry()
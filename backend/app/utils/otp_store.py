@@ -0,0 +1,213 @@
+"""One-time signup codes with a fixed lifetime.
+
+An email has at most one live code. `issue` replaces the previous one in a
+single statement (a Redis SET, or one UPDATE in SQL), and `verify` consumes
+the code atomically, so it works only once. Codes are compared with
+`hmac.compare_digest`, so response time does not reveal how many digits of
+a guess were right.
+
+Backends, picked by URL (`OTP_STORE_URL`):
+
+- ``memory://``: a dict in this process. For tests and single-worker runs.
+- ``redis://...``: one key per email with a native TTL. Redis deletes expired
+  codes itself, so nothing needs purging.
+- ``sql://``: the `verification_codes` table, read through the
+  (email, is_used, expires_at) index. Expired and used rows are deleted by
+  `purge`, which `start` runs every `interval` seconds so the table does not
+  grow with signup volume.
+"""
+
+import asyncio
+import logging
+import hmac
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, insert, or_, select, update
+
+from .. import models
+from ..db import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def generate_code(digits: int = 6) -> str:
+    return f"{secrets.randbelow(10 ** digits):0{digits}d}"
+
+
+class OTPStore:
+    def __init__(self, ttl: float = 600.0):
+        self.ttl = ttl
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"issued": 0, "verified": 0, "rejected": 0, "purged": 0, "purge_passes": 0}
+
+    def issue(self, email: str, code: str):
+        """Store `code` for `email`, replacing any earlier code."""
+        raise NotImplementedError
+
+    def verify(self, email: str, code: str) -> bool:
+        """True (and the code is consumed) if `code` is the live code for `email`."""
+        ok = self._consume(email, code)
+        self.stats["verified" if ok else "rejected"] += 1
+        return ok
+
+    def purge(self) -> int:
+        """Delete expired and used codes. Returns how many were removed."""
+        return 0
+
+    def start(self, interval: float):
+        if interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run(interval))
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def metrics(self) -> dict:
+        return {**self.stats, "backend": type(self).__name__, "ttl": self.ttl}
+
+    def _consume(self, email: str, code: str) -> bool:
+        raise NotImplementedError
+
+    async def _run(self, interval: float):
+        while True:
+            try:
+                purged = await run_in_threadpool(self.purge)
+                self.stats["purged"] += purged
+                self.stats["purge_passes"] += 1
+            except Exception:
+                logger.exception("OTP purge failed")
+            await asyncio.sleep(interval)
+
+
+class MemoryOTPStore(OTPStore):
+    def __init__(self, ttl: float = 600.0):
+        super().__init__(ttl)
+        self._codes: Dict[str, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def issue(self, email: str, code: str):
+        with self._lock:
+            self._codes[email] = (code, time.monotonic() + self.ttl)
+        self.stats["issued"] += 1
+
+    def _consume(self, email: str, code: str) -> bool:
+        with self._lock:
+            entry = self._codes.get(email)
+            if entry is None or entry[1] <= time.monotonic():
+                return False
+            if not hmac.compare_digest(entry[0].encode(), code.encode()):
+                return False
+            del self._codes[email]
+            return True
+
+    def purge(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            expired = [email for email, (_, deadline) in self._codes.items() if deadline <= now]
+            for email in expired:
+                del self._codes[email]
+        return len(expired)
+
+
+class RedisOTPStore(OTPStore):
+    """Key ``otp:<email>`` holds the code and expires with it."""
+
+    def __init__(self, url: str = "redis://localhost:6379/0", ttl: float = 600.0, prefix: str = "otp:", client=None):
+        super().__init__(ttl)
+        self.prefix = prefix
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self._redis = client
+
+    def issue(self, email: str, code: str):
+        self._redis.set(self.prefix + email, code, ex=max(1, int(self.ttl)))
+        self.stats["issued"] += 1
+
+    def _consume(self, email: str, code: str) -> bool:
+        from redis.exceptions import WatchError
+
+        key = self.prefix + email
+        with self._redis.pipeline() as pipe:
+            try:
+                # WATCH makes the DEL fail if a new code was issued meanwhile
+                pipe.watch(key)
+                stored = pipe.get(key)
+                if stored is None:
+                    return False
+                if isinstance(stored, bytes):
+                    stored = stored.decode()
+                if not hmac.compare_digest(stored.encode(), code.encode()):
+                    return False
+                pipe.multi()
+                pipe.delete(key)
+                return pipe.execute()[0] == 1
+            except WatchError:
+                return False
+
+
+class SQLOTPStore(OTPStore):
+    """Codes in `verification_codes`; each call uses its own short session."""
+
+    def __init__(self, ttl: float = 600.0, session_factory=SessionLocal):
+        super().__init__(ttl)
+        self._session = session_factory
+
+    def issue(self, email: str, code: str):
+        Code = models.VerificationCode
+        now = datetime.utcnow()
+        with self._session() as db:
+            db.execute(update(Code).where(Code.email == email, Code.is_used == False).values(is_used=True))
+            db.execute(insert(Code).values(
+                email=email, code=code, created_at=now, expires_at=now + timedelta(seconds=self.ttl), is_used=False
+            ))
+            db.commit()
+        self.stats["issued"] += 1
+
+    def _consume(self, email: str, code: str) -> bool:
+        Code = models.VerificationCode
+        with self._session() as db:
+            row = db.execute(
+                select(Code.id, Code.code)
+                .where(Code.email == email, Code.is_used == False, Code.expires_at > datetime.utcnow())
+                .order_by(Code.expires_at.desc())
+                .limit(1)
+            ).first()
+            if row is None or not hmac.compare_digest(row.code.encode(), code.encode()):
+                return False
+            # Guarded UPDATE: of two concurrent requests with the code, one wins
+            consumed = db.execute(
+                update(Code).where(Code.id == row.id, Code.is_used == False).values(is_used=True)
+            ).rowcount
+            db.commit()
+            return consumed == 1
+
+    def purge(self) -> int:
+        Code = models.VerificationCode
+        with self._session() as db:
+            removed = db.execute(
+                delete(Code).where(or_(Code.is_used == True, Code.expires_at <= datetime.utcnow(), Code.expires_at.is_(None)))
+            ).rowcount
+            db.commit()
+        return removed
+
+
+def create_otp_store(url: str, ttl: float = 600.0) -> OTPStore:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisOTPStore(url, ttl=ttl)
+    if url.startswith("memory://"):
+        return MemoryOTPStore(ttl=ttl)
+    if url.startswith("sql://"):
+        return SQLOTPStore(ttl=ttl)
+    raise ValueError(f"Unsupported OTP_STORE_URL: {url}")
@@ -0,0 +1,119 @@
+"""Argon2 password hashing on a dedicated, bounded thread pool.
+
+Each Argon2 call burns ~0.2 s of CPU and tens of MB of memory. Run
+directly in FastAPI's shared thread pool, a burst of logins would occupy
+every thread and stall all other sync endpoints. Instead:
+
+- hashing runs on `max_workers` threads of its own (argon2-cffi releases
+  the GIL, so they use real cores), which caps the CPU spent on it;
+- at most `max_queue` further calls wait for a worker; past that,
+  `HasherBusy` is raised at once and the API answers 429. So at most
+  `max_workers + max_queue` request threads are ever parked here;
+- cost parameters come from settings. `verify_and_update` returns a fresh
+  hash whenever the stored one was made with other parameters, so hashes
+  migrate on the next successful login.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+
+class HasherBusy(Exception):
+    """Raised when the hashing pool and its queue are full."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Password hashing capacity exhausted")
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    def __init__(
+        self,
+        max_workers: int = 2,
+        max_queue: int = 16,
+        queue_timeout: float = 0.0,
+        time_cost: int = 3,
+        memory_cost: int = 65536,
+        parallelism: int = 4,
+    ):
+        self.context = CryptContext(
+            schemes=["argon2"],
+            deprecated="auto",
+            argon2__rounds=time_cost,
+            argon2__memory_cost=memory_cost,
+            argon2__parallelism=parallelism,
+        )
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="argon2")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._dummy_hash: Optional[str] = None
+        self._dummy_lock = threading.Lock()
+        self.stats = {"hashed": 0, "verified": 0, "rehashed": 0, "rejected": 0, "in_flight": 0, "max_in_flight": 0, "total_ms": 0.0}
+
+    def hash(self, password: str) -> str:
+        return self._run("hashed", self.context.hash, password)
+
+    def verify_and_update(self, password: str, hashed: Optional[str]) -> Tuple[bool, Optional[str]]:
+        """(matches, replacement hash or None). A missing hash still costs a verify."""
+        if hashed is None:
+            # Same work as a real check, so response time does not reveal
+            # whether the account exists.
+            self._run("verified", self._verify_dummy, password)
+            return False, None
+        ok, new_hash = self._run("verified", self.context.verify_and_update, password, hashed)
+        if new_hash is not None:
+            self.stats["rehashed"] += 1
+        return ok, new_hash
+
+    def verify(self, password: str, hashed: Optional[str]) -> bool:
+        return self.verify_and_update(password, hashed)[0]
+
+    def metrics(self) -> dict:
+        return {**self.stats, "max_workers": self.max_workers, "max_queue": self.max_queue}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, kind: Optional[str], fn, *args):
+        if self.queue_timeout > 0:
+            admitted = self._slots.acquire(timeout=self.queue_timeout)
+        else:
+            admitted = self._slots.acquire(blocking=False)
+        if not admitted:
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise HasherBusy(retry_after=self._retry_after())
+        started = time.perf_counter()
+        with self._lock:
+            self.stats["in_flight"] += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self.stats["in_flight"] -= 1
+                self.stats["total_ms"] += (time.perf_counter() - started) * 1000
+                if kind:
+                    self.stats[kind] += 1
+            self._slots.release()
+
+    def _retry_after(self) -> int:
+        """Seconds until the current queue has likely drained."""
+        done = self.stats["hashed"] + self.stats["verified"]
+        average = self.stats["total_ms"] / done / 1000 if done else 0.25
+        return max(1, round(average * (self.max_workers + self.max_queue) / self.max_workers))
+
+    def _verify_dummy(self, password: str) -> bool:
+        # On the pool, so the first call's extra hash is admitted and capped
+        # like any other; concurrent first calls make it once.
+        with self._dummy_lock:
+            if self._dummy_hash is None:
+                self._dummy_hash = self.context.hash("dummy password for timing")
+        return self.context.verify(password, self._dummy_hash)
@@ -0,0 +1,127 @@
+"""Cache of authenticated principals, keyed by bearer token.
+
+`deps.get_current_principal` answers "who is calling" from here without
+decoding the JWT or querying `users`. Entries live for at most `ttl`
+seconds (never past the token's own `exp`), and the least recently used
+ones are dropped beyond `max_entries`.
+
+Any ORM change to a `User` row invalidates that user's entries: once at
+flush, and again after the commit, so a request that re-read the old row
+in between cannot keep a stale copy. The cache is per process, so other
+workers catch up within `ttl`.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .. import models
+
+
+class Principal(NamedTuple):
+    """The fields most routes need from the caller, without an ORM session."""
+    id: int
+    email: str
+    role: Optional[str]
+    company_id: Optional[int]
+    is_active: bool
+    is_superuser: bool
+
+    @classmethod
+    def from_user(cls, user: models.User) -> "Principal":
+        return cls(
+            id=user.id,
+            email=user.email,
+            role=user.role,
+            company_id=user.company_id,
+            is_active=user.is_active is not False,
+            is_superuser=bool(user.is_superuser),
+        )
+
+
+class PrincipalCache:
+    def __init__(self, max_entries: int = 10_000, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, Principal]]" = OrderedDict()
+        self._tokens_by_user: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[Principal]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._drop(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, token: str, principal: Principal, token_expires_at: Optional[float] = None):
+        """Cache a principal; `token_expires_at` is the JWT `exp` (epoch seconds)."""
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        lifetime = self.ttl
+        if token_expires_at is not None:
+            lifetime = min(lifetime, token_expires_at - time.time())
+        if lifetime <= 0:
+            return
+        with self._lock:
+            self._drop(token)
+            self._entries[token] = (time.monotonic() + lifetime, principal)
+            self._tokens_by_user.setdefault(principal.id, set()).add(token)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._drop(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def metrics(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _drop(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            tokens = self._tokens_by_user.get(entry[1].id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens_by_user[entry[1].id]
+
+    def watch(self, session_class=Session):
+        """Invalidate users changed through ORM sessions of `session_class`."""
+
+        @event.listens_for(session_class, "after_flush")
+        def _after_flush(session, flush_context):
+            changed = {
+                obj.id for obj in list(session.dirty) + list(session.deleted)
+                if isinstance(obj, models.User) and obj.id is not None
+            }
+            if changed:
+                session.info.setdefault("principal_cache_users", set()).update(changed)
+                for user_id in changed:
+                    self.invalidate_user(user_id)
+
+        @event.listens_for(session_class, "after_commit")
+        def _after_commit(session):
+            for user_id in session.info.pop("principal_cache_users", ()):
+                self.invalidate_user(user_id)
+
+        @event.listens_for(session_class, "after_rollback")
+        def _after_rollback(session):
+            session.info.pop("principal_cache_users", None)
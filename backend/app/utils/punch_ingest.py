@@ -0,0 +1,244 @@
+"""Bulk ingestion of punches queued offline by kiosks and mobile apps.
+
+A batch costs a fixed number of statements however many punches it holds:
+a SELECT each for known receipts, the users and their open entries; one
+multi-row INSERT for new entries, one bulk UPDATE for the entries it closes
+and one INSERT for the receipts; a scoped rebuild of the attendance rollup;
+and a single commit. Clock-in locations are checked per company with
+`SiteIndex.contains_many`, and clock-ins are paired with clock-outs in
+memory, per user in timestamp order.
+
+Every punch carries a device-generated `client_id`. A `PunchReceipt` row
+per accepted punch makes resubmitting a batch safe: punches already seen
+come back as "duplicate" with the entry they produced.
+
+Punches older than OFFLINE_PUNCH_MAX_AGE_HOURS come back as "expired": a
+device may replay what it queued while offline, not backfill old
+attendance. Corrections that far back go through HR.
+"""
+
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .. import crud, models, schemas
+from ..config import settings
+from .attendance_stream import attendance_hub
+from .geofence import site_indexes
+from .open_sessions import open_sessions
+from .principal_cache import Principal
+
+ACTIONS = ("clock_in", "clock_out")
+MAX_CLOCK_SKEW = timedelta(minutes=5)  # Device clocks may run slightly ahead
+
+
+class _Entry:
+    """A time entry touched by the batch, existing (`id` set) or new."""
+
+    __slots__ = ("id", "user_id", "clock_in", "clock_out", "latitude", "longitude", "new")
+
+    def __init__(self, user_id, clock_in, clock_out=None, latitude=None, longitude=None, id=None):
+        self.id = id
+        self.user_id = user_id
+        self.clock_in = clock_in
+        self.clock_out = clock_out
+        self.latitude = latitude
+        self.longitude = longitude
+        self.new = id is None
+
+
+def ingest_punches(db: Session, punches: List[schemas.PunchSubmit], submitter: Principal) -> List[schemas.PunchResult]:
+    """Apply a batch of punches and report the outcome of each, in input order."""
+    try:
+        return _ingest(db, punches, submitter)
+    except IntegrityError:
+        # Another worker stored some of these receipts first; a second pass
+        # reports those punches as duplicates.
+        db.rollback()
+        return _ingest(db, punches, submitter)
+
+
+def _ingest(db: Session, punches: List[schemas.PunchSubmit], submitter: Principal) -> List[schemas.PunchResult]:
+    results: Dict[int, schemas.PunchResult] = {}
+
+    def outcome(i, status, entry_id=None, detail=None):
+        results[i] = schemas.PunchResult(
+            client_id=punches[i].client_id, user_id=punches[i].user_id, status=status, entry_id=entry_id, detail=detail
+        )
+
+    # 1. Shape checks and duplicates within the batch
+    now = datetime.utcnow()
+    max_age = timedelta(hours=settings.OFFLINE_PUNCH_MAX_AGE_HOURS)
+    first_seen: Dict[Tuple[int, str], int] = {}
+    repeats: Dict[int, int] = {}
+    candidates: List[Tuple[int, datetime]] = []
+    for i, punch in enumerate(punches):
+        key = (punch.user_id, punch.client_id)
+        if key in first_seen:
+            repeats[i] = first_seen[key]
+            continue
+        first_seen[key] = i
+        timestamp = _naive_utc(punch.timestamp)
+        if punch.action not in ACTIONS:
+            outcome(i, "rejected", detail="action must be clock_in or clock_out")
+        elif timestamp > now + MAX_CLOCK_SKEW:
+            outcome(i, "rejected", detail="timestamp is in the future")
+        elif max_age and timestamp < now - max_age:
+            outcome(i, "expired", detail=f"timestamp is more than {settings.OFFLINE_PUNCH_MAX_AGE_HOURS:g} hours old")
+        else:
+            candidates.append((i, timestamp))
+
+    # 2. Punches already ingested by an earlier submission
+    if candidates:
+        Receipt = models.PunchReceipt
+        keys = [(punches[i].user_id, punches[i].client_id) for i, _ in candidates]
+        receipts = dict(
+            ((user_id, client_id), entry_id)
+            for user_id, client_id, entry_id in db.execute(
+                select(Receipt.user_id, Receipt.client_id, Receipt.entry_id).where(
+                    tuple_(Receipt.user_id, Receipt.client_id).in_(keys)
+                )
+            )
+        )
+        fresh = []
+        for i, timestamp in candidates:
+            key = (punches[i].user_id, punches[i].client_id)
+            if key in receipts:
+                outcome(i, "duplicate", entry_id=receipts[key], detail="Already ingested")
+            else:
+                fresh.append((i, timestamp))
+        candidates = fresh
+
+    # 3. Who may be punched for
+    user_ids = sorted({punches[i].user_id for i, _ in candidates})
+    companies: Dict[int, Optional[int]] = dict(
+        db.execute(select(models.User.id, models.User.company_id).where(models.User.id.in_(user_ids))).all()
+    ) if user_ids else {}
+    manages_company = submitter.role in ["hr", "admin"] and submitter.company_id is not None
+    allowed = []
+    for i, timestamp in candidates:
+        user_id = punches[i].user_id
+        if user_id not in companies:
+            outcome(i, "rejected", detail="Unknown user")
+        elif user_id != submitter.id and not (manages_company and companies[user_id] == submitter.company_id):
+            outcome(i, "rejected", detail="Not authorized to punch for this user")
+        else:
+            allowed.append((i, timestamp))
+
+    # 4. Geofence every clock-in in one vectorized pass per company
+    clock_ins_by_company: Dict[int, List[int]] = {}
+    for i, _ in allowed:
+        company_id = companies[punches[i].user_id]
+        if punches[i].action == "clock_in" and company_id is not None:
+            clock_ins_by_company.setdefault(company_id, []).append(i)
+    for company_id, indexes in clock_ins_by_company.items():
+        sites = site_indexes.get(db.get(models.Company, company_id))
+        if not len(sites):
+            continue
+        located = [i for i in indexes if punches[i].latitude is not None and punches[i].longitude is not None]
+        for i in set(indexes) - set(located):
+            outcome(i, "rejected", detail="Location data is required to clock in.")
+        inside = sites.contains_many([punches[i].latitude for i in located], [punches[i].longitude for i in located])
+        for i, ok in zip(located, inside):
+            if not ok:
+                outcome(i, "rejected", detail="Outside every allowed location")
+    allowed = [(i, timestamp) for i, timestamp in allowed if i not in results]
+
+    punch_users = sorted({punches[i].user_id for i, _ in allowed})
+    with ExitStack() as locks:
+        # Same per-user locks as /clock, taken in a fixed order
+        for user_id in punch_users:
+            locks.enter_context(open_sessions.lock(user_id))
+        entries, open_stacks = _pair(db, punches, allowed, punch_users, outcome)
+        _write(db, punches, entries, results)
+        db.commit()
+
+    # 5. Keep the registry and live dashboards in step
+    for entry in {id(e): e for e in entries.values()}.values():
+        if entry.new and entry.clock_out is None:
+            open_sessions.opened(entry.user_id, entry.clock_in, entry.id)
+        elif not entry.new and entry.clock_out is not None:
+            open_sessions.closed(entry.user_id, entry.id)
+    for user_id in punch_users:
+        attendance_hub.publish_punch(companies[user_id], user_id, online=bool(open_stacks[user_id]))
+
+    for i, original in repeats.items():
+        first = results[original]
+        if first.status in ("accepted", "duplicate"):
+            outcome(i, "duplicate", entry_id=first.entry_id, detail="Repeats an earlier punch in this batch")
+        else:
+            outcome(i, first.status, detail=first.detail)  # Same punch, same verdict
+    return [results[i] for i in range(len(punches))]
+
+
+def _pair(db: Session, punches, allowed, user_ids, outcome):
+    """Match punches to entries in memory. Returns ({index: entry}, {user_id: open stack})."""
+    TimeEntry = models.TimeEntry
+    open_stacks: Dict[int, List[_Entry]] = {user_id: [] for user_id in user_ids}
+    if user_ids:
+        for entry_id, user_id, clock_in in db.execute(
+            select(TimeEntry.id, TimeEntry.user_id, TimeEntry.clock_in)
+            .where(TimeEntry.user_id.in_(user_ids), TimeEntry.clock_out.is_(None))
+            .order_by(TimeEntry.clock_in, TimeEntry.id)
+        ):
+            open_stacks[user_id].append(_Entry(user_id, clock_in, id=entry_id))
+
+    entries: Dict[int, _Entry] = {}
+    for i, timestamp in sorted(allowed, key=lambda item: (punches[item[0]].user_id, item[1], item[0])):
+        punch = punches[i]
+        stack = open_stacks[punch.user_id]
+        if punch.action == "clock_in":
+            entry = _Entry(punch.user_id, timestamp, latitude=punch.latitude, longitude=punch.longitude)
+            stack.append(entry)
+            entries[i] = entry
+        elif stack and stack[-1].clock_in <= timestamp:
+            # Like /clock: clock_out closes the newest open entry
+            entry = stack.pop()
+            entry.clock_out = timestamp
+            entries[i] = entry
+        elif stack:
+            outcome(i, "rejected", detail="clock_out is earlier than the open clock-in")
+        else:
+            # Nothing open (e.g. forgot to clock in): record a completed entry
+            entries[i] = _Entry(punch.user_id, timestamp, clock_out=timestamp)
+    return entries, open_stacks
+
+
+def _write(db: Session, punches, entries: Dict[int, _Entry], results):
+    TimeEntry = models.TimeEntry
+    touched = list({id(e): e for e in entries.values()}.values())
+    new = [e for e in touched if e.new]
+    if new:
+        ids = db.scalars(
+            insert(TimeEntry).returning(TimeEntry.id, sort_by_parameter_order=True),
+            [
+                {"user_id": e.user_id, "clock_in": e.clock_in, "clock_out": e.clock_out, "latitude": e.latitude, "longitude": e.longitude}
+                for e in new
+            ],
+        ).all()
+        for entry, entry_id in zip(new, ids):
+            entry.id = entry_id
+    closed = [{"id": e.id, "clock_out": e.clock_out} for e in touched if not e.new]
+    if closed:
+        db.execute(update(TimeEntry), closed)
+    if entries:
+        db.execute(insert(models.PunchReceipt), [
+            {"user_id": punches[i].user_id, "client_id": punches[i].client_id, "entry_id": e.id, "action": punches[i].action}
+            for i, e in entries.items()
+        ])
+    crud.rebuild_attendance_days(db, [(e.user_id, e.clock_in.date()) for e in touched])
+    for i, entry in entries.items():
+        results[i] = schemas.PunchResult(
+            client_id=punches[i].client_id, user_id=punches[i].user_id, status="accepted", entry_id=entry.id
+        )
+
+
+def _naive_utc(value: datetime) -> datetime:
+    """Timestamps are stored as naive UTC, like datetime.utcnow()."""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
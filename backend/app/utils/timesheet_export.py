@@ -0,0 +1,139 @@
+"""Streaming timesheet export.
+
+`export_batches` reads time entries through a server-side cursor
+(`stream_results` + `yield_per`), so only one batch of rows is in memory at
+a time however long the date range is. The encoders turn each batch into a
+chunk of CSV, NDJSON or Parquet bytes as soon as it arrives, so the HTTP
+response starts with the first batch rather than after the last.
+
+The generators open their own session: a streamed response outlives the
+request's `get_db` session.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Iterator, List, Sequence
+
+from sqlalchemy import select
+
+from .. import models
+from ..config import settings
+from ..db import SessionLocal
+
+COLUMNS = [
+    "entry_id", "user_id", "email", "full_name",
+    "clock_in", "clock_out", "duration_seconds", "latitude", "longitude", "auto_closed",
+]
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def export_batches(
+    company_id: int,
+    start: datetime,
+    end: datetime,
+    batch_size: int = settings.EXPORT_BATCH_SIZE,
+) -> Iterator[List[Sequence]]:
+    """Rows of `COLUMNS` for entries clocked in within [start, end), in batches."""
+    TimeEntry, User = models.TimeEntry, models.User
+    query = (
+        select(
+            TimeEntry.id, TimeEntry.user_id, User.email, User.full_name,
+            TimeEntry.clock_in, TimeEntry.clock_out, TimeEntry.latitude, TimeEntry.longitude, TimeEntry.auto_closed,
+        )
+        .join(User, User.id == TimeEntry.user_id)
+        .where(User.company_id == company_id, TimeEntry.clock_in >= start, TimeEntry.clock_in < end)
+        .order_by(TimeEntry.clock_in, TimeEntry.id)
+        .execution_options(stream_results=True, yield_per=batch_size)
+    )
+    with SessionLocal() as db:
+        for partition in db.execute(query).partitions():
+            yield [
+                (
+                    entry_id, user_id, email, full_name, clock_in, clock_out,
+                    (clock_out - clock_in).total_seconds() if clock_out and clock_in else None,
+                    latitude, longitude, auto_closed,
+                )
+                for entry_id, user_id, email, full_name, clock_in, clock_out, latitude, longitude, auto_closed in partition
+            ]
+
+
+def _isoformat(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def csv_chunks(batches: Iterator[List[Sequence]]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    yield buffer.getvalue()
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_isoformat(v) for v in row] for row in batch)
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(batches: Iterator[List[Sequence]]) -> Iterator[str]:
+    for batch in batches:
+        yield "".join(json.dumps(dict(zip(COLUMNS, map(_isoformat, row)))) + "\n" for row in batch)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands back what was written since the last drain."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def parquet_chunks(batches: Iterator[List[Sequence]]) -> Iterator[bytes]:
+    """One Parquet row group per batch; raises ImportError without pyarrow."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("entry_id", pa.int64()),
+        ("user_id", pa.int64()),
+        ("email", pa.string()),
+        ("full_name", pa.string()),
+        ("clock_in", pa.timestamp("us")),
+        ("clock_out", pa.timestamp("us")),
+        ("duration_seconds", pa.float64()),
+        ("latitude", pa.float64()),
+        ("longitude", pa.float64()),
+        ("auto_closed", pa.bool_()),
+    ])
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in batches:
+            columns = list(zip(*batch))
+            writer.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+ENCODERS = {"csv": csv_chunks, "ndjson": ndjson_chunks, "parquet": parquet_chunks}
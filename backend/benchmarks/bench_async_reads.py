@@ -0,0 +1,115 @@
+"""Benchmark: hot read routes on sync sessions vs the async engine.
+
+Seeds a throwaway SQLite database with CLIENTS users (tasks, projects and a
+chat room), then has CLIENTS concurrent clients each cycle through
+/users/me, /tasks, /projects and /chat/history REQUESTS times, in-process
+over ASGI. It runs the sync routes (threadpool + `SessionLocal`) with the
+default pool and with one sized to CLIENTS, then DB_ASYNC_READS=1 (event
+loop + `AsyncSessionLocal`) with the default pool, each in a fresh
+interpreter because routes and pools are set up at import time. Requests
+that fail (e.g. pool checkout timeouts) are counted, not timed.
+
+    cd backend && python -m benchmarks.bench_async_reads [CLIENTS] [REQUESTS]
+"""
+
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+PATHS = ["/api/v1/users/me", "/api/v1/tasks/", "/api/v1/projects/", "/api/v1/chat/history?room=bench"]
+
+
+def seed(url: str, users: int):
+    from app import models
+
+    engine = create_engine(url)
+    models.Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as db:
+        company = models.Company(name="Bench Co")
+        db.add(company)
+        db.flush()
+        db.execute(insert(models.User), [
+            {"id": i, "email": f"user{i}@bench.example.com", "hashed_password": "x", "full_name": f"User {i}", "company_id": company.id}
+            for i in range(1, users + 1)
+        ])
+        db.execute(insert(models.Project), [{"id": i, "name": f"Project {i}", "company_id": company.id} for i in range(1, 21)])
+        db.execute(insert(models.Task), [
+            {"title": f"Task {i}.{j}", "project_id": 1 + (i + j) % 20, "assignee_id": i, "creator_id": i}
+            for i in range(1, users + 1) for j in range(5)
+        ])
+        db.execute(insert(models.Message), [
+            {"room": "bench", "sender_id": 1 + i % users, "content": f"message {i}"} for i in range(500)
+        ])
+        db.commit()
+    engine.dispose()
+
+
+async def run_clients(clients: int, requests: int):
+    import httpx
+
+    from app.api.v1.auth import create_access_token
+    from app.main import app
+
+    latencies, errors = [], 0
+
+    async def client(user_id: int, http: httpx.AsyncClient):
+        nonlocal errors
+        headers = {"Authorization": f"Bearer {create_access_token({'sub': str(user_id)})}"}
+        for i in range(requests):
+            for path in PATHS:
+                started = time.perf_counter()
+                try:
+                    ok = (await http.get(path, headers=headers)).status_code == 200
+                except Exception:
+                    ok = False  # e.g. QueuePool timeout, raised through the ASGI transport
+                if ok:
+                    latencies.append((time.perf_counter() - started) * 1000)
+                else:
+                    errors += 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(client(i, http) for i in range(1, clients + 1)))
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+    return len(latencies) / elapsed, statistics.median(latencies) if latencies else 0.0, p95, errors
+
+
+def main():
+    if sys.argv[1:2] == ["--worker"]:
+        throughput, p50, p95, errors = asyncio.run(run_clients(int(sys.argv[2]), int(sys.argv[3])))
+        print(f"{throughput:.1f} {p50:.1f} {p95:.1f} {errors}")
+        return
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        seed(url, clients)
+        print(f"{clients} concurrent clients x {requests} rounds of {len(PATHS)} routes")
+        modes = [
+            ("sync, default pool", {"DB_ASYNC_READS": "0"}),
+            ("sync, pool = clients", {"DB_ASYNC_READS": "0", "DB_POOL_SIZE": str(clients)}),
+            ("async, default pool", {"DB_ASYNC_READS": "1"}),
+        ]
+        for label, overrides in modes:
+            # A short checkout timeout keeps a starved pool from stalling the run
+            env = dict(os.environ, DATABASE_URL=url, DB_POOL_TIMEOUT="5", **overrides)
+            out = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_async_reads", "--worker", str(clients), str(requests)],
+                env=env, check=True, capture_output=True, text=True,
+            ).stdout.split()
+            throughput, p50, p95, errors = map(float, out[-4:])
+            print(f"{label:22s} {throughput:8.1f} req/s   p50 {p50:8.1f} ms   p95 {p95:8.1f} ms   errors {int(errors)}")
+
+
+if __name__ == "__main__":
+    main()
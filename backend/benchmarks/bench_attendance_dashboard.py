@@ -0,0 +1,91 @@
+"""Benchmark: attendance dashboard, N+1 loop vs the rollup query.
+
+Seeds a throwaway SQLite database with USERS users (3 punches each today,
+rolled up into attendance_days) and reports p50/p95 latency of both
+strategies.
+
+    cd backend && python -m benchmarks.bench_attendance_dashboard [USERS] [RUNS]
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, models
+
+
+def seed(db, users: int):
+    today = datetime.combine(date.today(), datetime.min.time())
+    company = models.Company(name="Bench Co")
+    db.add(company)
+    db.flush()
+    db.execute(insert(models.User), [
+        {"id": i, "email": f"user{i}@bench.test", "hashed_password": "x", "full_name": f"User {i}", "company_id": company.id}
+        for i in range(1, users + 1)
+    ])
+    entries = []
+    for i in range(1, users + 1):
+        entries.append({"user_id": i, "clock_in": today + timedelta(hours=1), "clock_out": today + timedelta(hours=3)})
+        entries.append({"user_id": i, "clock_in": today + timedelta(hours=4), "clock_out": today + timedelta(hours=6)})
+        entries.append({"user_id": i, "clock_in": today + timedelta(hours=7), "clock_out": None if i % 2 else today + timedelta(hours=8)})
+    db.execute(insert(models.TimeEntry), entries)
+    db.commit()
+    crud.backfill_attendance_days(db)
+    return company.id
+
+
+def naive(db, company_id):
+    """The pre-aggregation dashboard: one TimeEntry query per user."""
+    today_start = datetime.combine(date.today(), datetime.min.time())
+    stats = []
+    for user in db.query(models.User).filter(models.User.company_id == company_id).all():
+        entries = db.query(models.TimeEntry).filter(
+            models.TimeEntry.user_id == user.id,
+            models.TimeEntry.clock_in >= today_start
+        ).order_by(models.TimeEntry.clock_in.asc()).all()
+        total = 0.0
+        for entry in entries:
+            end = entry.clock_out or datetime.utcnow()
+            total += (end - entry.clock_in).total_seconds()
+        stats.append((user.id, total))
+    return stats
+
+
+def rollup(db, company_id):
+    today_start = datetime.combine(date.today(), datetime.min.time())
+    return crud.get_attendance_stats(db, company_id, since=today_start, now=datetime.utcnow())
+
+
+def measure(fn, db, company_id, runs):
+    samples = []
+    for _ in range(runs):
+        db.expire_all()
+        started = time.perf_counter()
+        fn(db, company_id)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    p95 = samples[min(len(samples) - 1, int(round(0.95 * len(samples))) - 1)]
+    return statistics.median(samples), p95
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        models.Base.metadata.create_all(bind=engine)
+        with sessionmaker(bind=engine)() as db:
+            company_id = seed(db, users)
+            for name, fn in (("n+1 loop", naive), ("rollup query", rollup)):
+                p50, p95 = measure(fn, db, company_id, runs)
+                print(f"{name:>14}: users={users} p50={p50:8.1f} ms  p95={p95:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
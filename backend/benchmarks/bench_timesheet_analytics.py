@@ -0,0 +1,93 @@
+"""Benchmark: timesheet analytics, per-entry Python loop vs NumPy columns.
+
+Seeds a throwaway SQLite database with USERS users punching twice a day on
+every weekday of 2023 and reports p50/p95 latency of the weekly summary
+(load + aggregate) for both strategies.
+
+    cd backend && python -m benchmarks.bench_timesheet_analytics [USERS] [RUNS]
+"""
+
+import os
+import sys
+import tempfile
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from app import models
+from app.utils.timesheet_analytics import load_columns, summarize
+
+from .bench_attendance_dashboard import measure
+
+START, END = datetime(2023, 1, 1), datetime(2024, 1, 1)
+
+
+def seed(db, users: int):
+    company = models.Company(name="Bench Co")
+    db.add(company)
+    db.flush()
+    db.execute(insert(models.User), [
+        {"id": i, "email": f"user{i}@bench.test", "hashed_password": "x", "full_name": f"User {i}", "company_id": company.id}
+        for i in range(1, users + 1)
+    ])
+    day = START
+    while day < END:
+        if day.weekday() < 5:
+            entries = []
+            for i in range(1, users + 1):
+                arrive = day + timedelta(hours=8, minutes=(i * 7 + day.day) % 90)
+                entries.append({"user_id": i, "clock_in": arrive, "clock_out": arrive + timedelta(hours=4)})
+                entries.append({"user_id": i, "clock_in": arrive + timedelta(hours=5), "clock_out": arrive + timedelta(hours=9, minutes=i % 60)})
+            db.execute(insert(models.TimeEntry), entries)
+        day += timedelta(days=1)
+    db.commit()
+    return company.id
+
+
+def naive(db, company_id):
+    """Load ORM rows and aggregate them one entry at a time."""
+    entries = db.query(models.TimeEntry).join(models.User).filter(
+        models.User.company_id == company_id,
+        models.TimeEntry.clock_in >= START,
+        models.TimeEntry.clock_in < END,
+    ).all()
+    day_hours = defaultdict(float)
+    first_arrival = {}
+    for entry in entries:
+        key = (entry.user_id, entry.clock_in.date())
+        if entry.clock_out:
+            day_hours[key] += (entry.clock_out - entry.clock_in).total_seconds() / 3600
+        arrival = entry.clock_in.time()
+        if key not in first_arrival or arrival < first_arrival[key]:
+            first_arrival[key] = arrival
+    weeks = defaultdict(lambda: [0.0, 0.0, 0, 0])
+    for (user_id, day), hours in day_hours.items():
+        week = weeks[(user_id, day - timedelta(days=day.weekday()))]
+        week[0] += hours
+        week[1] += max(hours - 8.0, 0.0)
+        week[2] += first_arrival[(user_id, day)] > time(9, 0)
+        week[3] += 1
+    return weeks
+
+
+def vectorized(db, company_id):
+    return summarize(load_columns(db, company_id, START, END), period="week")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        models.Base.metadata.create_all(bind=engine)
+        with sessionmaker(bind=engine)() as db:
+            company_id = seed(db, users)
+            for name, fn in (("python loop", naive), ("numpy columns", vectorized)):
+                p50, p95 = measure(fn, db, company_id, runs)
+                print(f"{name:>14}: users={users} p50={p50:8.1f} ms  p95={p95:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
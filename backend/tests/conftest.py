@@ -0,0 +1,31 @@
+"""Give the test session its own database, migrated to the latest revision.
+
+`DATABASE_URL` is pointed at a fresh SQLite file under pytest's temporary
+directory before anything imports `app`. The engines read the URL once, at
+import, so the suite never touches `./test_v3.db` or whatever database the
+environment points at, and every run starts from an empty schema.
+"""
+
+import os
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+
+ALEMBIC_INI = Path(__file__).resolve().parents[1] / "alembic.ini"
+
+
+def alembic_config(url: str) -> Config:
+    config = Config(str(ALEMBIC_INI))
+    config.attributes["url"] = url
+    config.attributes["configure_logger"] = False
+    return config
+
+
+def pytest_sessionstart(session):
+    # Runs before test modules are collected, i.e. before they import app
+    database = session.config._tmp_path_factory.mktemp("db") / "test.db"
+    os.environ["DATABASE_URL"] = f"sqlite:///{database}"
+    from app.config import settings
+
+    command.upgrade(alembic_config(settings.DATABASE_URL), "head")
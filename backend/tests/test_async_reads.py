@@ -0,0 +1,57 @@
+"""The async variants of the hot read routes answer like the sync ones."""
+
+import uuid
+
+from typing import List
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app import deps, models, schemas
+from app.api.v1 import chat, projects, tasks, users
+from app.api.v1.auth import create_access_token
+from app.db import SessionLocal
+from app.main import app
+
+async_app = FastAPI()
+async_app.get("/me", response_model=schemas.UserRead)(users.read_users_me_async)
+async_app.get("/tasks", response_model=List[schemas.TaskRead])(tasks.list_tasks_async)
+async_app.get("/projects", response_model=List[schemas.ProjectRead])(projects.list_projects_async)
+async_app.get("/history", response_model=List[schemas.MessageRead])(chat.get_chat_history_async)
+
+
+def test_async_read_routes_match_sync_routes():
+    tag = uuid.uuid4().hex[:8]
+    with SessionLocal() as db:
+        company = models.Company(name=f"Async {tag}")
+        db.add(company)
+        db.flush()
+        user = models.User(email=f"async-{tag}@example.com", hashed_password="x", full_name="Async", company_id=company.id)
+        db.add(user)
+        db.flush()
+        project = models.Project(name=f"P {tag}", company_id=company.id)
+        db.add(project)
+        db.flush()
+        db.add_all([
+            models.Task(title=f"T{i}", project_id=project.id, assignee_id=user.id, creator_id=user.id) for i in range(3)
+        ])
+        db.add_all([models.Message(room=f"async-{tag}", sender_id=user.id, content=f"m{i}") for i in range(5)])
+        db.commit()
+        user_id = user.id
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': str(user_id)})}"}
+    deps.principal_cache.clear()
+
+    sync_client, async_client = TestClient(app), TestClient(async_app)
+    pairs = [
+        ("/api/v1/users/me", "/me"),
+        ("/api/v1/tasks/?filter_by=created", "/tasks?filter_by=created"),
+        ("/api/v1/projects/", "/projects"),
+        ("/api/v1/projects/?filter_by=my", "/projects?filter_by=my"),
+        (f"/api/v1/chat/history?room=async-{tag}&limit=3", f"/history?room=async-{tag}&limit=3"),
+    ]
+    for sync_path, async_path in pairs:
+        expected = sync_client.get(sync_path, headers=headers)
+        got = async_client.get(async_path, headers=headers)
+        assert expected.status_code == got.status_code == 200, (async_path, got.text)
+        assert got.json() == expected.json(), async_path
+    assert async_client.get("/me").status_code == 401
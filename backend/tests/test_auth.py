@@ -20,3 +20,372 @@ def test_login(test_user):
     data = response.json()
     assert "access_token" in data
     assert data["token_type"] == "bearer"
+
+def test_principal_cache_skips_lookups_and_follows_user_updates():
+    import uuid
+    from sqlalchemy import event
+    from app import deps, models
+    from app.api.v1.auth import create_access_token
+    from app.db import SessionLocal, engine
+
+    with SessionLocal() as db:
+        user = models.User(email=f"cache-{uuid.uuid4().hex[:8]}@example.com", hashed_password="x", full_name="Before", role="hr")
+        db.add(user)
+        db.commit()
+        user_id = user.id
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': str(user_id)})}"}
+    deps.principal_cache.clear()
+
+    assert client.get("/api/v1/users/me", headers=headers).json()["full_name"] == "Before"
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        principal = deps.get_current_principal(headers["Authorization"].split()[1], db=None)
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    assert principal.id == user_id and principal.role == "hr" and statements == []
+
+    # The ORM variant is built from the cache too; other columns load on first use
+    with SessionLocal() as db:
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            current = deps.get_current_user(headers["Authorization"].split()[1], db=db)
+            assert (current.id, current.role) == (user_id, "hr") and statements == []
+            assert current.full_name == "Before" and len(statements) == 1
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+
+    assert client.put("/api/v1/users/me", headers=headers, json={"full_name": "After"}).status_code == 200
+    assert deps.principal_cache.get(headers["Authorization"].split()[1]) is None
+
+    with SessionLocal() as db:
+        db.get(models.User, user_id).is_active = False
+        db.commit()
+    assert client.get("/api/v1/users/me", headers=headers).status_code == 403
+
+def test_login_rehashes_outdated_argon2_parameters():
+    import uuid
+    from passlib.context import CryptContext
+    from app import models
+    from app.db import SessionLocal
+
+    email = f"rehash-{uuid.uuid4().hex[:8]}@example.com"
+    old_hash = CryptContext(schemes=["argon2"], argon2__rounds=2, argon2__memory_cost=8192).hash("secret123")
+    with SessionLocal() as db:
+        db.add(models.User(email=email, hashed_password=old_hash))
+        db.commit()
+
+    response = client.post("/api/v1/auth/login", data={"username": email, "password": "secret123"})
+    assert response.status_code == 200, response.text
+    with SessionLocal() as db:
+        new_hash = db.query(models.User).filter(models.User.email == email).one().hashed_password
+    assert new_hash != old_hash and "m=65536,t=3" in new_hash
+    assert client.post("/api/v1/auth/login", data={"username": email, "password": "wrong"}).status_code == 401
+
+
+def test_login_is_rejected_with_429_when_hashing_pool_is_saturated(monkeypatch):
+    import threading
+    import time
+    from app.api.v1 import auth
+    from app.utils.passwords import HasherBusy, PasswordHasher
+
+    hasher = PasswordHasher(max_workers=1, max_queue=0, memory_cost=8192)
+    release = threading.Event()
+    busy = threading.Thread(target=hasher._run, args=(None, release.wait))
+    busy.start()
+    try:
+        while hasher.stats["in_flight"] == 0:
+            time.sleep(0.001)
+        with pytest.raises(HasherBusy):
+            hasher.hash("x")
+        monkeypatch.setattr(auth, "password_hasher", hasher)
+        response = client.post("/api/v1/auth/login", data={"username": "nobody@example.com", "password": "x"})
+        assert response.status_code == 429
+        assert int(response.headers["retry-after"]) >= 1
+    finally:
+        release.set()
+        busy.join()
+    assert hasher.stats["rejected"] == 2
+    assert hasher.verify("x", hasher.hash("x"))
+
+def test_unknown_email_dummy_hash_is_made_on_the_hashing_pool():
+    import threading
+    from app.utils.passwords import PasswordHasher
+
+    hasher = PasswordHasher(max_workers=2, max_queue=4, queue_timeout=5, memory_cost=8192)
+    threads = []
+    hash_dummy = hasher.context.hash
+    hasher.context.hash = lambda secret: threads.append(threading.current_thread().name) or hash_dummy(secret)
+    logins = [threading.Thread(target=hasher.verify_and_update, args=("x", None)) for _ in range(4)]
+    for login in logins:
+        login.start()
+    for login in logins:
+        login.join()
+    assert len(threads) == 1 and threads[0].startswith("argon2")
+    assert hasher.stats["verified"] == 4
+    hasher.shutdown()
+
+def test_otp_codes_replace_each_other_and_are_single_use(monkeypatch):
+    import uuid
+    from app.api.v1 import auth
+    from app.utils.passwords import HasherBusy
+
+    sent = []
+    original = auth.generate_code
+    auth.generate_code = lambda: sent.append(f"{len(sent) + 1:06d}") or sent[-1]
+    email = f"otp-{uuid.uuid4().hex[:8]}@example.com"
+    try:
+        assert client.post("/api/v1/auth/send-otp", json={"email": email}).status_code == 200
+        assert client.post("/api/v1/auth/send-otp", json={"email": email}).status_code == 200
+    finally:
+        auth.generate_code = original
+    payload = {"email": email, "password": "secret123", "full_name": "Otp User", "role": "employee"}
+
+    # The first code was invalidated when the second was issued
+    assert client.post("/api/v1/auth/register", json={**payload, "code": sent[0]}).status_code == 400
+    # A busy hasher answers 429 without using up the code, so the retry works
+    def busy_hash(password):
+        raise HasherBusy(retry_after=1)
+
+    with monkeypatch.context() as busy:
+        busy.setattr(auth, "get_password_hash", busy_hash)
+        assert client.post("/api/v1/auth/register", json={**payload, "code": sent[1]}).status_code == 429
+    assert client.post("/api/v1/auth/register", json={**payload, "code": sent[1]}).status_code == 200
+    assert not auth.otp_store.verify(email, sent[1])
+
+def test_otp_store_backends_expire_and_purge():
+    import time
+    from datetime import datetime, timedelta
+    from app import models
+    from app.db import SessionLocal
+    from app.utils.otp_store import MemoryOTPStore, RedisOTPStore, SQLOTPStore
+
+    memory = MemoryOTPStore(ttl=0.05)
+    memory.issue("a@example.com", "111111")
+    assert not memory.verify("a@example.com", "222222")
+    assert memory.verify("a@example.com", "111111")
+    memory.issue("b@example.com", "333333")
+    time.sleep(0.06)
+    assert not memory.verify("b@example.com", "333333")
+    assert memory.purge() == 1
+
+    fakeredis = pytest.importorskip("fakeredis")
+    redis_store = RedisOTPStore(client=fakeredis.FakeRedis(decode_responses=True), ttl=60)
+    redis_store.issue("a@example.com", "111111")
+    redis_store.issue("a@example.com", "444444")
+    assert redis_store._redis.ttl("otp:a@example.com") > 0
+    assert not redis_store.verify("a@example.com", "111111")
+    assert redis_store.verify("a@example.com", "444444")
+    assert not redis_store.verify("a@example.com", "444444")
+
+    sql = SQLOTPStore(ttl=60)
+    sql.issue("purge@example.com", "555555")
+    with SessionLocal() as db:
+        db.add(models.VerificationCode(
+            email="purge@example.com", code="666666", expires_at=datetime.utcnow() - timedelta(seconds=1)
+        ))
+        db.commit()
+    assert not sql.verify("purge@example.com", "666666")
+    assert sql.purge() >= 1
+    with SessionLocal() as db:
+        left = db.query(models.VerificationCode).filter_by(email="purge@example.com").all()
+    assert [c.code for c in left] == ["555555"]
+    assert sql.metrics()["rejected"] == 1
+
+@pytest.fixture
+def smtp_server():
+    """A local SMTP server that accepts everything except RCPT temp* (451) and bad* (550)."""
+    import socketserver
+    import threading
+
+    class Handler(socketserver.StreamRequestHandler):
+        def reply(self, line):
+            self.wfile.write(line.encode() + b"\r\n")
+
+        def handle(self):
+            self.server.connections += 1
+            self.reply("220 test ESMTP")
+            recipients = []
+            for raw in self.rfile:
+                command = raw.decode().strip()
+                verb = command.split(" ", 1)[0].upper()
+                if verb in ("EHLO", "HELO", "NOOP", "RSET"):
+                    self.reply("250 OK")
+                elif verb == "MAIL":
+                    recipients = []
+                    self.reply("250 OK")
+                elif verb == "RCPT":
+                    address = command.split(":", 1)[1].strip("<> ")
+                    if address.startswith("temp"):
+                        self.reply("451 Try again later")
+                    elif address.startswith("bad"):
+                        self.reply("550 No such user")
+                    else:
+                        recipients.append(address)
+                        self.reply("250 OK")
+                elif verb == "DATA":
+                    self.reply("354 Go ahead")
+                    while self.rfile.readline() not in (b".\r\n", b""):
+                        pass
+                    self.server.delivered.extend(recipients)
+                    self.reply("250 Queued")
+                elif verb == "QUIT":
+                    self.reply("221 Bye")
+                    return
+                else:
+                    self.reply("502 Not implemented")
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.delivered = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_email_outbox_reuses_pooled_connections_and_retries(smtp_server):
+    import uuid
+    from app import models
+    from app.db import SessionLocal
+    from app.utils.email_outbox import EmailOutbox, SMTPConnectionPool
+
+    pool = SMTPConnectionPool("127.0.0.1", smtp_server.server_address[1], size=1, starttls=False, timeout=5)
+    outbox = EmailOutbox(pool, batch_size=4, retry_base=60)
+    tag = uuid.uuid4().hex[:8]
+    with SessionLocal() as db:
+        ok = [outbox.enqueue(db, f"ok{i}-{tag}@example.com", "Hi", "Body").id for i in range(6)]
+        temp = outbox.enqueue(db, f"temp-{tag}@example.com", "Hi", "Body").id
+        bad = outbox.enqueue(db, f"bad-{tag}@example.com", "Hi", "Body").id
+        db.commit()
+
+    outbox.drain()
+    outbox.drain()  # Nothing due any more: the retry waits retry_base seconds
+    with SessionLocal() as db:
+        rows = {m.id: m for m in db.query(models.OutboxEmail).filter(models.OutboxEmail.id.in_(ok + [temp, bad]))}
+    assert all(rows[i].status == "sent" and rows[i].sent_at for i in ok)
+    assert rows[temp].status == "pending" and rows[temp].attempts == 1 and "451" in rows[temp].last_error
+    assert rows[bad].status == "failed" and "550" in rows[bad].last_error
+    assert {f"ok{i}-{tag}@example.com" for i in range(6)} <= set(smtp_server.delivered)
+    # Several batches, one SMTP session
+    assert smtp_server.connections == 1 and pool.stats["opened"] == 1
+
+    metrics = outbox.metrics()
+    assert metrics["sent"] >= 6 and metrics["retried"] >= 1 and metrics["failed"] >= 1
+    assert metrics["pending"] >= 1 and metrics["pool"]["reused"] >= 1
+    pool.close()
+
+def test_email_outbox_records_unexpected_send_errors_and_joins_the_callers_transaction(smtp_server, monkeypatch):
+    import uuid
+    from app import models
+    from app.db import SessionLocal
+    from app.utils import email_outbox as outbox_module
+    from app.utils.email_outbox import EmailOutbox, SMTPConnectionPool
+
+    tag = uuid.uuid4().hex[:8]
+    build = outbox_module.build_message
+
+    def build_message(to_email, *args):
+        if to_email.startswith("broken"):
+            raise UnicodeEncodeError("ascii", to_email, 0, 1, "not encodable")
+        return build(to_email, *args)
+
+    monkeypatch.setattr(outbox_module, "build_message", build_message)
+    pool = SMTPConnectionPool("127.0.0.1", smtp_server.server_address[1], size=1, starttls=False, timeout=5)
+    outbox = EmailOutbox(pool, max_attempts=2, retry_base=0)
+    with SessionLocal() as db:
+        outbox.enqueue(db, f"dropped-{tag}@example.com", "Hi", "Body")
+        db.rollback()
+        ok = outbox.enqueue(db, f"ok-{tag}@example.com", "Hi", "Body").id
+        broken = outbox.enqueue(db, f"broken-{tag}@example.com", "Hi", "Body").id
+        db.commit()
+    assert outbox.stats["enqueued"] == 2
+
+    outbox.drain()
+    outbox.drain()
+    with SessionLocal() as db:
+        rows = {m.id: m for m in db.query(models.OutboxEmail).filter(models.OutboxEmail.id.in_([ok, broken]))}
+        assert not db.query(models.OutboxEmail).filter_by(to_email=f"dropped-{tag}@example.com").count()
+    # The bad mail used up its attempts rather than staying claimed; the good one went once
+    assert rows[ok].status == "sent"
+    assert rows[broken].status == "failed" and rows[broken].attempts == 2
+    assert "UnicodeEncodeError" in rows[broken].last_error
+    assert smtp_server.delivered.count(f"ok-{tag}@example.com") == 1
+    pool.close()
+
+def test_repeat_login_alerts_are_digested_and_otp_mail_goes_first():
+    import uuid
+    from app import models
+    from app.api.v1.auth import get_password_hash
+    from app.db import SessionLocal
+    from app.utils.email_outbox import EmailOutbox
+    from app.utils.notifications import notifications
+
+    email = f"alerts-{uuid.uuid4().hex[:8]}@example.com"
+    with SessionLocal() as db:
+        db.add(models.User(email=email, hashed_password=get_password_hash("secret123")))
+        db.commit()
+    EmailOutbox(None).drain()  # Start from an empty queue (logs whatever earlier tests queued)
+
+    for _ in range(3):
+        assert client.post("/api/v1/auth/login", data={"username": email, "password": "secret123"}).status_code == 200
+    with SessionLocal() as db:
+        statuses = [m.status for m in db.query(models.OutboxEmail).filter_by(to_email=email).order_by(models.OutboxEmail.id)]
+    assert statuses == ["pending", "held", "held"]
+
+    assert notifications.flush_digests() >= 1
+    with SessionLocal() as db:
+        mails = db.query(models.OutboxEmail).filter_by(to_email=email).order_by(models.OutboxEmail.id).all()
+    assert [m.status for m in mails] == ["pending", "digested", "digested", "pending"]
+    assert mails[-1].kind == "digest" and "New Login Alert x2" in mails[-1].body
+
+    # An OTP queued last is still claimed before the alert and the digest
+    assert client.post("/api/v1/auth/send-otp", json={"email": f"lane-{uuid.uuid4().hex[:8]}@example.com"}).status_code == 200
+    first = EmailOutbox(None, batch_size=1)._claim(mails[-1].next_attempt_at.replace(year=2100))
+    assert first[0][1].startswith("lane-")
+
+def test_racing_digest_flushes_queue_one_digest():
+    import uuid
+    from sqlalchemy import event
+    from app import models
+    from app.db import SessionLocal
+    from app.utils.email_outbox import EmailOutbox
+    from app.utils.notifications import NotificationCoalescer
+
+    email = f"race-{uuid.uuid4().hex[:8]}@example.com"
+    outbox = EmailOutbox(None)
+    with SessionLocal() as db:
+        for i in range(2):
+            outbox.enqueue(db, email, f"Notice {i}", "Body", held=True)
+        db.commit()
+
+    other = NotificationCoalescer(outbox)
+
+    def racing_session():
+        db = SessionLocal()
+        raced = []
+
+        @event.listens_for(db, "do_orm_execute")
+        def other_worker_first(state):
+            # Another worker digests the same held rows just before our UPDATE
+            if state.is_update and not raced:
+                raced.append(other.flush_digests())
+
+        return db
+
+    assert NotificationCoalescer(outbox, session_factory=racing_session).flush_digests() == 0
+    with SessionLocal() as db:
+        digests = db.query(models.OutboxEmail).filter_by(to_email=email, kind="digest").all()
+    assert len(digests) == 1 and "Notice 0" in digests[0].body and "Notice 1" in digests[0].body
+
+def test_email_health_is_for_admins_only():
+    from app import deps
+
+    assert client.get("/health/email").status_code == 401
+    app.dependency_overrides[deps.get_current_principal] = lambda: deps.Principal(1, "ops@example.com", "admin", None, True, False)
+    try:
+        body = client.get("/health/email").json()
+    finally:
+        app.dependency_overrides.pop(deps.get_current_principal, None)
+    assert "pending" in body and "notifications" in body
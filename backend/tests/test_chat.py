@@ -0,0 +1,365 @@
+"""Tests for the chat connection manager and WebSocket endpoint."""
+
+import asyncio
+import json
+import uuid
+from datetime import datetime
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app import crud, deps, models, schemas
+from app.api.v1.chat import ConnectionManager, RedisBroadcast
+from app.db import SessionLocal
+from app.utils.chat_writer import MessageWriter
+from app.utils import message_search
+from app.utils.message_cache import RecentMessageCache
+
+client = TestClient(app)
+
+
+class FakeSocket:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.sent = []
+        self.closed = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        await asyncio.sleep(self.delay)
+        self.sent.append(message)
+
+    async def close(self, code: int = 1000):
+        self.closed = code
+
+
+def test_broadcast_is_scoped_to_room():
+    with client.websocket_connect("/api/v1/chat/ws?user_id=1&room=alpha") as alpha, \
+         client.websocket_connect("/api/v1/chat/ws?user_id=2&room=beta") as beta:
+        alpha.send_text("hello alpha")
+        assert alpha.receive_text() == "User 1: hello alpha"
+        beta.send_text("hello beta")
+        # Beta's first frame is its own message: alpha's never reached it
+        assert beta.receive_text() == "User 2: hello beta"
+        # ...and alpha's next frame is its sentinel, not beta's message
+        alpha.send_text("sentinel")
+        assert alpha.receive_text() == "User 1: sentinel"
+
+
+def test_slow_consumer_is_evicted():
+    async def scenario():
+        manager = ConnectionManager(queue_size=2, send_timeout=0.05)
+        fast, slow = FakeSocket(), FakeSocket(delay=1.0)
+        await manager.connect(fast, "general")
+        await manager.connect(slow, "general")
+        for i in range(5):
+            await manager.broadcast(f"msg {i}", "general")
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        return manager, fast, slow
+
+    manager, fast, slow = asyncio.run(scenario())
+    assert fast.sent == [f"msg {i}" for i in range(5)]
+    assert slow.closed == 1013
+    assert manager.room_size("general") == 1
+    assert manager.evicted == 1
+
+
+def test_redis_backend_fans_out_across_workers():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def scenario():
+        server = fakeredis.FakeServer()
+        workers = [
+            ConnectionManager(backend=RedisBroadcast(client=fakeredis.FakeAsyncRedis(server=server, decode_responses=True)))
+            for _ in range(2)
+        ]
+        a, b, other = FakeSocket(), FakeSocket(), FakeSocket()
+        await workers[0].connect(a, "general")
+        await workers[1].connect(b, "general")
+        await workers[1].connect(other, "random")
+        await workers[0].broadcast("hello from worker 0", "general")
+        await asyncio.sleep(0.2)
+        for worker in workers:
+            await worker.shutdown()
+        return a, b, other
+
+    a, b, other = asyncio.run(scenario())
+    assert a.sent == ["hello from worker 0"]
+    assert b.sent == ["hello from worker 0"]
+    assert other.sent == []
+
+
+def test_writer_group_commits_and_drains_on_close():
+    room = f"writer-test-{uuid.uuid4().hex[:8]}"
+    writer = MessageWriter(batch_size=10, flush_interval=60, max_pending=100)
+    persisted = []
+    writer.listeners.append(persisted.extend)
+
+    async def scenario():
+        for i in range(25):
+            await writer.enqueue(f"message {i}", room, 1)
+        await asyncio.sleep(0.2)
+        await writer.close()
+
+    asyncio.run(scenario())
+    metrics = writer.metrics()
+    assert metrics["messages_written"] == 25
+    assert metrics["pending"] == 0
+    assert metrics["max_batch_size"] >= 10
+    assert [m.content for m in persisted] == [f"message {i}" for i in range(25)]
+    with SessionLocal() as db:
+        assert db.query(models.Message).filter(models.Message.room == room).count() >= 25
+
+
+def test_writer_isolates_a_bad_row_and_dead_letters_it(caplog):
+    room = f"writer-poison-{uuid.uuid4().hex[:8]}"
+    writer = MessageWriter(batch_size=100, flush_interval=60, max_pending=100, max_attempts=2)
+    persisted = []
+    writer.listeners.append(persisted.extend)
+
+    async def scenario():
+        for i in range(3):
+            await writer.enqueue(f"before {i}", room, 1)
+        await writer.enqueue(None, room, 1)  # Violates messages.content NOT NULL
+        for i in range(3):
+            await writer.enqueue(f"after {i}", room, 1)
+        first = await writer.flush()
+        await writer.enqueue("next", room, 1)
+        second = await writer.flush()
+        third = await writer.flush()
+        await writer.close()
+        return first, second, third
+
+    # Every write goes through the async session; the bad row fails its batch,
+    # then alone, and is dropped on its second attempt while the rest is saved.
+    assert asyncio.run(scenario()) == (False, True, True)
+    assert [m.content for m in persisted] == [f"before {i}" for i in range(3)] + [f"after {i}" for i in range(3)] + ["next"]
+    metrics = writer.metrics()
+    assert metrics["pending"] == 0 and metrics["dead_lettered"] == 1 and metrics["failed_flushes"] == 2
+    assert writer.dead_letters[0]["content"] is None and "NOT NULL" in writer.dead_letters[0]["error"]
+    dropped = [r for r in caplog.records if "dropped a message" in r.getMessage()]
+    assert len(dropped) == 1 and dropped[0].exc_info  # Logged with its traceback
+    with SessionLocal() as db:
+        assert db.query(models.Message).filter(models.Message.room == room).count() == 7
+
+
+def test_writer_keeps_every_row_while_the_database_is_down(monkeypatch):
+    from sqlalchemy.exc import OperationalError
+
+    tag = uuid.uuid4().hex[:8]
+    writer = MessageWriter(batch_size=100, flush_interval=60, max_attempts=1)
+
+    async def down(rows):
+        raise OperationalError("INSERT", {}, Exception("database is locked"))
+
+    async def scenario():
+        for i in range(3):
+            await writer.enqueue(f"outage {i}", f"writer-outage-{tag}", 1)
+        monkeypatch.setattr(writer, "_write", down)
+        assert not await writer.flush()
+        assert not await writer.flush()
+        monkeypatch.undo()
+        assert await writer.flush()
+        await writer.close()
+
+    asyncio.run(scenario())
+    assert writer.metrics()["messages_written"] == 3 and writer.metrics()["dead_lettered"] == 0
+
+
+def test_history_returns_newest_page_with_keyset_cursors():
+    room = "history-test"
+    with SessionLocal() as db:
+        db.query(models.Message).filter(models.Message.room == room).delete()
+        db.commit()
+        ids = [m.id for m in crud.create_messages(db, [
+            {"content": f"m{i}", "room": room, "sender_id": 1, "timestamp": datetime(2024, 1, 1, 0, 0, i)}
+            for i in range(10)
+        ])]
+
+    newest = client.get("/api/v1/chat/history", params={"room": room, "limit": 3}).json()
+    assert [m["content"] for m in newest] == ["m7", "m8", "m9"]
+
+    older = client.get("/api/v1/chat/history", params={"room": room, "limit": 3, "before_id": newest[0]["id"]}).json()
+    assert [m["content"] for m in older] == ["m4", "m5", "m6"]
+
+    newer = client.get("/api/v1/chat/history", params={"room": room, "limit": 3, "after_id": ids[1]}).json()
+    assert [m["content"] for m in newer] == ["m2", "m3", "m4"]
+
+
+def test_history_cache_serves_tail_and_evicts_lru():
+    def message(i, room):
+        return schemas.MessageRead(id=i, content=f"m{i}", room=room, sender_id=1, timestamp=datetime(2024, 1, 1))
+
+    loads = []
+
+    def loader_for(room, count):
+        def load(n):
+            loads.append(room)
+            return [message(i, room) for i in range(count)][-n:]
+        return load
+
+    cache = RecentMessageCache(room_capacity=5, max_bytes=3000)
+    assert [m.id for m in cache.lookup("a", 3, loader_for("a", 20))] == [17, 18, 19]
+    assert [m.id for m in cache.lookup("a", 2, loader_for("a", 20), before_id=17)] == [15, 16]
+    assert cache.lookup("a", 3, loader_for("a", 20), before_id=16) is None
+    cache.append([message(20, "a")])
+    assert [m.id for m in cache.lookup("a", 2, loader_for("a", 20), after_id=18)] == [19, 20]
+    assert loads == ["a"]
+
+    # A small room fits entirely, so windows past its start are still hits.
+    assert [m.id for m in cache.lookup("b", 10, loader_for("b", 2))] == [0, 1]
+    cache.lookup("c", 1, loader_for("c", 5))
+    metrics = cache.metrics()
+    assert metrics["hits"] == 5 and metrics["misses"] == 1
+    assert metrics["evictions"] >= 1 and metrics["bytes"] <= 3000
+
+
+
+def test_history_cache_expires_when_other_workers_write():
+    from app.utils import message_cache
+
+    assert message_cache.default_ttl("memory://") == 0
+    assert message_cache.default_ttl("redis://redis:6379/0") == message_cache.MULTI_WORKER_TTL
+
+    table = [schemas.MessageRead(id=1, content="local", room="r", sender_id=1, timestamp=datetime(2024, 1, 1))]
+    cache = RecentMessageCache(ttl=message_cache.default_ttl("redis://redis:6379/0"))
+    load = lambda n: table[-n:]
+    assert [m.id for m in cache.lookup("r", 10, load)] == [1]
+    # Another worker persists a message: this worker's flush listener never sees it
+    table.append(table[0].copy(update={"id": 2, "content": "remote"}))
+    assert [m.id for m in cache.lookup("r", 10, load)] == [1]
+    cache._rooms["r"].loaded_at -= message_cache.MULTI_WORKER_TTL + 1
+    assert [m.id for m in cache.lookup("r", 10, load)] == [1, 2]
+
+
+@pytest.mark.parametrize("fts5", [True, False])
+def test_search_matches_all_terms_newest_first(monkeypatch, fts5):
+    monkeypatch.setattr(message_search, "uses_fts5", lambda bind: fts5)
+    room = f"search-test-{fts5}-{uuid.uuid4().hex[:8]}"
+    with SessionLocal() as db:
+        crud.create_messages(db, [
+            {"content": "Deploy the backend tonight", "room": room, "sender_id": 1},
+            {"content": "backend deploy finished", "room": room, "sender_id": 2},
+            {"content": "frontend deploy finished", "room": room, "sender_id": 2},
+            {"content": "backend deploy in another room", "room": f"{room}-other", "sender_id": 2},
+        ])
+
+    params = {"q": "deploy BACKEND", "room": room}
+    results = client.get("/api/v1/chat/search", params=params).json()
+    assert [m["content"] for m in results] == ["backend deploy finished", "Deploy the backend tonight"]
+
+    results = client.get("/api/v1/chat/search", params={**params, "sender_id": 1}).json()
+    assert [m["content"] for m in results] == ["Deploy the backend tonight"]
+
+
+def test_presence_pushes_diffs_and_reaps_silent_sockets():
+    async def scenario():
+        manager = ConnectionManager(heartbeat_interval=0.05, heartbeat_timeout=0.12)
+        watcher, alice, alice_tab, bob = FakeSocket(), FakeSocket(), FakeSocket(), FakeSocket()
+        await manager.connect(watcher, "general", user_id="1", presence=True)
+        await manager.connect(alice, "general", user_id="2")
+        await manager.connect(alice_tab, "general", user_id="2")
+        await manager.connect(bob, "general", user_id="3")
+        manager.disconnect(alice_tab, "general")
+        manager.disconnect(bob, "general")
+        await asyncio.sleep(0.01)
+        roster = manager.presence.roster("general")
+        # The watcher never answers pings, so the heartbeat reaps it.
+        await asyncio.sleep(0.3)
+        await manager.shutdown()
+        return manager, watcher, alice, roster
+
+    manager, watcher, alice, roster = asyncio.run(scenario())
+    assert roster == ["1", "2"]
+    diffs = [json.loads(m) for m in watcher.sent if json.loads(m)["type"] == "presence"]
+    assert [(d["joined"], d["left"]) for d in diffs] == [(["1"], []), (["2"], []), (["3"], []), ([], ["3"])]
+    assert any(json.loads(m)["type"] == "ping" for m in watcher.sent)
+    assert alice.sent == []
+    assert watcher.closed == 1001
+    assert manager.reaped == 1
+    assert manager.presence.roster("general") == ["2"]
+
+
+def test_presence_spans_workers_and_expires_with_a_dead_worker():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def scenario():
+        server = fakeredis.FakeServer()
+        workers = [
+            ConnectionManager(
+                backend=RedisBroadcast(client=fakeredis.FakeAsyncRedis(server=server, decode_responses=True)),
+                heartbeat_interval=0.05, heartbeat_timeout=0.2,
+            )
+            for _ in range(2)
+        ]
+        alice, bob, watcher = FakeSocket(), FakeSocket(), FakeSocket()
+        await workers[1].connect(alice, "general", user_id="2")
+        await workers[0].connect(watcher, "general", user_id="1", presence=True)
+
+        async def answer_pings():
+            while True:
+                workers[0].touch(watcher, "general")
+                await asyncio.sleep(0.02)
+
+        ponger = asyncio.create_task(answer_pings())
+        await asyncio.sleep(0.1)
+        rosters = [w.roster("general") for w in workers]
+        await workers[1].connect(bob, "general", user_id="3")
+        await asyncio.sleep(0.1)
+        workers[1].disconnect(bob, "general")
+        await asyncio.sleep(0.1)
+        # Worker 1 dies without a word: its users expire after heartbeat_timeout
+        workers[1]._heartbeat.cancel()
+        await workers[1].backend.close()
+        await asyncio.sleep(0.4)
+        ponger.cancel()
+        await workers[0].shutdown()
+        return rosters, watcher, workers[0].roster("general")
+
+    rosters, watcher, final = asyncio.run(scenario())
+    assert rosters == [["1", "2"], ["1", "2"]]
+    frames = [json.loads(m) for m in watcher.sent if json.loads(m)["type"] == "presence"]
+    diffs = [(d["joined"], d["left"]) for d in frames]
+    assert diffs == [(["1"], []), (["2"], []), (["3"], []), ([], ["3"]), ([], ["2"])]
+    assert final == ["1"]
+
+
+def test_presence_forgets_rooms_once_their_last_socket_leaves():
+    async def scenario():
+        manager = ConnectionManager(heartbeat_interval=60)
+        watcher, alice = FakeSocket(), FakeSocket()
+        await manager.connect(watcher, "short-lived", user_id="1", presence=True)
+        await manager.connect(alice, "short-lived", user_id="2")
+        manager.disconnect(watcher, "short-lived")
+        manager.disconnect(alice, "short-lived")
+        await asyncio.sleep(0.01)
+        await manager._apply_state("short-lived", {"worker": "other", "users": ["3"]})
+        await manager.shutdown()
+        return manager
+
+    manager = asyncio.run(scenario())
+    assert manager.rooms == {} and manager._rosters == {} and manager._remote == {}
+
+
+def test_presence_endpoint_reads_roster_from_memory():
+    assert client.get("/api/v1/chat/rooms/presence-test/presence").status_code == 401
+    app.dependency_overrides[deps.get_current_principal] = lambda: deps.Principal(1, "a@example.com", "employee", None, True, False)
+    try:
+        with client.websocket_connect("/api/v1/chat/ws?user_id=42&room=presence-test&presence=true") as ws:
+            assert json.loads(ws.receive_text())["joined"] == ["42"]
+            response = client.get("/api/v1/chat/rooms/presence-test/presence")
+            assert response.json() == {"room": "presence-test", "users": ["42"], "count": 1}
+    finally:
+        app.dependency_overrides.pop(deps.get_current_principal, None)
+
+
+def test_chat_metrics_are_for_admins_only():
+    assert client.get("/api/v1/chat/metrics").status_code == 401
+    for role, expected in (("employee", 403), ("admin", 200)):
+        app.dependency_overrides[deps.get_current_principal] = lambda: deps.Principal(1, "a@example.com", role, None, True, False)
+        try:
+            assert client.get("/api/v1/chat/metrics").status_code == expected
+        finally:
+            app.dependency_overrides.pop(deps.get_current_principal, None)
@@ -0,0 +1,109 @@
+"""SQLite production profile: pragmas, WAL readers and the single-writer gate."""
+
+import threading
+import time
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, func, insert, select, text, update
+
+from app.db import WriterGate, apply_sqlite_profile
+
+metadata = MetaData()
+counters = Table("counters", metadata, Column("id", Integer, primary_key=True), Column("n", Integer, nullable=False))
+events = Table("events", metadata, Column("id", Integer, primary_key=True), Column("worker", String, nullable=False))
+
+
+def profiled_engine(tmp_path, gate):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'stress.db'}", pool_size=32, max_overflow=0, connect_args={"check_same_thread": False}
+    )
+    apply_sqlite_profile(engine, gate)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(counters).values(id=1, n=0))
+    return engine
+
+
+def test_profile_sets_pragmas(tmp_path):
+    engine = profiled_engine(tmp_path, None)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        assert conn.exec_driver_sql("PRAGMA cache_size").scalar() == -65536
+
+
+def test_concurrent_writers_and_readers_do_not_hit_database_is_locked(tmp_path):
+    gate = WriterGate(timeout=30)
+    engine = profiled_engine(tmp_path, gate)
+    writers, transactions, errors = 16, 40, []
+    stop = threading.Event()
+    reads = []
+
+    def write(worker):
+        try:
+            for _ in range(transactions):
+                with engine.begin() as conn:
+                    conn.execute(select(func.count()).select_from(events)).scalar()
+                    conn.execute(insert(events).values(worker=str(worker)))
+                    conn.execute(update(counters).where(counters.c.id == 1).values(n=counters.c.n + 1))
+        except Exception as e:  # pragma: no cover - reported below
+            errors.append(e)
+
+    def read():
+        while not stop.is_set():
+            started = time.perf_counter()
+            with engine.connect() as conn:
+                conn.execute(select(func.count()).select_from(events)).scalar()
+            reads.append(time.perf_counter() - started)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(writers)]
+    for t in readers + threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stop.set()
+    for t in readers:
+        t.join()
+
+    assert errors == []
+    with engine.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(events)).scalar() == writers * transactions
+        assert conn.execute(select(counters.c.n)).scalar() == writers * transactions
+    assert gate.stats["writes"] >= writers * transactions and gate.stats["timeouts"] == 0
+    assert reads and max(reads) < 1.0
+
+
+def test_readers_are_not_blocked_by_an_open_write_transaction(tmp_path):
+    engine = profiled_engine(tmp_path, WriterGate(timeout=5))
+    with engine.connect() as writer:
+        writer.execute(insert(events).values(worker="pending"))  # Uncommitted write holds the lock
+        started = time.perf_counter()
+        with engine.connect() as reader:
+            assert reader.execute(select(func.count()).select_from(events)).scalar() == 0
+        assert time.perf_counter() - started < 0.5
+        writer.commit()
+    with engine.connect() as reader:
+        assert reader.execute(text("SELECT count(*) FROM events")).scalar() == 1
+
+
+def test_a_second_write_connection_on_the_writing_thread_skips_the_gate(tmp_path):
+    gate = WriterGate(timeout=2)
+    engine = profiled_engine(tmp_path, gate)
+    with engine.connect() as first:
+        first.execute(insert(events).values(worker="first"))  # Holds the gate, uncommitted
+        started = time.perf_counter()
+        with engine.connect() as second:
+            # A write SQLite lets through (temp schema) must not wait on the thread's own gate
+            second.exec_driver_sql("CREATE TEMP TABLE scratch (x INTEGER)")
+        assert time.perf_counter() - started < 0.5
+        assert gate.stats["reentered"] == 1 and gate.stats["timeouts"] == 0
+        first.commit()
+
+    # The first connection's checkin released the gate; other threads get it at once
+    acquired = []
+    worker = threading.Thread(target=lambda: acquired.append(gate.acquire()))
+    worker.start()
+    worker.join()
+    assert acquired == [True] and gate.stats["waited"] == 0
+    gate.release()
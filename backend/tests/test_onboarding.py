@@ -10,6 +10,7 @@ def test_onboarding_flow():
         return models.User(id=999, email="admin@example.com", is_superuser=True, role="admin", full_name="Admin")
     
     app.dependency_overrides[deps.get_current_user] = override_admin
+    app.dependency_overrides[deps.get_current_principal] = lambda: deps.Principal.from_user(override_admin())
     
     # 2. Invite a new user
     invite_data = {
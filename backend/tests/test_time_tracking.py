@@ -0,0 +1,543 @@
+"""Tests for clocking and the attendance dashboard."""
+
+import asyncio
+import csv
+import io
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytest
+from fastapi import Depends
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app import crud, deps, models, schemas
+from app.api.v1 import time_tracking
+from app.config import settings
+from app.db import SessionLocal, engine, get_db
+from app.main import app
+from app.utils.attendance_stream import AttendanceHub
+from app.utils.entry_sweeper import OpenEntrySweeper
+from app.utils.open_sessions import open_sessions
+from app.utils.geofence import Site, SiteIndex, haversine, haversine_np
+from app.utils.timesheet_export import COLUMNS, export_batches
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def company():
+    """A fresh company with an HR user and two employees."""
+    tag = uuid.uuid4().hex[:8]
+    with SessionLocal() as db:
+        company = models.Company(name=f"Company {tag}")
+        db.add(company)
+        db.flush()
+        users = [
+            models.User(email=f"{name}-{tag}@example.com", hashed_password="x", full_name=name, role=role, company_id=company.id)
+            for name, role in (("hr", "hr"), ("alice", "employee"), ("bob", "employee"))
+        ]
+        db.add_all(users)
+        db.commit()
+        ids = {u.full_name: u.id for u in users}
+        company_id = company.id
+    yield company_id, ids
+    app.dependency_overrides = {}
+
+
+def act_as(user_id: int):
+    def override(db: Session = Depends(get_db)):
+        return db.get(models.User, user_id)
+
+    def override_principal(db: Session = Depends(get_db)):
+        return deps.Principal.from_user(db.get(models.User, user_id))
+    app.dependency_overrides[deps.get_current_user] = override
+    app.dependency_overrides[deps.get_current_principal] = override_principal
+    app.dependency_overrides[deps.get_current_principal_detached] = override_principal
+
+
+def test_dashboard_aggregates_company_attendance(company):
+    company_id, ids = company
+    today = datetime.combine(date.today(), datetime.min.time())
+    with SessionLocal() as db:
+        db.add_all([
+            models.TimeEntry(user_id=ids["alice"], clock_in=today + timedelta(hours=1), clock_out=today + timedelta(hours=2)),
+            models.TimeEntry(user_id=ids["alice"], clock_in=today + timedelta(hours=3), clock_out=today + timedelta(hours=4, minutes=30)),
+            models.TimeEntry(user_id=ids["alice"], clock_in=today - timedelta(days=1), clock_out=today - timedelta(hours=20)),
+        ])
+        db.commit()
+        crud.backfill_attendance_days(db)
+
+    act_as(ids["bob"])
+    assert client.post("/api/v1/time-tracking/clock", json={"action": "clock_in"}).status_code == 200
+    act_as(ids["hr"])
+    response = client.get("/api/v1/time-tracking/dashboard")
+    assert response.status_code == 200, response.text
+    data = response.json()
+
+    by_user = {s["user_id"]: s for s in data["stats"]}
+    assert set(by_user) == set(ids.values())
+    assert data["online_count"] == 1 and data["offline_count"] == 2
+    alice = by_user[ids["alice"]]
+    assert alice["status"] == "offline"
+    assert alice["total_hours"] == 2.5
+    assert alice["clock_in"].startswith((today + timedelta(hours=1)).isoformat())
+    assert by_user[ids["bob"]]["status"] == "online"
+    assert by_user[ids["hr"]]["total_hours"] == 0.0
+
+
+def test_clock_actions_maintain_daily_rollup(company):
+    _, ids = company
+    act_as(ids["alice"])
+    for action in ("clock_in", "clock_out", "clock_in"):
+        assert client.post("/api/v1/time-tracking/clock", json={"action": action}).status_code == 200
+
+    def rollup(db):
+        return db.query(models.AttendanceDay).filter(models.AttendanceDay.user_id == ids["alice"]).one()
+
+    with SessionLocal() as db:
+        live = rollup(db)
+        entries = db.query(models.TimeEntry).filter(models.TimeEntry.user_id == ids["alice"]).order_by(models.TimeEntry.id).all()
+        assert live.open_count == 1
+        assert live.open_since == entries[1].clock_in
+        assert live.first_clock_in == entries[0].clock_in
+        assert live.last_clock_out == entries[0].clock_out
+        assert live.total_seconds == pytest.approx((entries[0].clock_out - entries[0].clock_in).total_seconds())
+        snapshot = (live.total_seconds, live.first_clock_in, live.last_clock_out, live.open_since, live.open_count)
+
+        crud.backfill_attendance_days(db)
+        rebuilt = rollup(db)
+        assert rebuilt.total_seconds == pytest.approx(snapshot[0], abs=1e-3)
+        assert (rebuilt.first_clock_in, rebuilt.last_clock_out, rebuilt.open_since, rebuilt.open_count) == snapshot[1:]
+
+
+def test_open_session_registry_tracks_punches(company):
+    _, ids = company
+    with SessionLocal() as db:
+        db.add(models.TimeEntry(user_id=ids["bob"], clock_in=datetime.utcnow() - timedelta(days=2)))
+        db.commit()
+        open_sessions.load(db)
+    try:
+        assert open_sessions.is_open(ids["bob"]) is True
+        act_as(ids["alice"])
+        for action in ("clock_in", "clock_in", "clock_out"):
+            client.post("/api/v1/time-tracking/clock", json={"action": action})
+        assert open_sessions.is_open(ids["alice"]) is True
+
+        with SessionLocal() as db:
+            still_open = db.query(models.TimeEntry).filter(
+                models.TimeEntry.user_id == ids["alice"], models.TimeEntry.clock_out.is_(None)
+            ).one()
+        assert open_sessions.latest(ids["alice"])[1] == still_open.id
+
+        act_as(ids["hr"])
+        by_user = {s["user_id"]: s for s in client.get("/api/v1/time-tracking/dashboard").json()["stats"]}
+        assert by_user[ids["bob"]]["status"] == "online"  # open since two days ago
+
+        act_as(ids["alice"])
+        client.post("/api/v1/time-tracking/clock", json={"action": "clock_out"})
+        assert open_sessions.is_open(ids["alice"]) is False
+    finally:
+        open_sessions.clear()
+
+
+def test_clock_out_closes_an_entry_opened_on_another_worker(company):
+    _, ids = company
+    with SessionLocal() as db:
+        open_sessions.load(db)
+        # Clocked in through another worker: this worker's registry never saw it
+        entry = models.TimeEntry(user_id=ids["alice"], clock_in=datetime.utcnow() - timedelta(hours=1))
+        db.add(entry)
+        db.commit()
+        entry_id = entry.id
+    try:
+        act_as(ids["alice"])
+        response = client.post("/api/v1/time-tracking/clock", json={"action": "clock_out"})
+        assert response.status_code == 200 and response.json()["id"] == entry_id
+        with SessionLocal() as db:
+            assert db.query(models.TimeEntry).filter_by(user_id=ids["alice"]).count() == 1
+    finally:
+        open_sessions.clear()
+
+
+def test_concurrent_clock_outs_close_each_entry_once(company):
+    _, ids = company
+    start = datetime.utcnow() - timedelta(hours=1)
+    with SessionLocal() as db:
+        db.add_all([models.TimeEntry(user_id=ids["alice"], clock_in=start + timedelta(minutes=i)) for i in range(4)])
+        db.commit()
+
+    def clock_out(_):
+        with SessionLocal() as db:
+            return crud.create_time_entry(db, schemas.TimeEntryCreate(action="clock_out"), user_id=ids["alice"]).id
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        closed = list(pool.map(clock_out, range(8)))
+
+    assert len(set(closed)) == 8
+    with SessionLocal() as db:
+        entries = db.query(models.TimeEntry).filter(models.TimeEntry.user_id == ids["alice"]).all()
+        assert len(entries) == 8 and all(e.clock_out is not None for e in entries)
+        plan = db.execute(text(
+            "EXPLAIN QUERY PLAN SELECT id FROM time_entries WHERE user_id = 1 AND clock_out IS NULL ORDER BY clock_in DESC"
+        )).all()
+    assert "ix_time_entries_open_user" in " ".join(str(row) for row in plan)
+
+
+def test_hub_pushes_status_deltas_once_per_change():
+    async def scenario():
+        hub = AttendanceHub()
+        queue = await hub.subscribe(7)
+        hub.seed(7, [1])
+        hub.publish_punch(7, 2, online=True)
+        hub.publish_punch(7, 2, online=True)   # no change, no event
+        hub.publish_punch(8, 3, online=True)   # other company
+        hub.publish_punch(7, 1, online=False)
+        await asyncio.sleep(0)
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    events = asyncio.run(scenario())
+    assert [(e["user_id"], e["status"], e["online_count"]) for e in events] == [(2, "online", 2), (1, "offline", 1)]
+
+
+def test_hub_carries_punches_to_dashboards_on_other_workers():
+    fakeredis = pytest.importorskip("fakeredis")
+    from app.utils.broadcast import RedisBroadcast
+
+    async def scenario():
+        server = fakeredis.FakeServer()
+        worker_a, worker_b = (
+            AttendanceHub(backend=RedisBroadcast(client=fakeredis.FakeAsyncRedis(server=server, decode_responses=True), prefix="attendance:"))
+            for _ in range(2)
+        )
+        await worker_a.start()
+        queue = await worker_b.subscribe(7)
+        worker_b.seed(7, [])
+        # The punch is handled on worker A's thread pool; the dashboard is on B
+        await asyncio.to_thread(worker_a.publish_punch, 7, 2, True)
+        event = await asyncio.wait_for(queue.get(), 2)
+        worker_b.unsubscribe(7, queue)
+        await worker_a.close()
+        await worker_b.close()
+        return event
+
+    event = asyncio.run(scenario())
+    assert (event["user_id"], event["status"], event["online_count"]) == (2, "online", 1)
+
+
+def test_stream_replays_a_punch_between_snapshot_and_seed_without_pinning_a_connection(company, monkeypatch):
+    company_id, ids = company
+    with SessionLocal() as db:
+        hr = deps.Principal.from_user(db.get(models.User, ids["hr"]))
+    read_snapshot = time_tracking.build_attendance_dashboard
+
+    def snapshot_then_punch(db, company_id):
+        snapshot = read_snapshot(db, company_id)
+        # Alice clocks in after the snapshot was read but before it seeds the hub
+        act_as(ids["alice"])
+        assert client.post("/api/v1/time-tracking/clock", json={"action": "clock_in"}).status_code == 200
+        return snapshot
+
+    monkeypatch.setattr(time_tracking, "build_attendance_dashboard", snapshot_then_punch)
+
+    async def scenario():
+        before = engine.pool.checkedout()
+        response = await time_tracking.stream_attendance(current_user=hr)
+        frames = response.body_iterator
+        snapshot = await frames.__anext__()
+        held = engine.pool.checkedout() - before
+        delta = await asyncio.wait_for(frames.__anext__(), 5)
+        await frames.aclose()
+        return snapshot, held, delta
+
+    snapshot, held, delta = asyncio.run(scenario())
+    assert snapshot.startswith("event: snapshot") and json.loads(snapshot.split("data: ", 1)[1])["online_count"] == 0
+    assert held == 0
+    event = json.loads(delta.split("data: ", 1)[1])
+    assert (event["user_id"], event["status"], event["online_count"]) == (ids["alice"], "online", 1)
+
+
+def test_site_index_matches_brute_force():
+    rng = np.random.default_rng(7)
+    sites = [
+        Site(i, f"site {i}", float(lat), float(lon), float(r))
+        for i, (lat, lon, r) in enumerate(zip(rng.uniform(12.8, 13.2, 60), rng.uniform(77.4, 77.8, 60), rng.uniform(50, 800, 60)))
+    ]
+    index = SiteIndex(sites)
+    lats, lons = rng.uniform(12.8, 13.2, 500), rng.uniform(77.4, 77.8, 500)
+
+    expected = []
+    for lat, lon in zip(lats, lons):
+        expected.append(any(haversine(lon, lat, s.longitude, s.latitude) <= s.radius for s in sites))
+        assert index.nearest(lat, lon).allowed == expected[-1]
+    assert index.contains_many(lats, lons).tolist() == expected
+    assert haversine_np(lons, lats, 77.6, 13.0) == pytest.approx([haversine(lo, la, 77.6, 13.0) for la, lo in zip(lats, lons)])
+
+
+def test_clock_in_accepts_any_company_site(company):
+    company_id, ids = company
+    act_as(ids["hr"])
+    for name, lat, lon in (("HQ", 12.9716, 77.5946), ("Client", 19.0760, 72.8777)):
+        response = client.post("/api/v1/companies/me/sites", json={"name": name, "latitude": lat, "longitude": lon, "radius": 200})
+        assert response.status_code == 201, response.text
+
+    act_as(ids["alice"])
+    far = client.post("/api/v1/time-tracking/clock", json={"action": "clock_in", "latitude": 19.0787, "longitude": 72.8777})
+    assert far.status_code == 403 and "Client" in far.json()["detail"]
+    near = client.post("/api/v1/time-tracking/clock", json={"action": "clock_in", "latitude": 19.0765, "longitude": 72.8780})
+    assert near.status_code == 200, near.text
+    nowhere = client.post("/api/v1/time-tracking/clock", json={"action": "clock_in", "latitude": 0.0, "longitude": 0.0})
+    assert nowhere.status_code == 403
+    assert client.post("/api/v1/time-tracking/clock", json={"action": "clock_in"}).status_code == 400
+
+
+def test_export_streams_company_entries_in_range(company):
+    company_id, ids = company
+    day = datetime(2024, 3, 4, 9)
+    with SessionLocal() as db:
+        db.add_all(
+            [models.TimeEntry(user_id=ids["alice"], clock_in=day + timedelta(days=i), clock_out=day + timedelta(days=i, hours=8)) for i in range(5)]
+            + [models.TimeEntry(user_id=ids["bob"], clock_in=day + timedelta(days=10))]
+        )
+        db.commit()
+
+    batches = list(export_batches(company_id, day, day + timedelta(days=30), batch_size=2))
+    assert [len(b) for b in batches] == [2, 2, 2]
+
+    act_as(ids["hr"])
+    params = {"start": "2024-03-05", "end": "2024-03-14"}
+    response = client.get("/api/v1/time-tracking/export", params=params)
+    assert response.status_code == 200, response.text
+    assert "attachment" in response.headers["content-disposition"]
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [r["user_id"] for r in rows] == [str(ids["alice"])] * 4 + [str(ids["bob"])]
+    assert rows[0]["duration_seconds"] == "28800.0" and rows[-1]["clock_out"] == ""
+
+    response = client.get("/api/v1/time-tracking/export", params={**params, "format": "ndjson"})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 5 and list(lines[0]) == COLUMNS
+
+    assert client.get("/api/v1/time-tracking/export", params={**params, "format": "xml"}).status_code == 400
+    act_as(ids["alice"])
+    assert client.get("/api/v1/time-tracking/export", params=params).status_code == 403
+
+
+def test_export_parquet(company):
+    pq = pytest.importorskip("pyarrow.parquet")
+    company_id, ids = company
+    with SessionLocal() as db:
+        db.add(models.TimeEntry(user_id=ids["alice"], clock_in=datetime(2024, 3, 4, 9), clock_out=datetime(2024, 3, 4, 17)))
+        db.commit()
+
+    act_as(ids["hr"])
+    response = client.get("/api/v1/time-tracking/export", params={"start": "2024-03-04", "end": "2024-03-04", "format": "parquet"})
+    assert response.status_code == 200, response.text
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.column_names == COLUMNS
+    assert table.column("duration_seconds").to_pylist() == [8 * 3600.0]
+
+
+def test_punch_batch_pairs_geofences_and_is_idempotent(company, monkeypatch):
+    company_id, ids = company
+    monkeypatch.setattr(settings, "OFFLINE_PUNCH_MAX_AGE_HOURS", 0)  # The batch replays May 2024
+    act_as(ids["hr"])
+    client.post("/api/v1/companies/me/sites", json={"name": "HQ", "latitude": 12.9716, "longitude": 77.5946, "radius": 200})
+    with SessionLocal() as db:
+        db.add(models.TimeEntry(user_id=ids["bob"], clock_in=datetime(2024, 5, 1, 8)))
+        db.commit()
+
+    at_hq = {"latitude": 12.9717, "longitude": 77.5947}
+    punches = [
+        {"client_id": "a1", "user_id": ids["alice"], "action": "clock_in", "timestamp": "2024-05-01T09:00:00", **at_hq},
+        {"client_id": "a2", "user_id": ids["alice"], "action": "clock_out", "timestamp": "2024-05-01T17:00:00"},
+        {"client_id": "a3", "user_id": ids["alice"], "action": "clock_in", "timestamp": "2024-05-02T09:00:00", "latitude": 13.5, "longitude": 77.5},
+        {"client_id": "b1", "user_id": ids["bob"], "action": "clock_out", "timestamp": "2024-05-01T12:00:00+02:00"},
+        {"client_id": "a1", "user_id": ids["alice"], "action": "clock_in", "timestamp": "2024-05-01T09:00:00", **at_hq},
+        {"client_id": "x1", "user_id": 10 ** 9, "action": "clock_in", "timestamp": "2024-05-01T09:00:00"},
+    ]
+    response = client.post("/api/v1/time-tracking/punches/batch", json={"punches": punches})
+    assert response.status_code == 200, response.text
+    report = response.json()
+    assert [r["status"] for r in report["results"]] == ["accepted", "accepted", "rejected", "accepted", "duplicate", "rejected"]
+    assert (report["accepted"], report["duplicates"], report["rejected"]) == (3, 1, 2)
+    results = report["results"]
+    assert results[0]["entry_id"] == results[1]["entry_id"] == results[4]["entry_id"]
+
+    with SessionLocal() as db:
+        alice = db.get(models.TimeEntry, results[0]["entry_id"])
+        assert (alice.clock_in, alice.clock_out) == (datetime(2024, 5, 1, 9), datetime(2024, 5, 1, 17))
+        bob = db.get(models.TimeEntry, results[3]["entry_id"])
+        assert bob.clock_out == datetime(2024, 5, 1, 10)
+        day = db.query(models.AttendanceDay).filter_by(user_id=ids["alice"], day=date(2024, 5, 1)).one()
+        assert day.total_seconds == pytest.approx(8 * 3600) and day.open_count == 0
+
+    replay = client.post("/api/v1/time-tracking/punches/batch", json={"punches": punches[:4]}).json()
+    assert [r["status"] for r in replay["results"]] == ["duplicate", "duplicate", "rejected", "duplicate"]
+    assert replay["results"][0]["entry_id"] == results[0]["entry_id"]
+    with SessionLocal() as db:
+        assert db.query(models.TimeEntry).filter(models.TimeEntry.user_id == ids["alice"]).count() == 1
+
+    act_as(ids["alice"])
+    other = [{"client_id": "b2", "user_id": ids["bob"], "action": "clock_in", "timestamp": "2024-05-03T09:00:00", **at_hq}]
+    assert client.post("/api/v1/time-tracking/punches/batch", json={"punches": other}).json()["rejected"] == 1
+
+
+def test_punch_batch_expires_old_punches_and_repeats_verdicts(company):
+    company_id, ids = company
+    act_as(ids["alice"])
+    now = datetime.utcnow().replace(microsecond=0)
+    old = (now - timedelta(hours=settings.OFFLINE_PUNCH_MAX_AGE_HOURS + 1)).isoformat()
+    future = (now + timedelta(days=1)).isoformat()
+    punches = [
+        {"client_id": "old", "user_id": ids["alice"], "action": "clock_in", "timestamp": old},
+        {"client_id": "soon", "user_id": ids["alice"], "action": "clock_in", "timestamp": future},
+        {"client_id": "ok", "user_id": ids["alice"], "action": "clock_in", "timestamp": (now - timedelta(hours=2)).isoformat()},
+        {"client_id": "old", "user_id": ids["alice"], "action": "clock_in", "timestamp": old},
+        {"client_id": "soon", "user_id": ids["alice"], "action": "clock_in", "timestamp": future},
+        {"client_id": "ok", "user_id": ids["alice"], "action": "clock_in", "timestamp": (now - timedelta(hours=2)).isoformat()},
+    ]
+    report = client.post("/api/v1/time-tracking/punches/batch", json={"punches": punches}).json()
+    results = report["results"]
+    assert [r["status"] for r in results] == ["expired", "rejected", "accepted", "expired", "rejected", "duplicate"]
+    assert (report["accepted"], report["duplicates"], report["rejected"], report["expired"]) == (1, 1, 2, 2)
+    assert results[3]["detail"] == results[0]["detail"] and "hours old" in results[0]["detail"]
+    assert results[4]["detail"] == results[1]["detail"] == "timestamp is in the future"
+    with SessionLocal() as db:
+        assert db.query(models.TimeEntry).filter(models.TimeEntry.user_id == ids["alice"]).count() == 1
+
+
+def test_analytics_weekly_hours_overtime_and_lateness(company):
+    company_id, ids = company
+    monday = datetime(2024, 1, 1)
+    with SessionLocal() as db:
+        db.add_all([
+            # Monday: 10 h across two entries, on time
+            models.TimeEntry(user_id=ids["alice"], clock_in=monday + timedelta(hours=8), clock_out=monday + timedelta(hours=13)),
+            models.TimeEntry(user_id=ids["alice"], clock_in=monday + timedelta(hours=14), clock_out=monday + timedelta(hours=19)),
+            # Tuesday: late, 6 h
+            models.TimeEntry(user_id=ids["alice"], clock_in=monday + timedelta(days=1, hours=10), clock_out=monday + timedelta(days=1, hours=16)),
+            # Next Monday: still open, late
+            models.TimeEntry(user_id=ids["alice"], clock_in=monday + timedelta(days=7, hours=9, minutes=30)),
+            models.TimeEntry(user_id=ids["bob"], clock_in=monday + timedelta(days=2, hours=9), clock_out=monday + timedelta(days=2, hours=12)),
+        ])
+        db.commit()
+
+    act_as(ids["hr"])
+    params = {"start": "2024-01-01", "end": "2024-01-31"}
+    response = client.get("/api/v1/time-tracking/analytics", params=params)
+    assert response.status_code == 200, response.text
+    rows = {(r["user_id"], r["period_start"]): r for r in response.json()["rows"]}
+    assert set(rows) == {(ids["alice"], "2024-01-01"), (ids["alice"], "2024-01-08"), (ids["bob"], "2024-01-01")}
+    week1 = rows[(ids["alice"], "2024-01-01")]
+    assert (week1["hours"], week1["overtime_hours"], week1["late_days"], week1["days_worked"]) == (16.0, 2.0, 1, 2)
+    assert rows[(ids["alice"], "2024-01-08")]["hours"] == 0.0 and rows[(ids["alice"], "2024-01-08")]["late_days"] == 1
+    assert rows[(ids["bob"], "2024-01-01")]["late_days"] == 0
+
+    # A grace period moves the lateness cut-off
+    lenient = client.get("/api/v1/time-tracking/analytics", params={**params, "grace_minutes": 45}).json()["rows"]
+    assert sum(r["late_days"] for r in lenient) == 1
+    monthly = client.get("/api/v1/time-tracking/analytics", params={**params, "period": "month"}).json()["rows"]
+    assert {r["period_start"] for r in monthly} == {"2024-01-01"}
+    assert client.get("/api/v1/time-tracking/analytics", params={**params, "period": "day"}).status_code == 400
+
+
+def test_sweeper_auto_closes_stale_entries_in_batches(company):
+    _, ids = company
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        stale = [models.TimeEntry(user_id=ids["alice"], clock_in=now - timedelta(days=3, hours=i)) for i in range(5)]
+        fresh = models.TimeEntry(user_id=ids["bob"], clock_in=now - timedelta(hours=2))
+        db.add_all(stale + [fresh])
+        db.commit()
+        stale_ids, fresh_id = [e.id for e in stale], fresh.id
+        crud.backfill_attendance_days(db)
+        open_sessions.load(db)
+
+    try:
+        sweeper = OpenEntrySweeper(max_hours=12, interval=0, batch_size=2)
+        assert sweeper.sweep(now) >= 5
+        assert sweeper.stats["last_pass_batches"] >= 3
+        assert open_sessions.is_open(ids["alice"]) is False and open_sessions.is_open(ids["bob"]) is True
+    finally:
+        open_sessions.clear()
+
+    with SessionLocal() as db:
+        for entry_id in stale_ids:
+            entry = db.get(models.TimeEntry, entry_id)
+            assert entry.auto_closed and entry.clock_out - entry.clock_in == timedelta(hours=12)
+        assert db.get(models.TimeEntry, fresh_id).clock_out is None
+        days = db.query(models.AttendanceDay).filter(models.AttendanceDay.user_id == ids["alice"]).all()
+        assert sum(d.open_count for d in days) == 0
+        assert sum(d.total_seconds for d in days) == pytest.approx(5 * 12 * 3600)
+
+    assert OpenEntrySweeper(max_hours=12, interval=0).sweep(now) == 0
+    act_as(ids["hr"])
+    assert client.get("/api/v1/time-tracking/metrics").status_code == 403
+    app.dependency_overrides[deps.get_current_principal] = lambda: deps.Principal(0, "ops@example.com", "admin", None, True, False)
+    assert client.get("/api/v1/time-tracking/metrics").json()["sweeper"]["max_hours"] == 16.0
+
+
+def test_sweeper_pushes_offline_deltas_to_live_dashboards(company, monkeypatch):
+    from fastapi.concurrency import run_in_threadpool
+    from app.utils import entry_sweeper
+
+    company_id, ids = company
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        db.add_all([
+            models.TimeEntry(user_id=ids["alice"], clock_in=now - timedelta(days=2)),
+            models.TimeEntry(user_id=ids["bob"], clock_in=now - timedelta(days=2)),
+            models.TimeEntry(user_id=ids["bob"], clock_in=now - timedelta(hours=1)),
+        ])
+        db.commit()
+    hub = AttendanceHub()
+    monkeypatch.setattr(entry_sweeper, "attendance_hub", hub)
+
+    async def scenario():
+        queue = await hub.subscribe(company_id)
+        hub.seed(company_id, [ids["alice"], ids["bob"]])
+        await run_in_threadpool(OpenEntrySweeper(max_hours=12, interval=0).sweep, now)
+        await asyncio.sleep(0)
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    events = asyncio.run(scenario())
+    # Bob still has a fresh entry open, so only Alice goes offline
+    assert [(e["user_id"], e["status"]) for e in events] == [(ids["alice"], "offline")]
+
+
+def test_clock_out_does_not_reclose_an_entry_the_sweeper_closed(company, monkeypatch):
+    company_id, ids = company
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        stale = models.TimeEntry(user_id=ids["alice"], clock_in=now - timedelta(days=2))
+        db.add(stale)
+        db.commit()
+        stale_id = stale.id
+        crud.backfill_attendance_days(db)
+    read_open_entry = crud._latest_open_entry
+
+    def read_then_lose_race(db, user_id):
+        entry = read_open_entry(db, user_id)
+        if entry is not None:
+            # Another worker's sweeper closes it before this clock_out writes
+            with SessionLocal() as other:
+                other.execute(text(
+                    "UPDATE time_entries SET clock_out = :closed_at, auto_closed = 1 WHERE id = :id"
+                ), {"id": entry.id, "closed_at": entry.clock_in + timedelta(hours=12)})
+                crud.rebuild_attendance_days(other, [(user_id, entry.clock_in.date())])
+                other.commit()
+        return entry
+
+    monkeypatch.setattr(crud, "_latest_open_entry", read_then_lose_race)
+    act_as(ids["alice"])
+    response = client.post("/api/v1/time-tracking/clock", json={"action": "clock_out"})
+    assert response.status_code == 200 and response.json()["id"] != stale_id
+    with SessionLocal() as db:
+        entry = db.get(models.TimeEntry, stale_id)
+        assert entry.auto_closed and entry.clock_out - entry.clock_in == timedelta(hours=12)
+        day = db.query(models.AttendanceDay).filter_by(user_id=ids["alice"], day=entry.clock_in.date()).one()
+        assert day.total_seconds == pytest.approx(12 * 3600) and day.open_count == 0
@@ -17,6 +17,7 @@ export default function Chat() {
     const [activeChat, setActiveChat] = useState(null); // { id, full_name, type: 'dm' }
     const [messages, setMessages] = useState([]);
     const [inputText, setInputText] = useState('');
+    const [roomUsers, setRoomUsers] = useState([]); // user ids (strings) present in the room
     const ws = useRef(null);
     const messagesEndRef = useRef(null);
 
@@ -40,11 +41,23 @@ export default function Chat() {
         // Fetch history first
         fetchHistory(roomId);
 
-        // Connect WS
-        const wsUrl = `${process.env.NEXT_PUBLIC_WS_URL || 'ws://localhost:8000'}/api/v1/chat/ws?user_id=${user.id}&room=${roomId}`;
+        // Connect WS (presence=true: roster diffs, plus pings we must answer or be reaped)
+        const wsUrl = `${process.env.NEXT_PUBLIC_WS_URL || 'ws://localhost:8000'}/api/v1/chat/ws?user_id=${user.id}&room=${roomId}&presence=true`;
         ws.current = new WebSocket(wsUrl);
+        setRoomUsers([]);
 
         ws.current.onmessage = (event) => {
+            // Control frames are JSON; chat messages are plain "User X: text"
+            if (event.data.startsWith('{')) {
+                const frame = JSON.parse(event.data);
+                if (frame.type === 'ping') {
+                    ws.current?.send('pong');
+                } else if (frame.type === 'presence') {
+                    setRoomUsers(prev => [...prev.filter(id => !frame.left.includes(id)), ...frame.joined.filter(id => !prev.includes(id))]);
+                }
+                return;
+            }
+
             // Assuming simplified text format for now based on backend: "User X: message"
             // We should parse it if possible, but backend sends text.
             // Let's just append.
@@ -124,9 +137,7 @@ export default function Chat() {
                     content: m.content,
                     isMine: m.sender_id === user.id,
                     sender: m.sender_id === user.id ? 'You' : activeChat.full_name
-                })).reverse(); // Assuming backend returns newest first? usually desc.
-                // If backend returns newest first, we reverse. If asc, don't.
-                // Standard limit=50 usually implies newest.
+                })); // Backend returns the newest page, oldest first.
                 setMessages(formatted);
             }
         });
@@ -255,9 +266,15 @@ export default function Chat() {
                                     </div>
                                     <div>
                                         <h3 className="font-semibold text-gray-900">{activeChat.full_name}</h3>
-                                        <p className="text-xs text-green-500 flex items-center gap-1">
-                                            <span className="w-1.5 h-1.5 rounded-full bg-green-500"></span> Online
-                                        </p>
+                                        {roomUsers.includes(String(activeChat.id)) ? (
+                                            <p className="text-xs text-green-500 flex items-center gap-1">
+                                                <span className="w-1.5 h-1.5 rounded-full bg-green-500"></span> Online
+                                            </p>
+                                        ) : (
+                                            <p className="text-xs text-gray-400 flex items-center gap-1">
+                                                <span className="w-1.5 h-1.5 rounded-full bg-gray-300"></span> Offline
+                                            </p>
+                                        )}
                                     </div>
                                 </div>
                                 <button className="text-gray-400 hover:text-gray-600">